@@ -0,0 +1,258 @@
+"""
+Buffered Access Logging
+Request threads push access records onto a bounded queue and a background
+thread writes them to the sink in batches as JSON lines
+"""
+
+import atexit
+import json
+import os
+import queue
+import random
+import sys
+import threading
+import time
+
+import config
+
+
+class StreamSink:
+    """Write log lines to a text stream (stdout by default)"""
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+
+    def write_lines(self, lines):
+        self.stream.write("".join(lines))
+        self.stream.flush()
+
+    def close(self):
+        self.stream.flush()
+
+
+class RotatingFileSink:
+    """
+    Append log lines to a file, rotating it once it grows past max_bytes
+    (access.log -> access.log.1 -> access.log.2 ...)
+    """
+
+    def __init__(self, path, max_bytes=10 * 1024 * 1024, backup_count=5):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self._file = open(path, "a", encoding="utf-8")
+        self._size = self._file.tell()
+
+    def _rotate(self):
+        self._file.close()
+        if self.backup_count > 0:
+            for i in range(self.backup_count - 1, 0, -1):
+                src = "{}.{}".format(self.path, i)
+                if os.path.exists(src):
+                    os.replace(src, "{}.{}".format(self.path, i + 1))
+            os.replace(self.path, self.path + ".1")
+        self._file = open(self.path, "w", encoding="utf-8")
+        self._size = 0
+
+    def write_lines(self, lines):
+        data = "".join(lines)
+        if self.max_bytes and self._size and self._size + len(data) > self.max_bytes:
+            self._rotate()
+        self._file.write(data)
+        self._file.flush()
+        self._size += len(data)
+
+    def close(self):
+        self._file.close()
+
+
+class AccessLogger:
+    """
+    Non-blocking access logger
+
+    log() never waits: when the queue is full the record is dropped and
+    counted instead. A daemon thread drains the queue in batches, encodes
+    each record as one JSON line and hands the batch to the sink.
+    """
+
+    _STOP = object()
+
+    def __init__(self, sink, queue_size=10000, batch_size=256,
+                 flush_interval=0.5, sample_rate=1.0):
+        self.sink = sink
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.sample_rate = sample_rate
+        self.logged = 0
+        self.dropped = 0
+        self.sampled_out = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="access-log", daemon=True)
+        self._thread.start()
+
+    def log(self, record):
+        """
+        Queue an access record (dict) for writing
+
+        Args:
+            record (dict): Fields to write as one JSON line
+
+        Returns:
+            bool: True if the record was queued
+        """
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            with self._lock:
+                self.sampled_out += 1
+            return False
+        try:
+            self._queue.put_nowait(record)
+            return True
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            return False
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+
+            batch = []
+            while True:
+                if item is self._STOP:
+                    stopping = True
+                    break
+                batch.append(json.dumps(item, default=str) + "\n")
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+
+            if batch:
+                try:
+                    self.sink.write_lines(batch)
+                except Exception as e:
+                    print("Access log write failed: {}".format(e), file=sys.stderr)
+                with self._lock:
+                    self.logged += len(batch)
+
+    def stats(self):
+        """Counters for records written, dropped on a full queue and sampled out"""
+        with self._lock:
+            return {
+                "logged": self.logged,
+                "dropped": self.dropped,
+                "sampled_out": self.sampled_out,
+                "queued": self._queue.qsize()
+            }
+
+    def close(self, timeout=5.0):
+        """Flush everything queued so far and stop the writer thread"""
+        if not self._thread.is_alive():
+            return
+        try:
+            self._queue.put(self._STOP, timeout=timeout)
+        except queue.Full:
+            pass
+        self._thread.join(timeout)
+        self.sink.close()
+
+
+def build_record(method, path, status, duration, remote_addr=None,
+                 user=None, size=None):
+    """
+    Build an access record
+
+    Args:
+        method (str): HTTP method
+        path (str): Request path including the query string
+        status (int): Response status code
+        duration (float): Request handling time in seconds
+        remote_addr (str): Client address
+        user (str): Authenticated user, if any
+        size (int): Response body size in bytes
+
+    Returns:
+        dict: Access record
+    """
+    return {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime()),
+        "remote_addr": remote_addr,
+        "user": user,
+        "method": method,
+        "path": path,
+        "status": status,
+        "bytes": size,
+        "duration_ms": round(duration * 1000, 3)
+    }
+
+
+_access_logger = None
+_access_logger_lock = threading.Lock()
+
+
+def get_access_logger():
+    """
+    Return the process-wide access logger, creating it from config on first use
+
+    Returns:
+        AccessLogger: The shared logger, or None when ACCESS_LOG_SINK is "off"
+    """
+    global _access_logger
+
+    if config.ACCESS_LOG_SINK == "off":
+        return None
+    if _access_logger is None:
+        with _access_logger_lock:
+            if _access_logger is None:
+                if config.ACCESS_LOG_SINK == "file":
+                    sink = RotatingFileSink(config.ACCESS_LOG_FILE,
+                                            config.ACCESS_LOG_MAX_BYTES,
+                                            config.ACCESS_LOG_BACKUP_COUNT)
+                else:
+                    sink = StreamSink()
+                _access_logger = AccessLogger(
+                    sink,
+                    queue_size=config.ACCESS_LOG_QUEUE_SIZE,
+                    batch_size=config.ACCESS_LOG_BATCH_SIZE,
+                    flush_interval=config.ACCESS_LOG_FLUSH_INTERVAL,
+                    sample_rate=config.ACCESS_LOG_SAMPLE_RATE
+                )
+                atexit.register(_access_logger.close)
+    return _access_logger
+
+
+# Test the access logger
+if __name__ == "__main__":
+    import io
+
+    print("Access Logger Test")
+    print("=" * 50)
+
+    out = io.StringIO()
+    logger = AccessLogger(StreamSink(out), queue_size=100, batch_size=10)
+    for i in range(50):
+        logger.log(build_record("GET", "/transactions/{}".format(i), 200, 0.0012))
+    logger.close()
+    print("Lines written: {}".format(len(out.getvalue().splitlines())))
+    print("Stats: {}".format(logger.stats()))
+    print("First line: {}".format(out.getvalue().splitlines()[0]))
+
+    # A tiny queue with a stalled sink must drop, not block
+    class SlowSink(StreamSink):
+        def write_lines(self, lines):
+            time.sleep(0.2)
+
+    logger = AccessLogger(SlowSink(io.StringIO()), queue_size=5, batch_size=1)
+    start = time.perf_counter()
+    for i in range(1000):
+        logger.log(build_record("GET", "/transactions", 200, 0.001))
+    elapsed = time.perf_counter() - start
+    print("\n1000 log() calls against a stalled sink took {:.4f}s".format(elapsed))
+    print("Stats: {}".format(logger.stats()))
@@ -3,27 +3,51 @@ REST API Server for Mobile Money Transactions
 Uses Flask to serve CRUD endpoints with Basic Authentication
 """
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, g, stream_with_context
 from functools import wraps
 import sys
 import os
+import time
 
 # Add parent directory to path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 # Import our modules
 from routes import (
+    start_loading,
+    is_ready,
+    get_health,
+    get_readiness,
     get_all_transactions,
+    export_transactions,
     get_transaction_by_id,
+    get_transactions_by_ids,
     create_transaction,
     update_transaction,
     delete_transaction,
-    get_transaction_stats
+    get_transaction_stats,
+    get_ledger,
+    get_counterparty_stats,
+    get_alerts,
+    search_counterparties
 )
 from auth import authenticate
+from access_log import get_access_logger, build_record
+from profiler import request_profiler, start_profiling, get_profile_report, reset_profiles
+from rate_limit import rate_limiter, in_flight, rate_limited_response, overloaded_response
+from changes import stream_slots, parse_since, poll_changes, stream_changes, wants_stream
+from tenants import tenant_store, partition_for
+from idempotency import run_idempotent
+import config
 
 app = Flask(__name__)
 
+# Start loading on import, so gunicorn, flask run and test clients get data
+# too. Under the debug reloader, `python app.py` runs twice: the parent only
+# watches files, and the child (WERKZEUG_RUN_MAIN=true) serves requests.
+if __name__ != '__main__' or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+    start_loading()
+
 # Authentication decorator
 def require_auth(f):
     @wraps(f)
@@ -34,10 +58,97 @@ def require_auth(f):
                 'error': auth_result['error'],
                 'message': 'Please provide valid credentials'
             }), auth_result['status']
+        g.user = auth_result['user']
+        if config.RATE_LIMIT_ENABLED:
+            allowed, retry_after, quota = rate_limiter.check(g.user)
+            if not allowed:
+                body, headers = rate_limited_response(retry_after, quota)
+                return jsonify(body), 429, headers
+        # Fail fast with 503 + Retry-After while the store is still loading
+        # (after auth, so only authenticated callers see the load progress)
+        if not is_ready() and request.path.startswith(('/transactions', '/counterparties')):
+            return jsonify(get_readiness()), 503, {'Retry-After': str(config.RETRY_AFTER_SECONDS)}
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+# Admin-only decorator (use after require_auth)
+def require_admin(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if g.get('user') not in config.ADMIN_USERS:
+            return jsonify({
+                'status': 'error',
+                'message': 'Admin access required',
+                'error_code': 403
+            }), 403
         return f(*args, **kwargs)
     return decorated_function
 
 
+# Account decorator (use after require_auth): passes the user's partition
+def with_account(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        partition, error = partition_for(g.user)
+        if error:
+            return jsonify(error), error['error_code']
+        return f(partition, *args, **kwargs)
+    return decorated_function
+
+
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.before_request
+def start_profile():
+    if request_profiler.wants(request.headers):
+        g.profile = request_profiler.start()
+
+
+@app.before_request
+def limit_in_flight():
+    """Shed load with a fast 503 once MAX_IN_FLIGHT requests are being handled"""
+    if request.path in ('/', '/healthz', '/readyz', '/transactions/changes'):
+        # The change feed is long-lived and capped by stream_slots instead
+        return None
+    if not in_flight.acquire():
+        body, headers = overloaded_response()
+        return jsonify(body), 503, headers
+    g.in_flight = True
+
+
+@app.teardown_request
+def release_in_flight(error):
+    if g.pop('in_flight', False):
+        in_flight.release()
+
+
+@app.teardown_request
+def stop_profile(error):
+    profile = g.pop('profile', None)
+    if profile is not None:
+        request_profiler.stop(profile, "{} {}".format(request.method, request.path))
+
+
+@app.after_request
+def log_access(response):
+    logger = get_access_logger()
+    if logger is not None and 'request_start' in g:
+        logger.log(build_record(
+            request.method,
+            request.full_path.rstrip('?'),
+            response.status_code,
+            time.perf_counter() - g.request_start,
+            remote_addr=request.remote_addr,
+            user=g.get('user'),
+            size=response.calculate_content_length()
+        ))
+    return response
+
+
 @app.route('/')
 def home():
     """API information endpoint - no auth required"""
@@ -46,23 +157,83 @@ def home():
         "version": "1.0",
         "description": "REST API for managing mobile money SMS transactions",
         "endpoints": {
-            "GET /transactions": "Get all transactions",
+            "GET /transactions?type=&from=&to=": "Get all transactions (optionally filtered)",
+            "GET /transactions?sort=-amount&limit=20": "Get the first transactions by amount, fee or timestamp",
+            "GET /transactions?ids=1,5,9": "Get several transactions by ID",
             "GET /transactions/<id>": "Get transaction by ID",
+            "GET /transactions/export?format=csv": "Download transactions as csv, ndjson or parquet",
+            "POST /transactions/lookup": "Get several transactions by ID ({\"ids\": [...]} body)",
             "POST /transactions": "Create new transaction",
             "PUT /transactions/<id>": "Update transaction",
             "DELETE /transactions/<id>": "Delete transaction",
-            "GET /transactions/stats": "Get transaction statistics"
+            "GET /transactions/stats?approx=1": "Get transaction statistics (approx: distinct counts, quantiles, heavy hitters)",
+            "GET /transactions/stats/counterparties?by=amount&k=10": "Top counterparties by amount or count",
+            "GET /transactions/changes?since=": "Change feed (Server-Sent Events, or long-poll with &wait=)",
+            "GET /transactions/ledger?from=&to=": "Net inflow, outflow and fees between two dates",
+            "GET /transactions/alerts?since=&rule=": "Velocity and unusual-amount alerts raised on new transactions",
+            "GET /counterparties/search?q=": "Find sender/receiver names despite typos, with their transaction IDs",
+            "GET /account/transactions": "Your own account's transactions (also /<id>, /stats, /ledger, POST, PUT, DELETE)",
+            "GET /admin/tenants": "Loaded accounts and cache statistics (admin)",
+            "GET /healthz": "Liveness check (no auth)",
+            "GET /readyz": "Readiness check with load progress (no auth)"
         },
         "authentication": "Basic Authentication required for all endpoints except /"
     })
 
 
+@app.route('/healthz')
+def healthz():
+    """Liveness: the process is up - no auth required"""
+    return jsonify(get_health()), 200
+
+
+@app.route('/readyz')
+def readyz():
+    """Readiness: 200 once transactions are loaded, 503 with progress before - no auth required"""
+    result = get_readiness()
+    return jsonify(result), result.get('error_code', 200)
+
+
 @app.route('/transactions', methods=['GET'])
 @require_auth
 def get_transactions():
-    """GET all transactions"""
-    result = get_all_transactions()
-    return jsonify(result), 200
+    """GET all transactions (filtered by ?type=&from=&to=, ordered by ?sort=&limit=), or only those listed in ?ids="""
+    ids = request.args.get('ids')
+    if ids is not None:
+        result = get_transactions_by_ids(ids)
+        return jsonify(result), result.get('error_code', 200)
+    result = get_all_transactions(request.args.get('type'), request.args.get('from'), request.args.get('to'),
+                                  request.args.get('sort'), request.args.get('limit'))
+    if 'chunks' in result:
+        return Response(result['chunks'], content_type=result['content_type'])
+    return jsonify(result), result.get('error_code', 200)
+
+
+@app.route('/transactions/export', methods=['GET'])
+@require_auth
+def export_trans():
+    """Stream transactions as CSV, NDJSON or Parquet (same filters as GET /transactions)"""
+    result = export_transactions(request.args.get('format', 'csv'), request.args.get('type'),
+                                 request.args.get('from'), request.args.get('to'))
+    if result['status'] != 'success':
+        return jsonify(result), result['error_code']
+    return Response(result['chunks'], content_type=result['content_type'], headers={
+        'Content-Disposition': 'attachment; filename="{}"'.format(result['filename'])})
+
+
+@app.route('/transactions/lookup', methods=['POST'])
+@require_auth
+def lookup_transactions():
+    """GET several transactions by ID, with the ID list in the body"""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or 'ids' not in data:
+        return jsonify({
+            'status': 'error',
+            'message': "Body must be a JSON object with an 'ids' list"
+        }), 400
+
+    result = get_transactions_by_ids(data['ids'])
+    return jsonify(result), result.get('error_code', 200)
 
 
 @app.route('/transactions/<int:transaction_id>', methods=['GET'])
@@ -85,9 +256,10 @@ def create_trans():
             'message': 'No JSON data provided'
         }), 400
     
-    result = create_transaction(data)
-    status_code = result.get('error_code', 201)
-    return jsonify(result), status_code
+    result, status_code, headers = run_idempotent(
+        request.headers.get('Idempotency-Key'), g.user, 'POST /transactions', data,
+        lambda: create_transaction(data), 201)
+    return jsonify(result), status_code, headers
 
 
 @app.route('/transactions/<int:transaction_id>', methods=['PUT'])
@@ -118,11 +290,202 @@ def delete_trans(transaction_id):
 @app.route('/transactions/stats', methods=['GET'])
 @require_auth
 def get_stats():
-    """GET transaction statistics"""
-    result = get_transaction_stats()
+    """GET transaction statistics (?approx=1 answers from streaming sketches)"""
+    result = get_transaction_stats(request.args.get('approx', '').lower() in ('1', 'true', 'yes'))
     return jsonify(result), 200
 
 
+@app.route('/transactions/stats/counterparties', methods=['GET'])
+@require_auth
+def get_top_counterparties():
+    """GET top counterparties, optionally for one type and a time window"""
+    result = get_counterparty_stats(request.args.get('by', 'amount'), request.args.get('k', 10),
+                                    request.args.get('type'), request.args.get('from'), request.args.get('to'))
+    return jsonify(result), result.get('error_code', 200)
+
+
+@app.route('/transactions/changes', methods=['GET'])
+@require_auth
+def get_changes():
+    """Follow creates, updates and deletes: SSE stream or long-poll"""
+    if not stream_slots.acquire():
+        body, headers = overloaded_response()
+        return jsonify(body), 503, headers
+
+    last_event_id = request.headers.get('Last-Event-ID')
+    if not wants_stream(request.headers.get('Accept'), request.args.get('stream')):
+        try:
+            result = poll_changes(request.args.get('since'), request.args.get('wait', 0), last_event_id)
+        finally:
+            stream_slots.release()
+        return jsonify(result), result.get('error_code', 200)
+
+    seq, error = parse_since(request.args.get('since'), last_event_id)
+    if error:
+        stream_slots.release()
+        return jsonify(error), error['error_code']
+
+    def generate():
+        try:
+            yield from stream_changes(seq)
+        finally:
+            stream_slots.release()
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
+
+
+@app.route('/transactions/ledger', methods=['GET'])
+@require_auth
+def get_ledger_summary():
+    """GET net flow and balance mismatches between two dates"""
+    result = get_ledger(request.args.get('from'), request.args.get('to'), request.args.get('limit', 100))
+    return jsonify(result), result.get('error_code', 200)
+
+
+@app.route('/transactions/alerts', methods=['GET'])
+@require_auth
+def get_transaction_alerts():
+    """GET alerts raised on loaded and created transactions (?since=<seq> to poll)"""
+    result = get_alerts(request.args.get('since', 0), request.args.get('rule'), request.args.get('id'),
+                        request.args.get('limit', 100))
+    return jsonify(result), result.get('error_code', 200)
+
+
+@app.route('/counterparties/search', methods=['GET'])
+@require_auth
+def get_counterparty_search():
+    """GET sender and receiver names similar to ?q= (typo-tolerant)"""
+    result = search_counterparties(request.args.get('q'), request.args.get('limit', 10),
+                                   request.args.get('min_similarity'))
+    return jsonify(result), result.get('error_code', 200)
+
+
+@app.route('/account/transactions', methods=['GET'])
+@require_auth
+@with_account
+def get_account_transactions(partition):
+    """GET the user's account transactions (same filters as /transactions)"""
+    if request.args.get('ids') is not None:
+        result = partition.get_by_ids(request.args['ids'])
+    else:
+        result = partition.get_all(request.args.get('type'), request.args.get('from'), request.args.get('to'),
+                                   request.args.get('sort'), request.args.get('limit'))
+    return jsonify(result), result.get('error_code', 200)
+
+
+@app.route('/account/transactions/<int:transaction_id>', methods=['GET'])
+@require_auth
+@with_account
+def get_account_transaction(partition, transaction_id):
+    """GET one transaction of the user's account"""
+    result = partition.get(transaction_id)
+    return jsonify(result), result.get('error_code', 200)
+
+
+@app.route('/account/transactions', methods=['POST'])
+@require_auth
+@with_account
+def create_account_transaction(partition):
+    """CREATE a transaction in the user's account"""
+    data = request.get_json()
+    if not isinstance(data, dict) or not data:
+        return jsonify({
+            'status': 'error',
+            'message': 'No JSON data provided'
+        }), 400
+    result, status_code, headers = run_idempotent(
+        request.headers.get('Idempotency-Key'), g.user, 'POST /account/transactions', data,
+        lambda: partition.create(data), 201)
+    return jsonify(result), status_code, headers
+
+
+@app.route('/account/transactions/<int:transaction_id>', methods=['PUT'])
+@require_auth
+@with_account
+def update_account_transaction(partition, transaction_id):
+    """UPDATE a transaction in the user's account"""
+    data = request.get_json()
+    if not isinstance(data, dict) or not data:
+        return jsonify({
+            'status': 'error',
+            'message': 'No JSON data provided'
+        }), 400
+    result = partition.update(transaction_id, data)
+    return jsonify(result), result.get('error_code', 200)
+
+
+@app.route('/account/transactions/<int:transaction_id>', methods=['DELETE'])
+@require_auth
+@with_account
+def delete_account_transaction(partition, transaction_id):
+    """DELETE a transaction from the user's account"""
+    result = partition.delete(transaction_id)
+    return jsonify(result), result.get('error_code', 200)
+
+
+@app.route('/account/transactions/stats', methods=['GET'])
+@require_auth
+@with_account
+def get_account_stats(partition):
+    """GET statistics for the user's account"""
+    return jsonify(partition.stats()), 200
+
+
+@app.route('/account/transactions/stats/counterparties', methods=['GET'])
+@require_auth
+@with_account
+def get_account_counterparties(partition):
+    """GET the top counterparties of the user's account"""
+    result = partition.top_counterparties(request.args.get('by', 'amount'), request.args.get('k', 10),
+                                          request.args.get('type'), request.args.get('from'),
+                                          request.args.get('to'))
+    return jsonify(result), result.get('error_code', 200)
+
+
+@app.route('/account/transactions/ledger', methods=['GET'])
+@require_auth
+@with_account
+def get_account_ledger(partition):
+    """GET net flow of the user's account between two dates"""
+    result = partition.ledger_summary(request.args.get('from'), request.args.get('to'),
+                                      request.args.get('limit', 100))
+    return jsonify(result), result.get('error_code', 200)
+
+
+@app.route('/admin/tenants', methods=['GET'])
+@require_auth
+@require_admin
+def tenants_report():
+    """Loaded accounts, memory estimate and LRU cache statistics"""
+    return jsonify(tenant_store.stats()), 200
+
+
+@app.route('/admin/profile', methods=['POST'])
+@require_auth
+@require_admin
+def profile_start():
+    """Profile all requests (mode=cprofile) or sample stacks (mode=sample) for N seconds"""
+    result = start_profiling(request.args.get('mode', 'cprofile'), request.args.get('seconds', 30))
+    return jsonify(result), result.get('error_code', 200)
+
+
+@app.route('/admin/profile', methods=['GET'])
+@require_auth
+@require_admin
+def profile_report():
+    """Aggregated hot-function reports"""
+    return jsonify(get_profile_report(request.args.get('sort', 'cumulative'))), 200
+
+
+@app.route('/admin/profile', methods=['DELETE'])
+@require_auth
+@require_admin
+def profile_reset():
+    """Clear profiling data"""
+    return jsonify(reset_profiles()), 200
+
+
 # Error handlers
 @app.errorhandler(404)
 def not_found(error):
@@ -154,5 +517,5 @@ if __name__ == '__main__':
     print("Username: admin")
     print("Password: password123")
     print("=" * 60)
-    
+
     app.run(host='0.0.0.0', port=8000, debug=True)
@@ -0,0 +1,240 @@
+"""
+Change Feed
+Every create, update and delete applied by routes becomes an event with a
+sequence number, kept in a bounded in-memory ring buffer. Clients follow
+the feed with Server-Sent Events (GET /transactions/changes with
+Accept: text/event-stream) or by long-polling the same URL, and resume
+from the last sequence number they saw. A client that falls further
+behind than the buffer holds gets 410 Gone and must reload the collection.
+"""
+
+import collections
+import json
+import threading
+import time
+
+import config
+import routes
+from rate_limit import InFlightLimiter
+
+
+class ChangeFeed:
+    """Ring buffer of write events with blocking waits for new ones"""
+
+    def __init__(self, size=None):
+        self._events = collections.deque(maxlen=size or config.CHANGE_FEED_SIZE)
+        self._condition = threading.Condition()
+        self.last_seq = 0
+
+    def publish(self, op, transaction):
+        """
+        Record a write (registered as a routes write listener)
+
+        Args:
+            op (str): 'create', 'update' or 'delete'
+            transaction (dict): The transaction after the write
+        """
+        with self._condition:
+            self.last_seq += 1
+            self._events.append({
+                "seq": self.last_seq,
+                "op": op,
+                "id": transaction.get("id"),
+                "time": time.time(),
+                # Not copied: the store never changes a transaction dict in
+                # place (an update stores a new one), so the event can share it
+                "data": transaction
+            })
+            self._condition.notify_all()
+
+    def since(self, seq):
+        """
+        Events with a sequence number greater than seq
+
+        Returns:
+            list: Events in order, or None if some of them were already
+            dropped from the buffer (or seq is from before a restart)
+        """
+        with self._condition:
+            return self._since(seq)
+
+    def covers(self, seq):
+        """True if every event after seq is still in the buffer"""
+        with self._condition:
+            return seq <= self.last_seq and self.last_seq - seq <= len(self._events)
+
+    def wait(self, seq, timeout):
+        """Like since(), but wait up to timeout seconds for a new event"""
+        with self._condition:
+            self._condition.wait_for(lambda: self.last_seq != seq, timeout)
+            return self._since(seq)
+
+    def _since(self, seq):
+        if seq > self.last_seq:
+            return None
+        missing = self.last_seq - seq
+        if missing > len(self._events):
+            return None
+        events = self._events
+        return [events[i] for i in range(len(events) - missing, len(events))]
+
+    def stats(self):
+        with self._condition:
+            return {
+                "last_seq": self.last_seq,
+                "oldest_seq": self._events[0]["seq"] if self._events else None,
+                "buffered": len(self._events),
+                "capacity": self._events.maxlen
+            }
+
+
+change_feed = ChangeFeed()
+routes.add_write_listener(change_feed.publish)
+
+# Event streams hold a thread for minutes, so they get their own cap
+stream_slots = InFlightLimiter(config.MAX_STREAMS)
+
+
+def _gone(seq):
+    return {
+        "status": "error",
+        "message": "Events after sequence {} are no longer available; reload "
+                   "GET /transactions and resume from last_seq".format(seq),
+        "last_seq": change_feed.last_seq,
+        "error_code": 410
+    }
+
+
+def parse_since(since=None, last_event_id=None):
+    """
+    Resume point from the since query parameter or the Last-Event-ID header
+
+    Returns:
+        tuple: (sequence number, None) or (None, error response);
+        with neither given, the feed's current sequence (only new events)
+    """
+    value = since if since not in (None, "") else last_event_id
+    if value in (None, ""):
+        return change_feed.last_seq, None
+    try:
+        seq = int(value)
+    except (TypeError, ValueError):
+        seq = -1
+    if seq < 0:
+        return None, {
+            "status": "error",
+            "message": "since must be a non-negative sequence number",
+            "error_code": 400
+        }
+    if not change_feed.covers(seq):
+        return None, _gone(seq)
+    return seq, None
+
+
+def poll_changes(since=None, wait=0, last_event_id=None, tick=None):
+    """
+    GET /transactions/changes (long-poll) - Events after a sequence number
+
+    Args:
+        since: Last sequence number the client saw
+        wait: Seconds to wait for an event when there is none yet
+            (at most CHANGE_POLL_MAX_WAIT)
+        last_event_id: Last-Event-ID header, used when since is missing
+        tick (callable): Called about once a second while waiting (pre-fork
+            workers use it to pick up writes from the other workers)
+
+    Returns:
+        dict: Response with the events and last_seq to pass as since next time
+    """
+    seq, error = parse_since(since, last_event_id)
+    if error:
+        return error
+    try:
+        wait = min(max(float(wait), 0.0), config.CHANGE_POLL_MAX_WAIT)
+    except (TypeError, ValueError):
+        return {
+            "status": "error",
+            "message": "wait must be a number of seconds",
+            "error_code": 400
+        }
+
+    deadline = time.monotonic() + wait
+    events = change_feed.since(seq)
+    while events == [] and time.monotonic() < deadline:
+        if tick is not None:
+            tick()
+        events = change_feed.wait(seq, min(1.0, deadline - time.monotonic()))
+    if events is None:
+        return _gone(seq)
+
+    return {
+        "status": "success",
+        "count": len(events),
+        "data": events,
+        "last_seq": events[-1]["seq"] if events else seq
+    }
+
+
+def format_event(event):
+    """One event in text/event-stream format"""
+    return "id: {}\nevent: {}\ndata: {}\n\n".format(
+        event["seq"], event["op"], json.dumps(event, default=str))
+
+
+def stream_changes(seq, tick=None):
+    """
+    Event stream body: events after seq as they happen
+
+    Sends a heartbeat comment when idle and ends after
+    CHANGE_STREAM_MAX_SECONDS; clients reconnect with Last-Event-ID.
+
+    Args:
+        seq (int): Resume point from parse_since()
+        tick (callable): As for poll_changes()
+
+    Yields:
+        str: text/event-stream chunks
+    """
+    yield "retry: {}\n\n".format(int(config.RETRY_AFTER_SECONDS * 1000))
+    deadline = time.monotonic() + config.CHANGE_STREAM_MAX_SECONDS
+    last_sent = time.monotonic()
+    while time.monotonic() < deadline:
+        if tick is not None:
+            tick()
+        events = change_feed.wait(seq, 1.0)
+        if events is None:
+            # Fell behind the buffer while streaming
+            yield "event: reset\ndata: {}\n\n".format(json.dumps(_gone(seq)))
+            return
+        if events:
+            yield "".join(format_event(event) for event in events)
+            seq = events[-1]["seq"]
+            last_sent = time.monotonic()
+        elif time.monotonic() - last_sent >= config.CHANGE_STREAM_HEARTBEAT:
+            yield ": keep-alive\n\n"
+            last_sent = time.monotonic()
+
+
+def wants_stream(accept, stream=None):
+    """True when the client asked for text/event-stream"""
+    return "text/event-stream" in (accept or "") or stream in ("1", "true", "yes")
+
+
+# Test the change feed
+if __name__ == "__main__":
+    print("Change Feed Test")
+    print("=" * 50)
+
+    feed = ChangeFeed(size=3)
+    for i in range(1, 6):
+        feed.publish("create", {"id": i})
+    print("Last seq: {}, buffered: {}".format(feed.last_seq, feed.stats()["buffered"]))
+    print("Since 3: {}".format([e["seq"] for e in feed.since(3)]))
+    print("Since 1 (dropped): {}".format(feed.since(1)))
+    print("Since 9 (unknown): {}".format(feed.since(9)))
+
+    threading.Timer(0.2, feed.publish, args=("delete", {"id": 1})).start()
+    start = time.perf_counter()
+    events = feed.wait(5, 5)
+    print("Waited {:.2f}s for: {}".format(time.perf_counter() - start, [(e["seq"], e["op"]) for e in events]))
+    print(format_event(events[0]), end="")
@@ -0,0 +1,155 @@
+"""
+API Configuration
+Runtime settings for the API servers, overridable with environment variables
+"""
+
+import os
+
+
+def _env_int(name, default):
+    """Read an integer setting from the environment"""
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def _env_float(name, default):
+    """Read a float setting from the environment"""
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+# Access logging
+# ACCESS_LOG_SINK is "stdout", "file" or "off"
+ACCESS_LOG_SINK = os.environ.get("ACCESS_LOG_SINK", "stdout")
+ACCESS_LOG_FILE = os.environ.get("ACCESS_LOG_FILE", "access.log")
+ACCESS_LOG_MAX_BYTES = _env_int("ACCESS_LOG_MAX_BYTES", 10 * 1024 * 1024)
+ACCESS_LOG_BACKUP_COUNT = _env_int("ACCESS_LOG_BACKUP_COUNT", 5)
+ACCESS_LOG_SAMPLE_RATE = _env_float("ACCESS_LOG_SAMPLE_RATE", 1.0)
+ACCESS_LOG_QUEUE_SIZE = _env_int("ACCESS_LOG_QUEUE_SIZE", 10000)
+ACCESS_LOG_BATCH_SIZE = _env_int("ACCESS_LOG_BATCH_SIZE", 256)
+ACCESS_LOG_FLUSH_INTERVAL = _env_float("ACCESS_LOG_FLUSH_INTERVAL", 0.5)
+
+# Users allowed to call /admin endpoints and to profile single requests
+ADMIN_USERS = set(os.environ.get("ADMIN_USERS", "admin").split(","))
+
+# Profiling
+# PROFILE_DIR: when set, each profiled request is also saved there as a .prof file
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "")
+PROFILE_TOP_N = _env_int("PROFILE_TOP_N", 25)
+PROFILE_SAMPLE_INTERVAL = _env_float("PROFILE_SAMPLE_INTERVAL", 0.005)
+PROFILE_MAX_SECONDS = _env_float("PROFILE_MAX_SECONDS", 300)
+
+# Data
+# Resolved from the project root so the working directory doesn't matter
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA_FILE = os.environ.get("DATA_FILE", os.path.join(PROJECT_ROOT, "data", "modified_sms_v2.xml"))
+# How the XML backup is read: auto, etree, lxml or scan (see dsa/xml_backends.py)
+XML_PARSER = os.environ.get("XML_PARSER", "auto")
+# Message templates the parser remembers extraction rules for (0 = off)
+MAX_TEMPLATES = _env_int("MAX_TEMPLATES", 4096)
+# Seconds clients are told to wait (Retry-After) while the store is loading
+RETRY_AFTER_SECONDS = _env_int("RETRY_AFTER_SECONDS", 2)
+
+# Multi-tenant store (/account/transactions, tenants.py)
+# One backup per account: <TENANT_DATA_DIR>/<account>.xml
+TENANT_DATA_DIR = os.environ.get("TENANT_DATA_DIR", os.path.join(PROJECT_ROOT, "data", "tenants"))
+# Loaded accounts are evicted (least recently used first) above this estimate
+TENANT_MEMORY_BUDGET = _env_int("TENANT_MEMORY_BUDGET_MB", 512) * 1024 * 1024
+# Users whose account isn't named after them, e.g. TENANT_USERS="student=acme,testuser=acme"
+TENANT_USERS = dict((part.strip() for part in item.split("=", 1))
+                    for item in os.environ.get("TENANT_USERS", "").split(",") if "=" in item)
+
+# Hot/cold tiering
+# Once the in-memory (hot) tier is over its budget, the oldest transactions
+# are compacted into compressed segment files here. Segments are rebuilt
+# from the XML backup on every start; a reload deletes the server's own
+# segments and those left by exited processes, not other servers'.
+COLD_DATA_DIR = os.environ.get("COLD_DATA_DIR", os.path.join(PROJECT_ROOT, "data", "cold"))
+# Estimated memory of the hot tier's transactions; 0 keeps everything in memory
+HOT_TIER_BUDGET = int(_env_float("HOT_TIER_MB", 256) * 1024 * 1024)
+# Memory for decompressed cold blocks (least recently used evicted first)
+BLOCK_CACHE_BUDGET = int(_env_float("BLOCK_CACHE_MB", 32) * 1024 * 1024)
+
+# HTTP server (server.py)
+KEEPALIVE_TIMEOUT = _env_float("KEEPALIVE_TIMEOUT", 15)
+KEEPALIVE_MAX_REQUESTS = _env_int("KEEPALIVE_MAX_REQUESTS", 1000)
+LISTEN_BACKLOG = _env_int("LISTEN_BACKLOG", 128)
+
+# Idempotency-Key on POST /transactions and /account/transactions (idempotency.py)
+# Responses are replayed for this long after the first request
+IDEMPOTENCY_TTL_SECONDS = _env_float("IDEMPOTENCY_TTL_SECONDS", 24 * 3600)
+IDEMPOTENCY_MAX_KEYS = _env_int("IDEMPOTENCY_MAX_KEYS", 10000)
+# When set, keys are also written here and survive restarts
+IDEMPOTENCY_FILE = os.environ.get("IDEMPOTENCY_FILE", "")
+
+# Most IDs accepted by one batch lookup (GET ?ids= or POST /transactions/lookup)
+MAX_BATCH_IDS = _env_int("MAX_BATCH_IDS", 1000)
+# Largest k accepted by top-k endpoints (GET /transactions/stats/counterparties)
+MAX_TOP_K = _env_int("MAX_TOP_K", 1000)
+
+# Approximate statistics (GET /transactions/stats?approx=1)
+# Sketches are rebuilt once deletes and updates reach this fraction of the store
+SKETCH_REBUILD_FRACTION = _env_float("SKETCH_REBUILD_FRACTION", 0.05)
+
+# Fuzzy counterparty search (GET /counterparties/search)
+# Lowest trigram similarity (0-1) returned unless ?min_similarity= says otherwise
+SEARCH_MIN_SIMILARITY = _env_float("SEARCH_MIN_SIMILARITY", 0.3)
+# Most names returned per search
+MAX_SEARCH_RESULTS = _env_int("MAX_SEARCH_RESULTS", 100)
+
+# Anomaly alerts on new transactions (GET /transactions/alerts)
+# Velocity: more than ANOMALY_BURST outgoing transactions to one counterparty
+# (ANOMALY_TYPE_BURST of one type) within ANOMALY_WINDOW_SECONDS
+ANOMALY_WINDOW_SECONDS = _env_float("ANOMALY_WINDOW_SECONDS", 600)
+ANOMALY_BURST = _env_int("ANOMALY_BURST", 5)
+ANOMALY_TYPE_BURST = _env_int("ANOMALY_TYPE_BURST", 20)
+# Amount: this many standard deviations above the counterparty's (or type's)
+# rolling mean, once ANOMALY_MIN_HISTORY amounts have been seen
+ANOMALY_THRESHOLD = _env_float("ANOMALY_THRESHOLD", 4.0)
+ANOMALY_MIN_HISTORY = _env_int("ANOMALY_MIN_HISTORY", 10)
+ANOMALY_HALF_LIFE = _env_int("ANOMALY_HALF_LIFE", 50)
+# Counterparties with no transactions for this long are forgotten
+ANOMALY_IDLE_SECONDS = _env_float("ANOMALY_IDLE_SECONDS", 30 * 86400)
+ANOMALY_MAX_TRACKED = _env_int("ANOMALY_MAX_TRACKED", 100000)
+# Alerts kept in memory
+MAX_ALERTS = _env_int("MAX_ALERTS", 10000)
+
+# Change feed (GET /transactions/changes)
+# Events kept in memory for clients resuming from an older sequence number
+CHANGE_FEED_SIZE = _env_int("CHANGE_FEED_SIZE", 10000)
+# Longest a long-poll request waits for new events
+CHANGE_POLL_MAX_WAIT = _env_float("CHANGE_POLL_MAX_WAIT", 30)
+# Comment line sent on idle event streams so proxies keep them open
+CHANGE_STREAM_HEARTBEAT = _env_float("CHANGE_STREAM_HEARTBEAT", 15)
+# Streams are closed after this long; clients reconnect with Last-Event-ID
+CHANGE_STREAM_MAX_SECONDS = _env_float("CHANGE_STREAM_MAX_SECONDS", 300)
+# Open event streams allowed at once (they don't count towards MAX_IN_FLIGHT)
+MAX_STREAMS = _env_int("MAX_STREAMS", 32)
+
+
+def _parse_quotas(text):
+    """Parse "user=rate:burst,user2=rate:burst" into {user: (rate, burst)}"""
+    quotas = {}
+    for item in text.split(","):
+        if "=" not in item:
+            continue
+        user, _, quota = item.partition("=")
+        rate, _, burst = quota.partition(":")
+        try:
+            quotas[user.strip()] = (float(rate), float(burst or rate))
+        except ValueError:
+            continue
+    return quotas
+
+
+# Rate limiting: token bucket per authenticated user, (requests per second, burst)
+RATE_LIMIT_ENABLED = os.environ.get("RATE_LIMIT_ENABLED", "1") not in ("0", "false", "no")
+RATE_LIMIT_DEFAULT = (_env_float("RATE_LIMIT_RATE", 50), _env_float("RATE_LIMIT_BURST", 100))
+# Per-user overrides, e.g. RATE_LIMITS="admin=200:400,student=10:20"
+RATE_LIMITS = _parse_quotas(os.environ.get("RATE_LIMITS", "admin=200:400"))
+# Requests handled at once before new ones get a fast 503
+MAX_IN_FLIGHT = _env_int("MAX_IN_FLIGHT", 64)
@@ -0,0 +1,359 @@
+"""
+Idempotency Keys
+A client that retries a POST after a dropped connection sends the same
+Idempotency-Key header; the retry gets the response of the first attempt
+instead of creating the transaction again.
+
+Keys are remembered per user and endpoint, for IDEMPOTENCY_TTL_SECONDS
+after the first response and at most IDEMPOTENCY_MAX_KEYS of them (oldest
+dropped first). With IDEMPOTENCY_FILE set, completed keys are appended to
+that file and reloaded at startup, so they survive restarts; pre-fork
+workers also read the keys the others append before checking their own.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import config
+
+MAX_KEY_LENGTH = 255
+
+# Stored in place of a response while the first request is being handled
+_PENDING = object()
+
+
+def _fingerprint(payload):
+    """Hash of a request body, so a key reused for different data is caught"""
+    canonical = json.dumps(payload, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def _error(message, code):
+    return {
+        "status": "error",
+        "message": message,
+        "error_code": code
+    }
+
+
+class IdempotencyCache:
+    """
+    Responses of completed requests, by (user, endpoint, key)
+
+    Thread-safe. Entries expire ttl seconds after they were stored; insertion
+    order is expiry order, so expired entries and the overflow are both
+    dropped from the front of an OrderedDict.
+    """
+
+    def __init__(self, max_keys=None, ttl=None, path=None, clock=time.time):
+        self.max_keys = config.IDEMPOTENCY_MAX_KEYS if max_keys is None else max_keys
+        self.ttl = config.IDEMPOTENCY_TTL_SECONDS if ttl is None else ttl
+        self.path = config.IDEMPOTENCY_FILE if path is None else path
+        self._clock = clock
+        # key -> [expires_at, fingerprint, status, body JSON or _PENDING]
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._file_lock = threading.Lock()
+        self._offset = 0
+        self.hits = 0
+        self.misses = 0
+        self.conflicts = 0
+        self.evictions = 0
+        if self.path:
+            self._load()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def begin(self, entry_key, fingerprint):
+        """
+        Reserve a key for a new request, or find its earlier response
+
+        Returns:
+            tuple: ("new", None) - handle the request, then complete() or
+            abandon(); ("replay", (status, body JSON)); ("busy", None) - the
+            first request is still running; ("mismatch", None) - the key
+            was used with a different body
+        """
+        if self.path:
+            self._catch_up()
+        with self._lock:
+            self._expire()
+            entry = self._entries.get(entry_key)
+            if entry is None:
+                self.misses += 1
+                self._entries[entry_key] = [self._clock() + self.ttl, fingerprint, None, _PENDING]
+                self._trim()
+                return "new", None
+            if entry[1] != fingerprint:
+                self.conflicts += 1
+                return "mismatch", None
+            if entry[3] is _PENDING:
+                self.conflicts += 1
+                return "busy", None
+            self.hits += 1
+            return "replay", (entry[2], entry[3])
+
+    def complete(self, entry_key, fingerprint, status, result):
+        """Store the response to a request begun with begin()"""
+        body = json.dumps(result, default=str)
+        expires_at = self._clock() + self.ttl
+        with self._lock:
+            self._entries.pop(entry_key, None)
+            self._entries[entry_key] = [expires_at, fingerprint, status, body]
+            self._trim()
+        if self.path:
+            self._append(entry_key, expires_at, fingerprint, status, body)
+
+    def abandon(self, entry_key):
+        """Release a key whose request failed, so a retry runs again"""
+        with self._lock:
+            entry = self._entries.get(entry_key)
+            if entry is not None and entry[3] is _PENDING:
+                del self._entries[entry_key]
+
+    def stats(self):
+        """Key count and lookup counters"""
+        with self._lock:
+            self._expire()
+            return {
+                "keys": len(self._entries),
+                "max_keys": self.max_keys,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "conflicts": self.conflicts,
+                "evictions": self.evictions,
+                "file": self.path or None
+            }
+
+    # Holding self._lock
+
+    def _expire(self):
+        now = self._clock()
+        entries = self._entries
+        while entries:
+            entry_key, entry = next(iter(entries.items()))
+            if entry[0] > now:
+                break
+            del entries[entry_key]
+
+    def _trim(self):
+        while len(self._entries) > self.max_keys:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    # Persistence
+
+    def _load(self):
+        """Read live keys back from the file and rewrite it without the expired ones"""
+        self._catch_up()
+        with self._lock:
+            self._expire()
+            live = [(entry_key, entry) for entry_key, entry in self._entries.items() if entry[3] is not _PENDING]
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        temporary = self.path + ".tmp"
+        with self._file_lock:
+            with open(temporary, "w") as f:
+                for entry_key, (expires_at, fingerprint, status, body) in live:
+                    f.write(self._line(entry_key, expires_at, fingerprint, status, body))
+            os.replace(temporary, self.path)
+            self._offset = os.path.getsize(self.path)
+
+    def _catch_up(self):
+        """Pick up keys appended since the last read (by this or another process)"""
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return
+        if size <= self._offset:
+            return
+        with self._file_lock:
+            with open(self.path, "rb") as f:
+                f.seek(self._offset)
+                data = f.read(size - self._offset)
+            # A writer may be mid-append; leave an incomplete last line for later
+            complete = data.rfind(b"\n") + 1
+            self._offset += complete
+        now = self._clock()
+        with self._lock:
+            for line in data[:complete].splitlines():
+                try:
+                    record = json.loads(line)
+                    entry_key = tuple(record["key"])
+                    entry = [record["expires_at"], record["fingerprint"], record["status"], record["body"]]
+                except (ValueError, KeyError, TypeError):
+                    continue
+                if entry[0] <= now:
+                    continue
+                current = self._entries.get(entry_key)
+                if current is not None and current[3] is _PENDING:
+                    # Being handled here; this process's own result wins
+                    continue
+                self._entries.pop(entry_key, None)
+                self._entries[entry_key] = entry
+            self._trim()
+
+    def _append(self, entry_key, expires_at, fingerprint, status, body):
+        line = self._line(entry_key, expires_at, fingerprint, status, body).encode()
+        with self._file_lock:
+            with open(self.path, "ab") as f:
+                f.write(line)
+                end = f.tell()
+            if end == self._offset + len(line):
+                # Nothing else was appended in between, so no need to reread it
+                self._offset = end
+
+    @staticmethod
+    def _line(entry_key, expires_at, fingerprint, status, body):
+        return json.dumps({"key": list(entry_key), "expires_at": expires_at, "fingerprint": fingerprint,
+                           "status": status, "body": body}) + "\n"
+
+
+idempotency_cache = IdempotencyCache()
+
+
+def run_idempotent(key, user, endpoint, payload, handler, success_status=200, cache=None):
+    """
+    Handle a write once per Idempotency-Key
+
+    Args:
+        key (str): The Idempotency-Key header (None: no key, just run handler)
+        user (str): Authenticated user; keys are per user
+        endpoint (str): e.g. "POST /transactions"; keys are per endpoint
+        payload: Decoded request body
+        handler (callable): Does the write and returns the result dict
+        success_status (int): Status when the result has no error_code
+        cache (IdempotencyCache): Defaults to the module's cache
+
+    Returns:
+        tuple: (result dict, status code, extra headers dict)
+
+    Raises:
+        Whatever handler raises; the key is released so a retry runs again
+    """
+    if key is None:
+        result = handler()
+        return result, result.get("error_code", success_status), {}
+    if not key or len(key) > MAX_KEY_LENGTH or not key.isprintable():
+        return _error("Idempotency-Key must be 1 to {} printable characters".format(MAX_KEY_LENGTH), 400), 400, {}
+
+    if cache is None:
+        cache = idempotency_cache
+    entry_key = (user, endpoint, key)
+    fingerprint = _fingerprint(payload)
+    state, stored = cache.begin(entry_key, fingerprint)
+    if state == "replay":
+        status, body = stored
+        return json.loads(body), status, {"Idempotent-Replayed": "true"}
+    if state == "busy":
+        return (_error("A request with this Idempotency-Key is still being processed", 409), 409,
+                {"Retry-After": "1"})
+    if state == "mismatch":
+        return _error("This Idempotency-Key was already used with a different request body", 422), 422, {}
+
+    try:
+        result = handler()
+    except BaseException:
+        cache.abandon(entry_key)
+        raise
+    status = result.get("error_code", success_status)
+    if status >= 500:
+        # Worth retrying: don't pin the failure to the key
+        cache.abandon(entry_key)
+    else:
+        cache.complete(entry_key, fingerprint, status, result)
+    return result, status, {}
+
+
+# Test retries, expiry, bounds and persistence
+if __name__ == "__main__":
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+
+    import routes
+
+    print("Idempotency Keys Test")
+    print("=" * 50)
+
+    routes.install_transactions([])
+    cache = IdempotencyCache(max_keys=100, ttl=60, path="")
+    payload = {"type": "payment", "amount": 5000, "recipient": "John Doe"}
+
+    def create(key, body=payload, **kwargs):
+        return run_idempotent(key, "admin", "POST /transactions", body,
+                              lambda: routes.create_transaction(body), 201, cache=kwargs.get("cache", cache))
+
+    first, status, headers = create("retry-1")
+    again, again_status, again_headers = create("retry-1")
+    assert status == again_status == 201 and again == first and again_headers == {"Idempotent-Replayed": "true"}
+    assert len(routes.transaction_versions) == 1
+    print(f"✓ Retry replayed transaction {again['data']['id']} (status {again_status}), no second row")
+
+    # Twenty clients retrying at once: one create
+    with ThreadPoolExecutor(20) as pool:
+        results = list(pool.map(lambda _: create("retry-2"), range(20)))
+    statuses = sorted(status for _, status, _ in results)
+    assert len(routes.transaction_versions) == 2 and set(statuses) <= {201, 409}, statuses
+    print(f"✓ 20 concurrent retries, one transaction ({statuses.count(201)} x 201, {statuses.count(409)} x 409 while in progress)")
+
+    # Same key, different body; other users and endpoints don't share keys
+    assert create("retry-1", {"type": "payment", "amount": 1})[1] == 422
+    other, other_status, _ = run_idempotent("retry-1", "student", "POST /transactions", payload,
+                                            lambda: routes.create_transaction(payload), 201, cache=cache)
+    assert other_status == 201 and other["data"]["id"] != first["data"]["id"]
+    assert create("x" * 256)[1] == 400 and create("")[1] == 400
+    print("✓ Reused key with another body: 422; keys are per user; bad keys: 400")
+
+    # Errors that are worth retrying aren't pinned to the key
+    failing = lambda: {"status": "error", "message": "down", "error_code": 503}
+    assert run_idempotent("retry-3", "admin", "POST /x", {}, failing, cache=cache)[1] == 503
+    assert cache.begin(("admin", "POST /x", "retry-3"), _fingerprint({}))[0] == "new"
+
+    # Expiry and the bound
+    now = [1000.0]
+    clocked = IdempotencyCache(max_keys=3, ttl=10, path="", clock=lambda: now[0])
+    calls = []
+    handler = lambda: calls.append(1) or {"status": "success"}
+    for key in ("a", "b", "c", "d"):
+        run_idempotent(key, "u", "POST /t", {}, handler, cache=clocked)
+    assert len(clocked) == 3 and clocked.evictions == 1
+    run_idempotent("d", "u", "POST /t", {}, handler, cache=clocked)
+    now[0] += 11
+    run_idempotent("d", "u", "POST /t", {}, handler, cache=clocked)
+    assert len(calls) == 5 and len(clocked) == 1
+    print(f"✓ Bounded to 3 keys, expired after the TTL: {clocked.stats()}")
+
+    # Persistence across a restart
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "idempotency.jsonl")
+    persisted = IdempotencyCache(max_keys=100, ttl=60, path=path)
+    saved, _, _ = create("retry-4", cache=persisted)
+    restarted = IdempotencyCache(max_keys=100, ttl=60, path=path)
+    replayed, status, headers = create("retry-4", cache=restarted)
+    assert replayed == saved and headers and len(restarted) == 1
+    # A second process appending is picked up
+    IdempotencyCache(max_keys=100, ttl=60, path=path).complete(("admin", "POST /transactions", "retry-5"),
+                                                              _fingerprint(payload), 201, saved)
+    assert create("retry-5", cache=restarted)[2] == {"Idempotent-Replayed": "true"}
+    print(f"✓ Keys reloaded from {os.path.basename(path)} after a restart")
+    os.remove(path)
+    os.rmdir(directory)
+
+    # A replay costs a dictionary lookup, whatever the store's size
+    n = 20000
+    begin = time.perf_counter()
+    for _ in range(n):
+        create("retry-1")
+    replay_time = (time.perf_counter() - begin) / n
+    begin = time.perf_counter()
+    for i in range(2000):
+        create(f"new-{i}")
+    create_time = (time.perf_counter() - begin) / 2000
+    print(f"\nReplay: {replay_time * 1e6:.1f} µs, first request: {create_time * 1e6:.1f} µs")
+    print(f"Counters: {cache.stats()}")
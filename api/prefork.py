@@ -0,0 +1,212 @@
+"""
+Pre-fork Serving Mode
+The parent process loads the transaction store, binds the listening socket
+and forks N workers that all accept() on the inherited socket. Each worker
+starts from the parent's parsed store, shared copy-on-write after fork
+(gc.freeze keeps the garbage collector from dirtying those pages).
+
+Writes are serialised through a shared append-only change log: a worker
+takes an exclusive lock on the log, replays entries it hasn't seen, applies
+its own write and appends it. Before every request each worker tails the
+log, so all workers converge on the same store and the same next ID.
+"""
+
+import fcntl
+import gc
+import json
+import os
+import signal
+import sys
+import tempfile
+import threading
+import time
+
+import routes
+
+
+class ChangeLog:
+    """Append-only JSON-lines log of writes shared by all workers"""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._offset = 0
+        self._pending = b""
+        # Worker threads share this process's file handle and offset
+        self._lock = threading.RLock()
+
+    @classmethod
+    def create(cls, directory=None):
+        """Create an empty log file (in the parent, before forking)"""
+        fd, path = tempfile.mkstemp(prefix="momo-changes-", suffix=".jsonl", dir=directory)
+        os.close(fd)
+        return cls(path)
+
+    def open(self):
+        """
+        Open the log in this process
+
+        Must be called after fork: flock locks belong to the open file
+        description, so workers sharing the parent's descriptor would not
+        exclude each other.
+        """
+        self._file = open(self.path, "a+b")
+        self._file.seek(self._offset)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def catch_up(self):
+        """Apply entries appended by other workers since the last call"""
+        size = os.fstat(self._file.fileno()).st_size
+        if size <= self._offset:
+            return 0
+        with self._lock:
+            return self._read_new(size)
+
+    def _read_new(self, size):
+        if size <= self._offset:
+            return 0
+        self._file.seek(self._offset)
+        data = self._pending + self._file.read(size - self._offset)
+        self._offset = size
+
+        # A writer may be mid-append; keep any incomplete last line for later
+        lines = data.split(b"\n")
+        self._pending = lines.pop()
+        for line in lines:
+            if line:
+                _apply(json.loads(line.decode()))
+        return len(lines)
+
+    def write(self, op, fn, *args):
+        """
+        Run a routes write function under the log lock and record it
+
+        Args:
+            op (str): 'create', 'update' or 'delete'
+            fn (callable): The routes function to call
+            *args: Arguments for fn
+
+        Returns:
+            dict: fn's result
+        """
+        with self._lock:
+            return self._locked_write(op, fn, *args)
+
+    def _locked_write(self, op, fn, *args):
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        try:
+            self._read_new(os.fstat(self._file.fileno()).st_size)
+            result = fn(*args)
+            if result.get("status") == "success":
+                entry = {"op": op}
+                if op == "create":
+                    entry["id"] = result["data"]["id"]
+                    entry["data"] = result["data"]
+                elif op == "update":
+                    entry["id"] = args[0]
+                    entry["data"] = args[1]
+                else:
+                    entry["id"] = args[0]
+                line = (json.dumps(entry, default=str) + "\n").encode()
+                self._file.seek(0, os.SEEK_END)
+                self._file.write(line)
+                self._file.flush()
+                self._offset = self._file.tell()
+            return result
+        finally:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+
+
+def _apply(entry):
+    """Replay one logged write against this worker's store"""
+    op = entry["op"]
+    if op == "create":
+        data = dict(entry["data"])
+        data.pop("id", None)
+        # Every worker replays creates in log order, so this is the ID it would assign anyway
+        routes.next_id = entry["id"]
+        routes.create_transaction(data)
+    elif op == "update":
+        routes.update_transaction(entry["id"], entry["data"])
+    elif op == "delete":
+        routes.delete_transaction(entry["id"])
+
+
+def _run_worker(httpd, change_log):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    change_log.open()
+    httpd.change_log = change_log
+    try:
+        httpd.serve_forever()
+    finally:
+        change_log.close()
+        os._exit(0)
+
+
+def serve_prefork(httpd, workers):
+    """
+    Fork `workers` processes that serve on httpd's listening socket
+
+    Dead workers are restarted; SIGINT/SIGTERM stops them all.
+
+    Args:
+        httpd: A bound and listening HTTPServer
+        workers (int): Number of worker processes
+    """
+    change_log = ChangeLog.create()
+    children = set()
+    stopping = []
+
+    # Objects created so far (the parsed store) are never collected, so the
+    # collector won't touch and copy their pages in every worker
+    gc.collect()
+    if hasattr(gc, "freeze"):
+        gc.freeze()
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            _run_worker(httpd, change_log)
+        children.add(pid)
+
+    def stop(signum, frame):
+        stopping.append(signum)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    for _ in range(workers):
+        spawn()
+    print("Started {} workers (pids {})".format(workers, ", ".join(str(p) for p in sorted(children))))
+
+    try:
+        while not stopping:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                time.sleep(0.2)
+                continue
+            children.discard(pid)
+            if not stopping:
+                print("Worker {} exited (status {}), restarting".format(pid, status))
+                spawn()
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in children:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        httpd.server_close()
+        os.remove(change_log.path)
@@ -0,0 +1,321 @@
+"""
+Live Profiling for the Request Path
+Two opt-in modes that need no restart:
+
+- cProfile: a single request (X-Profile: 1 header) or every request for N
+  seconds is run under cProfile and merged into one aggregated report
+- Sampling: a background thread samples the stacks of all request threads
+  every few milliseconds for N seconds; cheap enough to leave on under load
+
+Reports list the hottest functions and can also be saved to PROFILE_DIR.
+"""
+
+import collections
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import time
+
+import config
+
+PROFILE_HEADER = 'X-Profile'
+
+# Leaf frames of threads that are waiting, not working
+_IDLE_FRAMES = {
+    ("selectors.py", "select"),
+    ("socket.py", "accept"),
+    ("socket.py", "readinto"),
+    ("threading.py", "wait"),
+    ("threading.py", "_wait_for_tstate_lock"),
+    ("queue.py", "get"),
+}
+
+
+def _label(code):
+    return "{}:{}({})".format(os.path.basename(code.co_filename), code.co_firstlineno, code.co_name)
+
+
+class RequestProfiler:
+    """Aggregates cProfile runs of individual requests"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Only one cProfile may be active at a time (Python 3.12+ enforces this)
+        self._active = threading.Lock()
+        self._stats = None
+        self.requests = 0
+        self.skipped = 0
+        self.enabled_until = 0.0
+
+    def enable_for(self, seconds):
+        """Profile every request for the next `seconds` seconds"""
+        self.enabled_until = time.monotonic() + seconds
+
+    def window_active(self):
+        return time.monotonic() < self.enabled_until
+
+    def wants(self, headers, user=None):
+        """
+        Should this request be profiled?
+
+        Args:
+            headers: Request headers (dict-like object)
+            user (str): Authenticated user, if already known
+
+        Returns:
+            bool: True inside a global window, or when an admin sent X-Profile: 1
+        """
+        if self.window_active():
+            return True
+        if headers.get(PROFILE_HEADER, '').lower() not in ('1', 'true', 'yes'):
+            return False
+        if user is None:
+            from auth import authenticate
+            user = authenticate(headers).get('user')
+        return user in config.ADMIN_USERS
+
+    def start(self):
+        """
+        Start profiling the current request
+
+        Returns:
+            cProfile.Profile: The running profile, or None if another request is being profiled
+        """
+        if not self._active.acquire(blocking=False):
+            with self._lock:
+                self.skipped += 1
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler (e.g. an external one) already owns the hook
+            self._active.release()
+            return None
+        return profile
+
+    def stop(self, profile, label=None):
+        """Stop a profile returned by start() and merge it into the report"""
+        profile.disable()
+        self._active.release()
+        with self._lock:
+            if self._stats is None:
+                self._stats = pstats.Stats(profile)
+            else:
+                self._stats.add(profile)
+            self.requests += 1
+        if config.PROFILE_DIR and label:
+            os.makedirs(config.PROFILE_DIR, exist_ok=True)
+            name = "{}_{}.prof".format(time.strftime("%Y%m%d-%H%M%S"),
+                                       "".join(c if c.isalnum() else "_" for c in label)[:80])
+            profile.dump_stats(os.path.join(config.PROFILE_DIR, name))
+
+    def run(self, fn, *args, label=None):
+        """Call fn(*args) under the profiler"""
+        profile = self.start()
+        if profile is None:
+            return fn(*args)
+        try:
+            return fn(*args)
+        finally:
+            self.stop(profile, label)
+
+    def report(self, top_n=None, sort='cumulative'):
+        """
+        Hottest functions across all profiled requests
+
+        Args:
+            top_n (int): Number of functions to return
+            sort (str): 'cumulative' or 'tottime'
+
+        Returns:
+            dict: Request count and per-function call counts and times (ms)
+        """
+        top_n = top_n or config.PROFILE_TOP_N
+        with self._lock:
+            if self._stats is None:
+                return {"requests": 0, "skipped": self.skipped, "functions": []}
+            raw = dict(self._stats.stats)
+            requests = self.requests
+
+        index = 3 if sort == 'cumulative' else 2
+        rows = sorted(raw.items(), key=lambda item: item[1][index], reverse=True)[:top_n]
+        functions = []
+        for (filename, line, name), (cc, nc, tt, ct, _) in rows:
+            functions.append({
+                "function": "{}:{}({})".format(os.path.basename(filename), line, name),
+                "calls": nc,
+                "total_ms": round(tt * 1000, 3),
+                "cumulative_ms": round(ct * 1000, 3),
+                "cumulative_ms_per_request": round(ct * 1000 / requests, 3)
+            })
+        return {
+            "requests": requests,
+            "skipped": self.skipped,
+            "window_seconds_left": max(0.0, round(self.enabled_until - time.monotonic(), 1)),
+            "sort": sort,
+            "functions": functions
+        }
+
+    def save(self, path):
+        """Write the aggregated stats in pstats format (open with snakeviz, pstats, ...)"""
+        with self._lock:
+            if self._stats is not None:
+                self._stats.dump_stats(path)
+
+    def reset(self):
+        with self._lock:
+            self._stats = None
+            self.requests = 0
+            self.skipped = 0
+        self.enabled_until = 0.0
+
+
+class StackSampler:
+    """Samples every thread's Python stack at a fixed interval"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.samples = 0
+            self.self_counts = collections.Counter()
+            self.total_counts = collections.Counter()
+            self.stacks = collections.Counter()
+            self.started = None
+            self.finished = None
+
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, seconds, interval=None):
+        """
+        Sample for `seconds` seconds in a background thread
+
+        Returns:
+            bool: False if a sampling run is already in progress
+        """
+        if self.running():
+            return False
+        self.reset()
+        self._stop.clear()
+        interval = interval or config.PROFILE_SAMPLE_INTERVAL
+        self._thread = threading.Thread(target=self._run, args=(seconds, interval),
+                                        name="stack-sampler", daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self, seconds, interval):
+        me = threading.get_ident()
+        self.started = time.time()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline and not self._stop.is_set():
+            for ident, frame in sys._current_frames().items():
+                if ident != me:
+                    self._record(frame)
+            time.sleep(interval)
+        self.finished = time.time()
+
+    def _record(self, frame):
+        code = frame.f_code
+        if (os.path.basename(code.co_filename), code.co_name) in _IDLE_FRAMES:
+            return
+        stack = []
+        while frame is not None:
+            stack.append(_label(frame.f_code))
+            frame = frame.f_back
+        with self._lock:
+            self.samples += 1
+            self.self_counts[stack[0]] += 1
+            for label in set(stack):
+                self.total_counts[label] += 1
+            self.stacks[";".join(reversed(stack))] += 1
+
+    def report(self, top_n=None):
+        """
+        Hottest functions by share of busy samples
+
+        Returns:
+            dict: Sample count, top functions by self and inclusive samples,
+            and the most common stacks in collapsed (flamegraph) form
+        """
+        top_n = top_n or config.PROFILE_TOP_N
+        with self._lock:
+            samples = self.samples
+
+            def share(counter):
+                return [{"function": label, "samples": n, "percent": round(100.0 * n / samples, 2)}
+                        for label, n in counter.most_common(top_n)]
+
+            return {
+                "running": self.running(),
+                "samples": samples,
+                "self": share(self.self_counts) if samples else [],
+                "inclusive": share(self.total_counts) if samples else [],
+                "stacks": [{"stack": s, "samples": n} for s, n in self.stacks.most_common(top_n)]
+            }
+
+
+request_profiler = RequestProfiler()
+stack_sampler = StackSampler()
+
+
+def start_profiling(mode, seconds):
+    """
+    Admin action: profile everything for `seconds` seconds
+
+    Args:
+        mode (str): 'cprofile' or 'sample'
+        seconds (float): Length of the window (capped at PROFILE_MAX_SECONDS)
+
+    Returns:
+        dict: Response with status
+    """
+    try:
+        seconds = float(seconds)
+    except (TypeError, ValueError):
+        return {"status": "error", "message": "seconds must be a number", "error_code": 400}
+    if seconds <= 0:
+        return {"status": "error", "message": "seconds must be positive", "error_code": 400}
+    seconds = min(seconds, config.PROFILE_MAX_SECONDS)
+
+    if mode == 'cprofile':
+        request_profiler.enable_for(seconds)
+    elif mode == 'sample':
+        if not stack_sampler.start(seconds):
+            return {"status": "error", "message": "Sampling already running", "error_code": 409}
+    else:
+        return {"status": "error", "message": "mode must be 'cprofile' or 'sample'", "error_code": 400}
+
+    return {
+        "status": "success",
+        "message": "Profiling ({}) enabled for {} seconds".format(mode, seconds)
+    }
+
+
+def get_profile_report(sort='cumulative'):
+    """Admin action: current aggregated reports for both modes"""
+    return {
+        "status": "success",
+        "data": {
+            "cprofile": request_profiler.report(sort=sort),
+            "sampler": stack_sampler.report()
+        }
+    }
+
+
+def reset_profiles():
+    """Admin action: stop sampling and clear both reports"""
+    stack_sampler.stop()
+    request_profiler.reset()
+    stack_sampler.reset()
+    return {"status": "success", "message": "Profiling data cleared"}
@@ -0,0 +1,158 @@
+"""
+Rate Limiting and Overload Shedding
+Per-user token buckets (keyed by the Basic-auth user) and a global cap on
+requests in flight. Both answer immediately so an overloaded server rejects
+work quickly instead of queueing it.
+"""
+
+import threading
+import time
+
+import config
+
+
+class TokenBucket:
+    """
+    Classic token bucket: `rate` tokens per second refill up to `burst`
+
+    Each bucket has its own lock, so users never contend with each other.
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "updated", "_lock")
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_acquire(self, cost=1.0):
+        """
+        Take `cost` tokens if available
+
+        Returns:
+            tuple: (allowed, seconds until enough tokens, tokens left)
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= cost:
+                self.tokens -= cost
+                return True, 0.0, self.tokens
+            wait = (cost - self.tokens) / self.rate if self.rate > 0 else float("inf")
+            return False, wait, self.tokens
+
+
+class RateLimiter:
+    """Token bucket per user with quotas from config"""
+
+    def __init__(self, quotas=None, default=None):
+        self.quotas = quotas if quotas is not None else config.RATE_LIMITS
+        self.default = default or config.RATE_LIMIT_DEFAULT
+        self._buckets = {}
+
+    def check(self, user):
+        """
+        Count one request against `user`'s quota
+
+        Args:
+            user (str): Authenticated user
+
+        Returns:
+            tuple: (allowed, retry_after seconds, (rate, burst) quota)
+        """
+        bucket = self._buckets.get(user)
+        if bucket is None:
+            rate, burst = self.quotas.get(user, self.default)
+            # setdefault is atomic, so racing first requests share one bucket
+            bucket = self._buckets.setdefault(user, TokenBucket(rate, burst))
+        allowed, wait, _ = bucket.try_acquire()
+        return allowed, wait, (bucket.rate, bucket.burst)
+
+
+class InFlightLimiter:
+    """Caps concurrent requests; acquire() never blocks"""
+
+    def __init__(self, limit=None):
+        self.limit = limit or config.MAX_IN_FLIGHT
+        self._semaphore = threading.Semaphore(self.limit)
+        # += isn't atomic across threads, and rejections come in bursts
+        self._rejected_lock = threading.Lock()
+        self.rejected = 0
+
+    def acquire(self):
+        if self._semaphore.acquire(blocking=False):
+            return True
+        with self._rejected_lock:
+            self.rejected += 1
+        return False
+
+    def release(self):
+        self._semaphore.release()
+
+
+rate_limiter = RateLimiter()
+in_flight = InFlightLimiter()
+
+
+def rate_limited_response(retry_after, quota):
+    """
+    Build the 429 response for a user over quota
+
+    Returns:
+        tuple: (response dict, headers dict)
+    """
+    retry = max(1, int(retry_after + 0.999))
+    return {
+        "status": "error",
+        "message": "Rate limit exceeded ({:g} requests/s, burst {:g})".format(*quota),
+        "error_code": 429
+    }, {"Retry-After": str(retry)}
+
+
+def overloaded_response():
+    """
+    Build the 503 response used when too many requests are in flight
+
+    Returns:
+        tuple: (response dict, headers dict)
+    """
+    return {
+        "status": "error",
+        "message": "Server overloaded, try again shortly",
+        "error_code": 503
+    }, {"Retry-After": "1"}
+
+
+# Test the rate limiter
+if __name__ == "__main__":
+    print("Rate Limiter Test")
+    print("=" * 50)
+
+    limiter = RateLimiter(quotas={"student": (5, 10)}, default=(100, 100))
+    allowed = sum(1 for _ in range(50) if limiter.check("student")[0])
+    print("student (5/s, burst 10): {} of 50 immediate requests allowed".format(allowed))
+    allowed = sum(1 for _ in range(50) if limiter.check("admin")[0])
+    print("admin (default 100/s, burst 100): {} of 50 allowed".format(allowed))
+    print("student retry after: {:.2f}s".format(limiter.check("student")[1]))
+
+    cap = InFlightLimiter(2)
+    print("\nIn-flight cap 2: {}".format([cap.acquire() for _ in range(3)]))
+
+    # Rejections counted from many threads at once are all kept
+    cap = InFlightLimiter(1)
+    cap.acquire()
+    threads = [threading.Thread(target=lambda: [cap.acquire() for _ in range(20000)]) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert cap.rejected == 8 * 20000, cap.rejected
+    print("Rejections counted from 8 threads: {}".format(cap.rejected))
+
+    start = time.perf_counter()
+    for _ in range(100000):
+        limiter.check("admin")
+    print("100k checks: {:.3f}s".format(time.perf_counter() - start))
@@ -6,53 +6,551 @@ GET, POST, PUT, DELETE endpoints
 import json
 import sys
 import os
+import threading
+import time
+from contextlib import contextmanager, ExitStack
+from functools import wraps
+from itertools import islice
 
 # Add parent directory to import modules
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from dsa.parse_xml import parse_xml_file
-from dsa.dict_lookup import build_transaction_dict
+from dsa.parse_xml import parse_xml_file, TemplateCache
+from dsa.dict_lookup import build_transaction_dict, dict_lookup_many
+from dsa.ledger import Ledger, parse_time, ledger_time
+from dsa.counterparties import CounterpartyIndex, METRICS, transaction_type
+from dsa.export import iter_export, ExportError, FORMATS as EXPORT_FORMATS, CONTENT_TYPES
+from dsa.snapshot_list import SnapshotList
+from dsa.sketches import SketchIndex
+from dsa.trigram_index import TrigramIndex
+from dsa.anomalies import AnomalyDetector, RULES as ALERT_RULES
+from dsa.segments import ColdStore, TieredView, transaction_size
+from dsa.sorting import TimeIndex, parse_sort, top_k
+from schema import validate_transaction
+import config
 
 
 # Global storage for transactions
-transactions_list = []
+# The list is versioned: writers publish a new immutable version, readers
+# pin one (snapshot()) and scan it without holding the write lock.
+# Stored transaction dicts are never modified in place (updates store a
+# copy), so the dictionary hands out consistent records too.
+transaction_versions = SnapshotList(key='id')
 transactions_dict = {}
 next_id = 1
 
+# Older transactions, moved to compressed segment files once the in-memory
+# (hot) tier above goes over config.HOT_TIER_BUDGET. Every cold ID is below
+# every hot ID, so the whole store in ID order is the cold tier then the hot.
+cold_store = ColdStore(config.COLD_DATA_DIR, config.BLOCK_CACHE_BUDGET)
+# Estimated memory held by the hot tier's transactions
+_hot_bytes = 0
 
-def load_transactions():
+# Loading state reported by /readyz
+load_status = {
+    "state": "pending",
+    "loaded": 0,
+    "expected": None,
+    "file": None,
+    "started_at": None,
+    "finished_at": None,
+    "error": None,
+    "templates": None
+}
+_loader_thread = None
+_loader_lock = threading.Lock()
+
+# Serialises writers when requests are handled on several threads
+_write_lock = threading.RLock()
+
+
+def synchronized(f):
+    """Run a store write while holding the write lock"""
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        with _write_lock:
+            return f(*args, **kwargs)
+    return wrapper
+
+
+# Secondary indexes kept in step with the store
+# Each has rebuild(transactions), add(transaction) and remove(transaction);
+# they are called while the write lock is held
+_indexes = []
+
+# Callbacks run after every successful write, in write order: listener(op, transaction)
+_write_listeners = []
+
+# Stages that see each new transaction once, in arrival order (XML loads and
+# creates, not updates or deletes). Each has reset() and
+# observe(transaction) -> list of alerts; called while the write lock is held
+_ingest_stages = []
+
+# Running-balance ledger ordered by message time (GET /transactions/ledger)
+ledger = Ledger()
+
+
+def register_index(index):
+    """
+    Keep an index in step with every store write
+
+    Args:
+        index: Object with rebuild(transactions), add(transaction) and
+            remove(transaction) methods
+    """
+    with _write_lock:
+        _indexes.append(index)
+        index.rebuild(current_transactions())
+
+
+def register_ingest_stage(stage):
+    """
+    Run a stage on every transaction loaded from XML or created
+
+    Args:
+        stage: Object with reset() and observe(transaction) methods
+    """
+    with _write_lock:
+        _ingest_stages.append(stage)
+        stage.reset()
+        for transaction in current_transactions():
+            stage.observe(transaction)
+
+
+def current_transactions():
     """
-    Load transactions from XML file on server startup
+    The latest version of the transaction list
+
+    Returns:
+        list: Shared by every reader of this version - don't modify it.
+        Once there is a cold tier, each call reads a new list through the
+        block cache
+    """
+    if not cold_store.manifest.segments:
+        return transaction_versions.current().items()
+    with snapshot() as transactions:
+        return list(transactions)
+
+
+@contextmanager
+def snapshot():
+    """
+    Pin the latest version of the transaction list for a long read
+
+    Usage:
+        with snapshot() as transactions:
+            for t in transactions: ...
+
+    Yields:
+        An immutable Version (iterable, len()), or once there is a cold
+        tier a TieredView of the cold tier and the pinned hot version
+    """
+    while True:
+        # A compaction publishes the cold segment, then removes its
+        # transactions from the hot tier; the seq check makes sure both
+        # halves come from the same side of it
+        seq = cold_store.seq
+        manifest = cold_store.manifest
+        with transaction_versions.pin() as version:
+            if seq % 2 == 0 and cold_store.seq == seq:
+                yield TieredView(cold_store, manifest, version) if manifest.segments else version
+                return
+        time.sleep(0)
+
+
+def _lookup(transaction_id):
+    """A transaction by ID from the hot tier, else the cold tier (None if absent)"""
+    transaction = transactions_dict.get(transaction_id)
+    if transaction is None and cold_store.manifest.segments:
+        transaction = cold_store.get(transaction_id)
+    return transaction
+
+
+def _estimate_bytes(transactions):
+    """Memory held by a transaction list, estimated from a sample of it"""
+    if not transactions:
+        return 0
+    sample = transactions[::max(1, len(transactions) // 1024)]
+    return int(sum(map(transaction_size, sample)) / len(sample) * len(transactions))
+
+
+def _compact_if_needed():
     """
-    global transactions_list, transactions_dict, next_id
+    Move the oldest hot transactions to a new cold segment once the hot
+    tier is over its budget, down to three quarters of it
 
-    xml_file = "../data/modified_sms_v2.xml"
+    Called with the write lock held.
+    """
+    global _hot_bytes
+
+    budget = config.HOT_TIER_BUDGET
+    if not budget or _hot_bytes <= budget:
+        return
+    version = transaction_versions.current()
+    hot = version.items()
+    if not version.ordered:
+        hot = sorted(hot, key=lambda t: t['id'])
+    target = _hot_bytes - budget * 3 // 4
+    moved = 0
+    count = 0
+    while count < len(hot) and moved < target:
+        moved += transaction_size(hot[count])
+        count += 1
+    batch = hot[:count]
+
+    # Writing the file doesn't affect readers; publishing it does
+    segment = cold_store.write_segment(batch)
+    with cold_store.publishing():
+        cold_store.add_segment(segment)
+        for transaction in batch:
+            del transactions_dict[transaction['id']]
+        transaction_versions.reset(hot[count:])
+    _hot_bytes = max(0, _hot_bytes - moved)
+
+
+# Per-counterparty counts and amounts (GET /transactions/stats/counterparties)
+counterparty_index = CounterpartyIndex()
+
+def add_write_listener(listener):
+    """
+    Call listener(op, transaction) after every create, update and delete
+
+    Listeners run while the write lock is held, so they see writes in the
+    order they were applied and must return quickly.
+
+    Args:
+        listener (callable): Receives 'create', 'update' or 'delete' and the
+            transaction (its new state; the removed one for deletes)
+    """
+    with _write_lock:
+        _write_listeners.append(listener)
+
+
+def _notify(op, transaction):
+    for listener in _write_listeners:
+        listener(op, transaction)
+
+
+# Streaming sketches for approximate statistics (GET /transactions/stats?approx=1)
+sketch_index = SketchIndex(rebuild_fraction=config.SKETCH_REBUILD_FRACTION)
+# Trigrams of sender/receiver names (GET /counterparties/search)
+counterparty_search = TrigramIndex()
+
+register_index(ledger)
+register_index(counterparty_index)
+register_index(sketch_index)
+register_index(counterparty_search)
+
+# Transaction IDs in message-time order (GET /transactions?sort=-timestamp&limit=)
+time_index = TimeIndex()
+register_index(time_index)
+
+# Velocity and unusual-amount alerts (GET /transactions/alerts)
+anomaly_detector = AnomalyDetector(
+    window=config.ANOMALY_WINDOW_SECONDS, burst=config.ANOMALY_BURST, type_burst=config.ANOMALY_TYPE_BURST,
+    threshold=config.ANOMALY_THRESHOLD, min_history=config.ANOMALY_MIN_HISTORY,
+    half_life=config.ANOMALY_HALF_LIFE, idle=config.ANOMALY_IDLE_SECONDS,
+    max_tracked=config.ANOMALY_MAX_TRACKED, max_alerts=config.MAX_ALERTS)
+
+register_ingest_stage(anomaly_detector)
+
+
+def install_transactions(transactions):
+    """
+    Replace the store with a parsed transaction list and mark it ready
+
+    Args:
+        transactions (list): Transaction dictionaries
+    """
+    global transactions_dict, next_id, _hot_bytes
+
+    with _write_lock:
+        with cold_store.publishing():
+            cold_store.reset()
+            transactions_dict = build_transaction_dict(transactions)
+            next_id = max(t['id'] for t in transactions) + 1 if transactions else 1
+            transaction_versions.reset(transactions)
+        _hot_bytes = _estimate_bytes(transactions)
+        for index in _indexes:
+            index.rebuild(transactions)
+        for stage in _ingest_stages:
+            stage.reset()
+            for transaction in transactions:
+                stage.observe(transaction)
+        # Indexes keep derived values only, so compacted transactions leave memory
+        _compact_if_needed()
+    load_status["loaded"] = len(transactions)
+    load_status["state"] = "ready"
+    load_status["finished_at"] = time.time()
+
+
+def load_transactions(xml_file=None):
+    """
+    Load transactions from the XML backup (blocks until done)
+
+    Args:
+        xml_file (str): Backup to load; defaults to config.DATA_FILE, which
+            is resolved from the project root rather than the working directory
+    """
+    xml_file = xml_file or config.DATA_FILE
+
+    load_status.update(state="loading", loaded=0, expected=None, file=xml_file,
+                       started_at=time.time(), finished_at=None, error=None, templates=None)
+
+    def progress(count, expected):
+        load_status["loaded"] = count
+        load_status["expected"] = expected
 
     if os.path.exists(xml_file):
         print("Loading transactions from XML...")
-        transactions_list = parse_xml_file(xml_file)
-        transactions_dict = build_transaction_dict(transactions_list)
+        templates = TemplateCache(config.MAX_TEMPLATES)
+        try:
+            transactions = parse_xml_file(xml_file, progress=progress, backend=config.XML_PARSER,
+                                          templates=templates)
+        except Exception as e:
+            load_status.update(state="failed", error=str(e), finished_at=time.time())
+            print(f"✗ Failed to load {xml_file}: {e}")
+            return
+        load_status["templates"] = templates.stats()
+        install_transactions(transactions)
 
-        if transactions_list:
-            next_id = max(t['id'] for t in transactions_list) + 1
-            print(f"✓ Loaded {len(transactions_list)} transactions")
+        count = len(transaction_versions) + len(cold_store)
+        if count:
+            print(f"✓ Loaded {count} transactions")
+            if templates.hits:
+                print(f"  {len(templates)} message templates, {templates.stats()['hit_rate']:.0%} of messages matched one")
         else:
             print("⚠ No transactions loaded")
     else:
         print(f"⚠ Warning: {xml_file} not found. Starting with empty database.")
+        install_transactions([])
 
 
-def get_all_transactions():
+def start_loading(xml_file=None):
+    """
+    Load transactions in a background thread so the server can start
+    answering /healthz and /readyz immediately
+
+    Returns:
+        threading.Thread: The loader thread (the running one if already started)
+    """
+    global _loader_thread
+
+    with _loader_lock:
+        if _loader_thread is None or (not _loader_thread.is_alive() and load_status["state"] == "failed"):
+            _loader_thread = threading.Thread(target=load_transactions, args=(xml_file,),
+                                              name="transaction-loader", daemon=True)
+            _loader_thread.start()
+        return _loader_thread
+
+
+def is_ready():
+    """True once the store has been loaded"""
+    return load_status["state"] == "ready"
+
+
+def get_health():
+    """
+    GET /healthz - The process is up
+
+    Returns:
+        dict: Always a success response
+    """
+    return {
+        "status": "success",
+        "message": "ok"
+    }
+
+
+def get_readiness():
+    """
+    GET /readyz - Whether the store is loaded, with load progress
+
+    Returns:
+        dict: Response with error_code 503 until the store is ready
+    """
+    result = {
+        "status": "success" if is_ready() else "error",
+        "ready": is_ready(),
+        "load": dict(load_status),
+        "storage": {
+            "hot_transactions": len(transaction_versions),
+            "hot_bytes": _hot_bytes,
+            "hot_budget_bytes": config.HOT_TIER_BUDGET,
+            "cold": cold_store.stats()
+        }
+    }
+    if not is_ready():
+        result["message"] = "Transactions are still loading"
+        result["error_code"] = 503
+    return result
+
+
+def filter_transactions(transactions, t_type=None, start=None, end=None):
+    """
+    Transactions matching the list filters
+
+    Args:
+        transactions (iterable): Transactions to filter
+        t_type (str): Only this type (case-insensitive)
+        start (int): Only from this time on, epoch milliseconds
+        end (int): Only up to this time (inclusive), epoch milliseconds
+
+    Yields:
+        dict: Matching transactions, in their original order
+    """
+    t_type = t_type.lower() if t_type else None
+    if t_type is None and start is None and end is None:
+        yield from transactions
+        return
+    if hasattr(transactions, 'scan'):
+        # Tiered view: skip cold blocks that can't match
+        transactions = transactions.scan(t_type, start, end)
+    for transaction in transactions:
+        if t_type is not None and transaction_type(transaction) != t_type:
+            continue
+        if start is not None or end is not None:
+            time_ms = ledger_time(transaction)
+            if time_ms is None or (start is not None and time_ms < start) \
+                    or (end is not None and time_ms > end):
+                continue
+        yield transaction
+
+
+def get_all_transactions(t_type=None, start=None, end=None, sort=None, limit=None):
     """
     GET /transactions - Return all transactions
 
+    Args:
+        t_type (str): Optional type filter
+        start: Optional window start (epoch milliseconds or ISO date), inclusive
+        end: Optional window end (epoch milliseconds or ISO date), inclusive
+        sort (str): Optional order: amount, fee or timestamp, descending
+            with a leading - or :desc (e.g. "-amount", "timestamp:desc")
+        limit: Optional number of transactions to return
+
+    Returns:
+        dict: Response with count and data; without sort or limit, with
+        content_type and chunks instead (the JSON body, streamed, with
+        "count" after "data")
+    """
+    order = None
+    if sort not in (None, ""):
+        order, message = parse_sort(sort)
+        if message:
+            return {
+                "status": "error",
+                "message": message,
+                "error_code": 400
+            }
+    limit, error = _parse_limit(limit)
+    if error:
+        return error
+
+    if order is not None or limit is not None:
+        bounds, error = _parse_window(start, end)
+        if error:
+            return error
+        if order is not None and order[0] == "timestamp" and limit is not None:
+            # Read the first rows off the time index
+            matching = _by_time(t_type, *bounds, order[1], limit)
+        else:
+            with snapshot() as transactions:
+                rows = filter_transactions(transactions, t_type, *bounds)
+                if order is None:
+                    matching = list(islice(rows, limit))
+                else:
+                    # Heap selection: O(n log k), no full sort for k rows
+                    matching = top_k(rows, order[0], order[1], limit)
+        return {
+            "status": "success",
+            "count": len(matching),
+            "data": matching
+        }
+
+    bounds, error = _parse_window(start, end)
+    if error:
+        return error
+    # Always streamed, so the body has the same shape whether or not part of
+    # the store is in the cold tier (which is never read back into one list)
+    return {
+        "status": "success",
+        "content_type": "application/json",
+        "chunks": _iter_listing(t_type, *bounds)
+    }
+
+
+# Transactions encoded per chunk of a streamed listing
+LIST_BATCH_SIZE = 1000
+
+
+def _iter_listing(t_type, start, end):
+    """
+    A GET /transactions response body, encoded in batches while it is sent
+    from a pinned snapshot; "count" comes last, once the rows are counted
+
+    Yields:
+        bytes: JSON
+    """
+    encode = json.JSONEncoder().encode
+    with snapshot() as transactions:
+        rows = filter_transactions(transactions, t_type, start, end)
+        yield b'{"status": "success", "data": ['
+        count = 0
+        while True:
+            batch = list(islice(rows, LIST_BATCH_SIZE))
+            if not batch:
+                break
+            yield ((", " if count else "") + ", ".join(map(encode, batch))).encode()
+            count += len(batch)
+        yield '], "count": {}}}'.format(count).encode()
+
+
+def export_transactions(export_format="csv", t_type=None, start=None, end=None):
+    """
+    GET /transactions/export - Stream transactions as CSV, NDJSON or Parquet
+
+    Rows are encoded in batches while the response is sent, from a pinned
+    version of the store, so writes carry on while the export runs.
+
+    Args:
+        export_format (str): 'csv', 'ndjson' or 'parquet' (needs pyarrow)
+        t_type, start, end: The same filters as GET /transactions
+
     Returns:
-        dict: Response with all transactions
+        dict: Response with content_type, filename and chunks (a generator
+        of bytes), or an error
     """
+    export_format = (export_format or "csv").lower()
+    if export_format not in EXPORT_FORMATS:
+        return {
+            "status": "error",
+            "message": "format must be one of: {}".format(", ".join(EXPORT_FORMATS)),
+            "error_code": 400
+        }
+    bounds, error = _parse_window(start, end)
+    if error:
+        return error
+
+    def rows():
+        # Pinned from the first chunk until the generator is finished or closed
+        with snapshot() as transactions:
+            yield from filter_transactions(transactions, t_type, *bounds)
+
+    try:
+        chunks = iter_export(rows(), export_format)
+    except ExportError as e:
+        return {
+            "status": "error",
+            "message": str(e),
+            "error_code": 501
+        }
+
     return {
         "status": "success",
-        "count": len(transactions_list),
-        "data": transactions_list
+        "content_type": CONTENT_TYPES[export_format],
+        "filename": "transactions.{}".format(export_format),
+        "chunks": chunks
     }
 
 
@@ -66,8 +564,8 @@ def get_transaction_by_id(transaction_id):
     Returns:
         dict: Response with transaction or error
     """
-    # Use dictionary lookup for O(1) efficiency
-    transaction = transactions_dict.get(transaction_id)
+    # Use dictionary lookup for O(1) efficiency, then the cold tier's block index
+    transaction = _lookup(transaction_id)
 
     if transaction:
         return {
@@ -82,6 +580,73 @@ def get_transaction_by_id(transaction_id):
         }
 
 
+def parse_id_list(ids):
+    """
+    Parse the ids of a batch lookup
+
+    Args:
+        ids: Comma-separated string ("1,5,9") or a list of integers
+
+    Returns:
+        tuple: (list of int IDs, error message or None)
+    """
+    if isinstance(ids, str):
+        ids = [part for part in ids.split(',') if part.strip()]
+    if not isinstance(ids, list):
+        return None, "ids must be a list of integers"
+
+    parsed = []
+    for value in ids:
+        if isinstance(value, bool):
+            return None, f"Invalid transaction ID: {value}"
+        try:
+            parsed.append(int(value))
+        except (TypeError, ValueError):
+            return None, f"Invalid transaction ID: {value}"
+
+    if not parsed:
+        return None, "ids must contain at least one transaction ID"
+    if len(parsed) > config.MAX_BATCH_IDS:
+        return None, f"At most {config.MAX_BATCH_IDS} IDs per request"
+    return parsed, None
+
+
+def get_transactions_by_ids(ids):
+    """
+    GET /transactions?ids=1,5,9 and POST /transactions/lookup - Batch lookup
+
+    Args:
+        ids: Comma-separated string or list of transaction IDs
+
+    Returns:
+        dict: Response with found transactions (request order) and missing IDs
+    """
+    parsed, error = parse_id_list(ids)
+    if error:
+        return {
+            "status": "error",
+            "message": error,
+            "error_code": 400
+        }
+
+    # One dictionary lookup per ID, same O(1) path as GET /transactions/{id}
+    found, missing = dict_lookup_many(transactions_dict, parsed)
+    if missing and cold_store.manifest.segments:
+        # Some may be in the cold tier: look again, keeping request order
+        cold = {i: cold_store.get(i) for i in missing}
+        known = {t['id']: t for t in found}
+        known.update((i, t) for i, t in cold.items() if t is not None)
+        found, missing = dict_lookup_many(known, parsed)
+
+    return {
+        "status": "success",
+        "count": len(found),
+        "data": found,
+        "missing": missing
+    }
+
+
+@synchronized
 def create_transaction(new_transaction):
     """
     POST /transactions - Create a new transaction
@@ -92,42 +657,44 @@ def create_transaction(new_transaction):
     Returns:
         dict: Response with created transaction
     """
-    global next_id
+    global next_id, _hot_bytes
 
-    # Validate required fields
-    required_fields = ['transaction_type', 'amount']
-    for field in required_fields:
-        if field not in new_transaction:
-            return {
-                "status": "error",
-                "message": f"Missing required field: {field}",
-                "error_code": 400
-            }
+    # Validate against the schema: canonical field names, defaults filled in
+    new_transaction, error = validate_transaction(new_transaction)
+    if error:
+        return {
+            "status": "error",
+            "message": error,
+            "error_code": 400
+        }
 
     # Assign new ID
     new_transaction['id'] = next_id
     next_id += 1
 
-    # Set defaults for optional fields
-    new_transaction.setdefault('balance', 0)
-    new_transaction.setdefault('fee', 0)
-    new_transaction.setdefault('recipient', None)
-    new_transaction.setdefault('sender', None)
-    new_transaction.setdefault('phone_number', None)
-    new_transaction.setdefault('transaction_id', None)
-    new_transaction.setdefault('date', None)
-
     # Add to storage
-    transactions_list.append(new_transaction)
+    transaction_versions.append(new_transaction)
     transactions_dict[new_transaction['id']] = new_transaction
+    _hot_bytes += transaction_size(new_transaction)
+    for index in _indexes:
+        index.add(new_transaction)
+    alerts = []
+    for stage in _ingest_stages:
+        alerts.extend(stage.observe(new_transaction))
+    _notify('create', new_transaction)
+    _compact_if_needed()
 
-    return {
+    result = {
         "status": "success",
         "message": "Transaction created successfully",
         "data": new_transaction
     }
+    if alerts:
+        result["alerts"] = alerts
+    return result
 
 
+@synchronized
 def update_transaction(transaction_id, updated_data):
     """
     PUT /transactions/{id} - Update an existing transaction
@@ -139,29 +706,44 @@ def update_transaction(transaction_id, updated_data):
     Returns:
         dict: Response with updated transaction or error
     """
+    global _hot_bytes
+
+    updated_data, error = validate_transaction(updated_data, partial=True)
+    if error:
+        return {
+            "status": "error",
+            "message": error,
+            "error_code": 400
+        }
+
     # Check if transaction exists
-    transaction = transactions_dict.get(transaction_id)
+    previous = _lookup(transaction_id)
 
-    if not transaction:
+    if not previous:
         return {
             "status": "error",
             "message": f"Transaction with ID {transaction_id} not found",
             "error_code": 404
         }
 
-    # Update fields (don't allow ID change)
-    for key, value in updated_data.items():
-        if key != 'id':  # Prevent ID modification
-            transaction[key] = value
+    # Copy on write: readers holding the old version keep the old record
+    transaction = dict(previous)
 
-    # Update in both storage structures
-    transactions_dict[transaction_id] = transaction
+    # Update fields (the schema drops any ID)
+    transaction.update(updated_data)
 
-    # Update in list (find and replace)
-    for i, trans in enumerate(transactions_list):
-        if trans['id'] == transaction_id:
-            transactions_list[i] = transaction
-            break
+    # Update in both storage structures (cold ones are patched)
+    if transaction_id in transactions_dict:
+        transactions_dict[transaction_id] = transaction
+        transaction_versions.replace(transaction_id, transaction)
+        _hot_bytes += transaction_size(transaction) - transaction_size(previous)
+    else:
+        cold_store.patch(transaction_id, transaction)
+
+    for index in _indexes:
+        index.remove(previous)
+        index.add(transaction)
+    _notify('update', transaction)
 
     return {
         "status": "success",
@@ -170,6 +752,7 @@ def update_transaction(transaction_id, updated_data):
     }
 
 
+@synchronized
 def delete_transaction(transaction_id):
     """
     DELETE /transactions/{id} - Delete a transaction
@@ -180,8 +763,10 @@ def delete_transaction(transaction_id):
     Returns:
         dict: Response confirming deletion or error
     """
+    global _hot_bytes
+
     # Check if transaction exists
-    transaction = transactions_dict.get(transaction_id)
+    transaction = _lookup(transaction_id)
 
     if not transaction:
         return {
@@ -190,11 +775,19 @@ def delete_transaction(transaction_id):
             "error_code": 404
         }
 
-    # Remove from dictionary
-    del transactions_dict[transaction_id]
+    if transaction_id in transactions_dict:
+        # Remove from dictionary
+        del transactions_dict[transaction_id]
+
+        # Remove from list
+        transaction_versions.remove(transaction_id)
+        _hot_bytes -= transaction_size(transaction)
+    else:
+        cold_store.patch(transaction_id, None)
 
-    # Remove from list
-    transactions_list[:] = [t for t in transactions_list if t['id'] != transaction_id]
+    for index in _indexes:
+        index.remove(transaction)
+    _notify('delete', transaction)
 
     return {
         "status": "success",
@@ -203,15 +796,26 @@ def delete_transaction(transaction_id):
     }
 
 
-def get_transaction_stats():
+def get_transaction_stats(approx=False):
     """
     GET /transactions/stats - Get statistics about transactions
     Bonus endpoint for analysis
 
+    Args:
+        approx (bool): Answer from the streaming sketches instead of a full
+            scan (adds distinct counts, quantiles and heavy hitters)
+
     Returns:
         dict: Transaction statistics
     """
-    if not transactions_list:
+    if approx:
+        return get_approximate_stats()
+    with snapshot() as transactions:
+        return _transaction_stats(transactions)
+
+
+def _transaction_stats(transactions):
+    if not len(transactions):
         return {
             "status": "success",
             "message": "No transactions available",
@@ -220,15 +824,15 @@ def get_transaction_stats():
 
     # Calculate statistics
     stats = {
-        "total_transactions": len(transactions_list),
+        "total_transactions": len(transactions),
         "transaction_types": {},
         "total_amount": 0,
         "total_fees": 0
     }
 
-    for trans in transactions_list:
+    for trans in transactions:
         # Count by type
-        t_type = trans.get("type", trans.get("transaction_type", "UNKNOWN"))
+        t_type = trans.get("type", "UNKNOWN")
         stats["transaction_types"][t_type] = stats["transaction_types"].get(t_type, 0) + 1
 
         # Sum amounts (handle None values)
@@ -246,22 +850,404 @@ def get_transaction_stats():
         "data": stats
     }
 
-# Initialize transactions on module load
-load_transactions()
+
+class _IndexJournal:
+    """Index calls made while another index is rebuilt off the write lock, to replay on it"""
+
+    def __init__(self):
+        self.calls = []
+
+    def rebuild(self, transactions):
+        self.calls = [("rebuild", transactions)]
+
+    def add(self, transaction):
+        self.calls.append(("add", transaction))
+
+    def remove(self, transaction):
+        self.calls.append(("remove", transaction))
+
+    def replay(self, index):
+        for method, transaction in self.calls:
+            getattr(index, method)(transaction)
+
+
+# Held while the sketches are rebuilt; other readers use the stale ones meanwhile
+_sketch_rebuild_lock = threading.Lock()
+
+
+def _rebuild_sketches():
+    """
+    Rebuild the sketches from a pinned snapshot without holding up writes
+
+    The snapshot is streamed (through the block cache once there is a cold
+    tier) into a new SketchIndex; writes made meanwhile are journaled and
+    replayed on it before it replaces the old one, under the write lock.
+    """
+    global sketch_index
+
+    if not _sketch_rebuild_lock.acquire(blocking=False):
+        return
+    try:
+        journal = _IndexJournal()
+        fresh = SketchIndex(rebuild_fraction=config.SKETCH_REBUILD_FRACTION)
+        built = False
+        try:
+            with ExitStack() as pinned:
+                with _write_lock:
+                    _indexes.append(journal)
+                    transactions = pinned.enter_context(snapshot())
+                fresh.rebuild(transactions)
+                built = True
+        finally:
+            with _write_lock:
+                _indexes.remove(journal)
+                if built:
+                    journal.replay(fresh)
+                    _indexes[_indexes.index(sketch_index)] = fresh
+                    sketch_index = fresh
+    finally:
+        _sketch_rebuild_lock.release()
+
+
+def get_approximate_stats(k=10):
+    """
+    GET /transactions/stats?approx=1 - Statistics from the streaming sketches
+
+    Distinct senders/receivers (HyperLogLog), amount and fee quantiles (KLL)
+    and the busiest counterparties (Count-Min), each with its error bound.
+    Cost doesn't grow with the number of transactions, except for the
+    occasional rebuild after many deletes and updates.
+
+    Returns:
+        dict: Approximate statistics
+    """
+    if sketch_index.stale():
+        _rebuild_sketches()
+    with _write_lock:
+        summary = sketch_index.summary(k)
+
+    return {
+        "status": "success",
+        "approximate": True,
+        "data": summary
+    }
+
+
+def _parse_limit(limit):
+    """
+    Parse an optional limit query value
+
+    Returns:
+        tuple: (int or None, error response or None)
+    """
+    if limit in (None, ""):
+        return None, None
+    try:
+        value = int(limit)
+    except (TypeError, ValueError):
+        value = 0
+    if isinstance(limit, bool) or value < 1:
+        return None, {
+            "status": "error",
+            "message": "limit must be a positive integer",
+            "error_code": 400
+        }
+    return value, None
+
+
+# Time index entries taken per hold of the write lock by _by_time
+TIME_BATCH_SIZE = 256
+
+
+def _by_time(t_type, start, end, descending, limit):
+    """
+    The first limit transactions in time order, from the time index
+
+    Walks the index a batch at a time under the write lock, taking hot
+    transactions from the dictionary. Cold ones are read after the lock is
+    released, from the cold tier's manifest of the same moment, so writers
+    never wait for segment blocks to be read (a type filter can make the
+    walk long).
+    """
+    t_type = t_type.lower() if t_type else None
+    matching = []
+    after = None
+    while len(matching) < limit:
+        with _write_lock:
+            manifest = cold_store.manifest
+            keys = list(islice(time_index.keys(start, end, descending, after), TIME_BATCH_SIZE))
+            batch = [(key[1], transactions_dict.get(key[1])) for key in keys]
+        if keys:
+            after = keys[-1]
+        for transaction_id, transaction in batch:
+            if transaction is None and manifest.segments:
+                transaction = cold_store.get(transaction_id, manifest)
+            if transaction is None or (t_type is not None and transaction_type(transaction) != t_type):
+                continue
+            matching.append(transaction)
+            if len(matching) >= limit:
+                break
+        if len(batch) < TIME_BATCH_SIZE:
+            break
+    return matching
+
+
+def _parse_window(start, end):
+    """
+    Parse optional from/to query values
+
+    Returns:
+        tuple: ((start_ms, end_ms), None) or (None, error response)
+    """
+    bounds = []
+    for name, value in (("from", start), ("to", end)):
+        if value is None or value == "":
+            bounds.append(None)
+            continue
+        parsed = parse_time(value)
+        if parsed is None:
+            return None, {
+                "status": "error",
+                "message": f"Invalid '{name}': use epoch milliseconds or an ISO date",
+                "error_code": 400
+            }
+        bounds.append(parsed)
+    return tuple(bounds), None
+
+
+def get_counterparty_stats(by="amount", k=10, t_type=None, start=None, end=None):
+    """
+    GET /transactions/stats/counterparties - Who we pay or receive from the most
+
+    Args:
+        by (str): Rank by 'amount' or 'count'
+        k (int): Number of counterparties (at most MAX_TOP_K)
+        t_type (str): Only this transaction type, e.g. 'sent' or 'received'
+        start: Window start (epoch milliseconds or ISO date), inclusive
+        end: Window end (epoch milliseconds or ISO date), inclusive
+
+    Returns:
+        dict: Response with the top counterparties and their count and amount
+    """
+    if by not in METRICS:
+        return {
+            "status": "error",
+            "message": "by must be 'amount' or 'count'",
+            "error_code": 400
+        }
+    try:
+        k = int(k)
+    except (TypeError, ValueError):
+        k = 0
+    if not 1 <= k <= config.MAX_TOP_K:
+        return {
+            "status": "error",
+            "message": f"k must be between 1 and {config.MAX_TOP_K}",
+            "error_code": 400
+        }
+    bounds, error = _parse_window(start, end)
+    if error:
+        return error
+
+    # top() reorganises the heaps, so it runs under the write lock
+    with _write_lock:
+        top = counterparty_index.top(by, k, t_type or None, *bounds)
+
+    return {
+        "status": "success",
+        "by": by,
+        "type": t_type or None,
+        "from": bounds[0],
+        "to": bounds[1],
+        "count": len(top),
+        "data": top
+    }
+
+
+def get_alerts(since=0, rule=None, transaction_id=None, limit=100):
+    """
+    GET /transactions/alerts - Velocity and unusual-amount alerts
+
+    Alerts are raised as transactions are loaded or created (updates and
+    deletes don't change them) and numbered in order, so clients can poll
+    with since=<last seq>.
+
+    Args:
+        since: Only alerts with a higher sequence number
+        rule (str): Only 'velocity' or 'amount' alerts
+        transaction_id: Only alerts raised by this transaction
+        limit: Most alerts to return (at most MAX_ALERTS)
+
+    Returns:
+        dict: Response with the alerts, oldest first
+    """
+    if rule is not None and rule != "" and rule not in ALERT_RULES:
+        return {
+            "status": "error",
+            "message": "rule must be 'velocity' or 'amount'",
+            "error_code": 400
+        }
+    try:
+        since = int(since or 0)
+        limit = int(limit)
+        transaction_id = int(transaction_id) if transaction_id not in (None, "") else None
+    except (TypeError, ValueError):
+        return {
+            "status": "error",
+            "message": "since, limit and id must be integers",
+            "error_code": 400
+        }
+    if not 1 <= limit <= config.MAX_ALERTS:
+        return {
+            "status": "error",
+            "message": f"limit must be between 1 and {config.MAX_ALERTS}",
+            "error_code": 400
+        }
+
+    with _write_lock:
+        alerts = anomaly_detector.alerts(since, rule or None, transaction_id, limit)
+        stats = anomaly_detector.stats()
+
+    return {
+        "status": "success",
+        "count": len(alerts),
+        "last_seq": alerts[-1]["seq"] if alerts else since,
+        "stats": stats,
+        "data": alerts
+    }
+
+
+def search_counterparties(q, limit=10, min_similarity=None):
+    """
+    GET /counterparties/search?q= - Sender and receiver names like q
+
+    Matches typos and spelling variants ("jnae smyth" finds "jane smith")
+    by trigram similarity. Each match lists the IDs of its transactions
+    (at most MAX_BATCH_IDS, for POST /transactions/lookup).
+
+    Args:
+        q (str): Name to look for
+        limit: Most names to return (at most MAX_SEARCH_RESULTS)
+        min_similarity: Lowest similarity to return, 0-1 (default SEARCH_MIN_SIMILARITY)
+
+    Returns:
+        dict: Response with the matching names, best first
+    """
+    if not isinstance(q, str) or not q.strip():
+        return {
+            "status": "error",
+            "message": "q is required",
+            "error_code": 400
+        }
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        limit = 0
+    if not 1 <= limit <= config.MAX_SEARCH_RESULTS:
+        return {
+            "status": "error",
+            "message": f"limit must be between 1 and {config.MAX_SEARCH_RESULTS}",
+            "error_code": 400
+        }
+    if min_similarity is None or min_similarity == "":
+        min_similarity = config.SEARCH_MIN_SIMILARITY
+    try:
+        min_similarity = float(min_similarity)
+    except (TypeError, ValueError):
+        min_similarity = -1
+    if not 0 < min_similarity <= 1:
+        return {
+            "status": "error",
+            "message": "min_similarity must be greater than 0 and at most 1",
+            "error_code": 400
+        }
+
+    with _write_lock:
+        matches = []
+        for name, similarity, count in counterparty_search.search(q, limit, min_similarity):
+            matches.append({
+                "name": name,
+                "similarity": round(similarity, 4),
+                "transaction_count": count,
+                "transaction_ids": counterparty_search.transaction_ids(name)[:config.MAX_BATCH_IDS]
+            })
+
+    return {
+        "status": "success",
+        "query": q,
+        "count": len(matches),
+        "data": matches
+    }
+
+
+def get_ledger(start=None, end=None, limit=100):
+    """
+    GET /transactions/ledger - Net flow between two times
+
+    Args:
+        start: From (epoch milliseconds or ISO date/datetime), inclusive
+        end: To (epoch milliseconds or ISO date/datetime), inclusive
+        limit: Most balance mismatches to list
+
+    Returns:
+        dict: Inflow, outflow, fees, net flow and balance mismatches
+    """
+    bounds, error = _parse_window(start, end)
+    if error:
+        return error
+
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        return {
+            "status": "error",
+            "message": "limit must be an integer",
+            "error_code": 400
+        }
+
+    with _write_lock:
+        summary = ledger.summary(bounds[0], bounds[1], max(0, limit))
+
+    return {
+        "status": "success",
+        "data": summary
+    }
 
 
 # Test routes
 if __name__ == "__main__":
     print("Testing API Routes")
     print("=" * 60)
+    load_transactions()
+
+    def listed(*args):
+        """An unsorted listing's streamed body, decoded"""
+        return json.loads(b"".join(get_all_transactions(*args)["chunks"]))
 
     # Test GET all
     print("\n1. GET all transactions")
-    result = get_all_transactions()
+    result = listed()
+    assert result['data'] == list(current_transactions()) and result['count'] == len(result['data'])
     print(f"Status: {result['status']}")
     print(f"Count: {result['count']}")
     print(f"First transaction: {result['data'][0] if result['data'] else 'None'}")
 
+    # Sorted and limited lists match a full sort of the same rows
+    print("\n1b. GET sorted transactions")
+    for sort in ("-amount", "fee", "-timestamp", "timestamp:asc"):
+        for t_type in (None, "sent"):
+            field, descending = parse_sort(sort)[0]
+            expected = top_k(listed(t_type)['data'], field, descending)
+            for limit in (5, None):
+                result = get_all_transactions(t_type, sort=sort, limit=limit)
+                assert result['data'] == expected[:limit], (sort, t_type, limit)
+    latest = get_all_transactions(sort="-timestamp", limit=3)['data']
+    print(f"Latest 3: {[(t['id'], t.get('date')) for t in latest]}")
+    largest = get_all_transactions("sent", sort="amount:desc", limit=3)['data']
+    print(f"Largest 3 sent: {[(t['id'], t['amount']) for t in largest]}")
+    print(f"limit=0: {get_all_transactions(limit=0)['error_code']}, sort=balance: "
+          f"{get_all_transactions(sort='balance')['error_code']}")
+
     # Test GET by ID
     print("\n2. GET transaction by ID (ID=1)")
     result = get_transaction_by_id(1)
@@ -269,6 +1255,12 @@ if __name__ == "__main__":
     if result['status'] == 'success':
         print(f"Transaction: {result['data']}")
 
+    # Test batch GET
+    print("\n2b. GET transactions by IDs (1,5,999999)")
+    result = get_transactions_by_ids("1,5,999999")
+    print(f"Status: {result['status']}")
+    print(f"Found: {[t['id'] for t in result['data']]}, missing: {result['missing']}")
+
     # Test POST (create)
     print("\n3. POST - Create new transaction")
     new_trans = {
@@ -298,8 +1290,121 @@ if __name__ == "__main__":
     print(f"Status: {result['status']}")
     print(f"Message: {result['message']}")
 
+    # Test ledger
+    print("\n5b. GET ledger for May 2024")
+    result = get_ledger("2024-05-01", "2024-05-31T23:59:59")
+    print(f"Status: {result['status']}")
+    print(f"In: {result['data']['inflow']}, out: {result['data']['outflow']}, "
+          f"fees: {result['data']['fees']}, mismatches: {result['data']['balance_mismatch_count']}")
+
+    # A transaction created without a balance reports none, so it can't be a mismatch
+    mismatches = get_ledger()['data']['balance_mismatch_count']
+    latest = max(filter(None, map(ledger_time, current_transactions())))
+    created = create_transaction({"type": "received", "amount": 500, "sender": "B", "date": latest + 1000})
+    assert created['data']['balance'] is None
+    assert get_ledger()['data']['balance_mismatch_count'] == mismatches
+    delete_transaction(created['data']['id'])
+    print(f"Created without a balance: still {mismatches} mismatches")
+
+    # Test top counterparties
+    print("\n5c. GET top 3 counterparties by amount")
+    result = get_counterparty_stats("amount", 3)
+    for entry in result['data']:
+        print(f"  {entry['name']}: {entry['count']} transactions, {entry['amount']} RWF")
+
     # Test stats
     print("\n6. GET transaction statistics")
     result = get_transaction_stats()
     print(f"Status: {result['status']}")
     print(f"Stats: {json.dumps(result['data'], indent=2)}")
+
+    # Check the sketches against exact answers
+    print("\n6b. GET approximate statistics")
+    result = get_transaction_stats(approx=True)
+    approx = result['data']
+    exact = get_transaction_stats()['data']
+    transactions = current_transactions()
+    assert approx['total_transactions'] == exact['total_transactions']
+    for field, key in (('sender', 'distinct_senders'), ('receiver', 'distinct_receivers')):
+        names = {" ".join(t[field].lower().split()) for t in transactions if isinstance(t.get(field), str)}
+        names.discard('self')
+        # Deleted names stay in the sketch until the next rebuild
+        slack = 4 * approx['distinct_relative_error'] * len(names) + approx['removed_since_rebuild'] + 1
+        assert abs(approx[key] - len(names)) <= slack
+        print(f"{key}: approx {approx[key]}, exact {len(names)}")
+    amounts = sorted(t['amount'] for t in transactions if isinstance(t.get('amount'), (int, float)))
+    print(f"Median amount: approx {approx['amount_quantiles']['p50']}, exact {amounts[len(amounts) // 2]}")
+    print(f"Top counterparties: {approx['top_counterparties'][:3]}")
+    print(f"Removed since last rebuild: {approx['removed_since_rebuild']}")
+
+    # Alerts raised while loading, and by a burst of new transfers
+    print("\n6c. GET alerts")
+    result = get_alerts(limit=3)
+    print(f"Raised on load: {result['stats']['alerts_raised']}, first: {result['data'][:1]}")
+    since = result['stats']['last_seq']
+    created = [create_transaction({"transaction_type": "sent", "amount": 1000, "recipient": "Burst Test"})
+               for _ in range(config.ANOMALY_BURST + 1)]
+    assert 'alerts' in created[-1] and created[-1]['alerts'][0]['rule'] == 'velocity'
+    result = get_alerts(since, rule='velocity')
+    print(f"After {len(created)} quick transfers: {[(a['key'], a['count']) for a in result['data']]}")
+    for entry in created:
+        delete_transaction(entry['data']['id'])
+
+    # Fuzzy counterparty search, with a typo in a known name
+    print("\n6d. GET counterparty search")
+    name = approx['top_counterparties'][0]['name']
+    query = name[:2] + name[3:] if len(name) > 3 else name
+    result = search_counterparties(query, 3)
+    print(f"Query {query!r}: {[(m['name'], m['similarity'], m['transaction_count']) for m in result['data']]}")
+    assert result['data'] and any(m['name'] == name for m in result['data'])
+    print(f"Empty query: {search_counterparties(' ')['error_code']}")
+
+    # With a cold tier, unsorted listings are streamed rather than built as one list
+    print("\n7. GET /transactions with a cold tier")
+    import tempfile
+    expected = list(current_transactions())
+    sent = [t for t in expected if transaction_type(t) == "sent"]
+    hot_budget, cold_dir = config.HOT_TIER_BUDGET, cold_store.directory
+    config.HOT_TIER_BUDGET = _hot_bytes // 4
+    cold_store.directory = tempfile.mkdtemp()
+    try:
+        install_transactions(expected)
+        assert cold_store.manifest.segments
+        body = listed()
+        assert body["status"] == "success" and body["count"] == len(expected) and body["data"] == expected
+        body = listed("sent")
+        assert body["data"] == sent
+        print(f"Streamed {body['count']} sent of {len(expected)} transactions, "
+              f"{len(cold_store)} of them from {len(cold_store.manifest.segments)} cold segments")
+        # Time-ordered reads resolve cold transactions outside the write lock
+        for t_type in (None, "sent", "deposit"):
+            for sort in ("timestamp", "-timestamp"):
+                field, descending = parse_sort(sort)[0]
+                rows = [t for t in expected if t_type is None or transaction_type(t) == t_type]
+                result = get_all_transactions(t_type, sort=sort, limit=600)
+                assert result["data"] == top_k(rows, field, descending, 600), (t_type, sort)
+        # Stale sketches are rebuilt from a snapshot while writes carry on
+        for transaction in expected[:200]:
+            delete_transaction(transaction["id"])
+        assert sketch_index.stale()
+        stale = sketch_index
+        stop = threading.Event()
+
+        def write():
+            while not stop.is_set():
+                delete_transaction(create_transaction({"type": "sent", "amount": 1})["data"]["id"])
+                create_transaction({"type": "sent", "amount": 2})
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        get_approximate_stats()
+        stop.set()
+        writer.join()
+        store_size = len(transaction_versions) + len(cold_store)
+        assert sketch_index is not stale and sketch_index.count == store_size
+        print(f"Sketches rebuilt alongside writes: {sketch_index.count} transactions, as in the store")
+    finally:
+        config.HOT_TIER_BUDGET = hot_budget
+        install_transactions(expected)
+        os.rmdir(cold_store.directory)
+        cold_store.directory = cold_dir
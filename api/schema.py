@@ -0,0 +1,326 @@
+"""
+Transaction Schema
+Validates and normalises the JSON body of POST and PUT /transactions
+before anything is stored.
+
+SCHEMA declares each field once: its kind, the other names it may arrive
+under, its limits and its default. compile_schema() turns it into a
+Validator with one checker function per field, built up front, so a
+request costs one dictionary lookup and one call per key it sends rather
+than a walk over every rule.
+
+`type` is the canonical name of the transaction type (the SMS parser's);
+the API's older `transaction_type` is accepted as an alias, so every
+stored transaction has the same keys.
+"""
+
+import math
+import os
+import sys
+
+# Add parent directory to import modules
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dsa.ledger import parse_time
+
+# Field -> rules
+#   kind: "str", "number" or "time" (epoch ms, or an ISO date stored as epoch ms)
+#   aliases: other accepted names
+#   required: must be present on create
+#   nullable: null is accepted
+#   default: stored on create when the field is absent
+#   lower: lower-case the value
+#   max_length / min / max: limits
+SCHEMA = {
+    "type": {"kind": "str", "aliases": ("transaction_type",), "required": True, "lower": True, "max_length": 32},
+    "amount": {"kind": "number", "required": True, "min": 0, "max": 10 ** 12},
+    "fee": {"kind": "number", "nullable": True, "default": 0, "min": 0, "max": 10 ** 12},
+    # No default of 0: the ledger takes any number here as a balance the SMS reported
+    "balance": {"kind": "number", "nullable": True, "default": None, "max": 10 ** 15},
+    "sender": {"kind": "str", "nullable": True, "default": None, "max_length": 100},
+    "recipient": {"kind": "str", "nullable": True, "default": None, "max_length": 100},
+    "receiver": {"kind": "str", "nullable": True, "max_length": 100},
+    "phone_number": {"kind": "str", "nullable": True, "default": None, "max_length": 20},
+    "transaction_id": {"kind": "str", "nullable": True, "default": None, "max_length": 64},
+    "date": {"kind": "time", "nullable": True, "default": None},
+    "timestamp": {"kind": "str", "nullable": True, "max_length": 64},
+    "raw_text": {"kind": "str", "nullable": True, "max_length": 2000}
+}
+
+# Accepted but not stored: the store assigns IDs
+IGNORED_FIELDS = ("id",)
+
+# Bodies with more keys than this are rejected before any field is checked
+MAX_FIELDS = 32
+
+
+class SchemaError(ValueError):
+    """A field value that doesn't fit the schema"""
+
+
+def _string_checker(name, rules):
+    nullable = rules.get("nullable", False)
+    lower = rules.get("lower", False)
+    max_length = rules.get("max_length")
+    required = rules.get("required", False)
+
+    def check(value):
+        if value is None:
+            if nullable:
+                return None
+            raise SchemaError(f"{name} must be a string")
+        if type(value) is not str:
+            # Phone numbers and reference numbers often arrive as numbers
+            if type(value) is not int:
+                raise SchemaError(f"{name} must be a string")
+            value = str(value)
+        value = value.strip()
+        if max_length is not None and len(value) > max_length:
+            raise SchemaError(f"{name} is longer than {max_length} characters")
+        if required and not value:
+            raise SchemaError(f"{name} must not be empty")
+        return value.lower() if lower else value
+    return check
+
+
+def _number_checker(name, rules):
+    nullable = rules.get("nullable", False)
+    low = rules.get("min")
+    high = rules.get("max")
+
+    def check(value):
+        if value is None:
+            if nullable:
+                return None
+            raise SchemaError(f"{name} must be a number")
+        kind = type(value)
+        if kind is str:
+            # "5000" and "12.50" from form-style clients
+            text = value.strip()
+            try:
+                value = int(text)
+            except ValueError:
+                try:
+                    value = float(text)
+                except ValueError:
+                    raise SchemaError(f"{name} must be a number") from None
+        elif kind is not int and kind is not float:
+            raise SchemaError(f"{name} must be a number")
+        if type(value) is float and not math.isfinite(value):
+            raise SchemaError(f"{name} must be a finite number")
+        if low is not None and value < low:
+            raise SchemaError(f"{name} must be at least {low}")
+        if high is not None and value > high:
+            raise SchemaError(f"{name} must be at most {high}")
+        return value
+    return check
+
+
+def _time_checker(name, rules):
+    nullable = rules.get("nullable", False)
+
+    def check(value):
+        if value is None:
+            if nullable:
+                return None
+            raise SchemaError(f"{name} must be a time")
+        if type(value) is int:
+            return value
+        if type(value) is float and math.isfinite(value):
+            return int(value)
+        if type(value) is not str or len(value) > 64:
+            raise SchemaError(f"{name} must be epoch milliseconds or an ISO date")
+        parsed = parse_time(value)
+        if parsed is None:
+            raise SchemaError(f"{name} must be epoch milliseconds or an ISO date")
+        return parsed
+    return check
+
+
+_CHECKERS = {
+    "str": _string_checker,
+    "number": _number_checker,
+    "time": _time_checker
+}
+
+
+class Validator:
+    """A compiled schema: validate() checks and normalises one payload"""
+
+    def __init__(self, fields, required, defaults, ignored, max_fields):
+        # Accepted key (canonical or alias) -> (canonical name, checker)
+        self._fields = fields
+        # (canonical name, label for the error message)
+        self._required = required
+        self._defaults = defaults
+        self._ignored = frozenset(ignored)
+        self._max_fields = max_fields
+
+    def validate(self, payload, partial=False):
+        """
+        Check a POST or PUT body and normalise it
+
+        Args:
+            payload: Decoded JSON body
+            partial (bool): An update: nothing is required and no defaults
+                are added
+
+        Returns:
+            tuple: (new dict with canonical field names, None), or
+            (None, error message)
+        """
+        if not isinstance(payload, dict):
+            return None, "Body must be a JSON object"
+        if len(payload) > self._max_fields:
+            return None, f"At most {self._max_fields} fields per transaction"
+
+        clean = {}
+        fields = self._fields
+        try:
+            for key, value in payload.items():
+                field = fields.get(key)
+                if field is None:
+                    if key in self._ignored:
+                        continue
+                    return None, f"Unknown field: {key}"
+                name, check = field
+                if name in clean:
+                    return None, f"{key} and {name} are the same field; send one of them"
+                clean[name] = check(value)
+        except SchemaError as e:
+            return None, str(e)
+
+        if not partial:
+            for name, label in self._required:
+                if name not in clean:
+                    return None, f"Missing required field: {label}"
+            for name, default in self._defaults:
+                if name not in clean:
+                    clean[name] = default
+        return clean, None
+
+
+def compile_schema(schema, ignored=IGNORED_FIELDS, max_fields=MAX_FIELDS):
+    """
+    Build a Validator from a schema declaration
+
+    Args:
+        schema (dict): Field name -> rules (see SCHEMA)
+        ignored (iterable): Keys accepted and dropped
+        max_fields (int): Most keys in one payload
+
+    Returns:
+        Validator: Ready to validate payloads
+
+    Raises:
+        ValueError: The declaration is inconsistent
+    """
+    fields = {}
+    required = []
+    defaults = []
+    for name, rules in schema.items():
+        kind = rules.get("kind")
+        if kind not in _CHECKERS:
+            raise ValueError(f"{name}: unknown kind {kind!r}")
+        check = _CHECKERS[kind](name, rules)
+        for key in (name,) + tuple(rules.get("aliases", ())):
+            if key in fields:
+                raise ValueError(f"{key} is declared twice")
+            fields[key] = (name, check)
+        if rules.get("required"):
+            label = " or ".join((name,) + tuple(rules.get("aliases", ())))
+            required.append((name, label))
+        elif "default" in rules:
+            defaults.append((name, rules["default"]))
+    return Validator(fields, tuple(required), tuple(defaults), ignored, max_fields)
+
+
+TRANSACTION_VALIDATOR = compile_schema(SCHEMA)
+
+
+def validate_transaction(payload, partial=False):
+    """Validate a POST (or, with partial=True, PUT) /transactions body - see Validator.validate"""
+    return TRANSACTION_VALIDATOR.validate(payload, partial)
+
+
+# Test the schema and time validation
+if __name__ == "__main__":
+    import json
+    import time
+
+    print("Transaction Schema Test")
+    print("=" * 50)
+
+    clean, error = validate_transaction({"transaction_type": "PAYMENT", "amount": "5000",
+                                         "recipient": " John Doe ", "date": "2024-05-10T16:30:00"})
+    print(f"Create: {clean}")
+    assert error is None and clean["type"] == "payment" and clean["amount"] == 5000
+    assert clean["recipient"] == "John Doe" and clean["date"] == 1715358600000 and clean["fee"] == 0
+    assert "transaction_type" not in clean
+
+    clean, error = validate_transaction({"amount": 6000, "id": 99}, partial=True)
+    assert clean == {"amount": 6000} and error is None
+
+    for payload, partial in (
+            ([1, 2], False),
+            ({"amount": 5}, False),
+            ({"type": "sent", "amount": -1}, False),
+            ({"type": "sent", "amount": True}, False),
+            ({"type": "sent", "amount": "lots"}, False),
+            ({"type": "sent", "amount": float("nan")}, False),
+            ({"type": "sent", "transaction_type": "sent", "amount": 1}, False),
+            ({"type": "sent", "amount": 1, "is_admin": True}, False),
+            ({"sender": "x" * 101}, True),
+            ({"date": "yesterday"}, True),
+            ({"type": "  "}, True),
+            ({f"field{i}": i for i in range(MAX_FIELDS + 1)}, True)):
+        clean, error = validate_transaction(payload, partial)
+        assert clean is None and error, payload
+        print(f"  {json.dumps(payload)[:50]:<52} -> {error}")
+
+    # Validating canonical output again changes nothing
+    clean, _ = validate_transaction({"transaction_type": "Sent", "amount": 1.5, "phone_number": 250791666666})
+    assert validate_transaction(clean) == (clean, None)
+
+    # Per-request cost, against checking the declaration rule by rule
+    def interpreted(payload):
+        clean = {}
+        for key, value in payload.items():
+            for name, rules in SCHEMA.items():
+                if key == name or key in rules.get("aliases", ()):
+                    clean[name] = _CHECKERS[rules["kind"]](name, rules)(value)
+                    break
+            else:
+                if key not in IGNORED_FIELDS:
+                    raise SchemaError(f"Unknown field: {key}")
+        for name, rules in SCHEMA.items():
+            if rules.get("required") and name not in clean:
+                raise SchemaError(f"Missing required field: {name}")
+            if "default" in rules:
+                clean.setdefault(name, rules["default"])
+        return clean
+
+    payloads = {
+        "create (3 fields)": ({"transaction_type": "PAYMENT", "amount": 5000, "recipient": "John Doe"}, False),
+        "create (9 fields)": ({"type": "sent", "amount": 5000, "fee": 100, "balance": 40400,
+                               "sender": "self", "receiver": "Jane Smith", "phone_number": "250791666666",
+                               "transaction_id": "76662021700", "date": 1715351458724}, False),
+        "update (1 field)": ({"amount": 6000}, True),
+        "rejected (unknown field)": ({"type": "sent", "amount": 1, "is_admin": True}, False),
+    }
+    n = 100000
+    print(f"\nPer-request validation cost ({n} runs each):")
+    for label, (payload, partial) in payloads.items():
+        begin = time.perf_counter()
+        for _ in range(n):
+            validate_transaction(payload, partial)
+        compiled = (time.perf_counter() - begin) / n
+        line = f"  {label:<26} {compiled * 1e6:6.2f} µs"
+        if not partial and "is_admin" not in payload:
+            begin = time.perf_counter()
+            for _ in range(n // 10):
+                interpreted(payload)
+            line += f"   (rule by rule: {(time.perf_counter() - begin) / (n // 10) * 1e6:.2f} µs)"
+        print(line)
+
+    print("\n✓ Schema checks passed")
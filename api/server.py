@@ -2,147 +2,640 @@
 REST API Server for Mobile Money Transactions
 """
 
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import argparse
 import json
+import os
 import re
-from urllib.parse import urlparse, parse_qs
+import time
+from functools import wraps
+from urllib.parse import parse_qs
 
 # Import the modules
-from auth import require_auth
+import config
+from auth import authenticate
+from access_log import get_access_logger, build_record
+from profiler import request_profiler, start_profiling, get_profile_report, reset_profiles
+from rate_limit import rate_limiter, in_flight, rate_limited_response, overloaded_response
+from changes import stream_slots, parse_since, poll_changes, stream_changes, wants_stream
+from tenants import tenant_store, partition_for
+from idempotency import run_idempotent
 from routes import (
+    start_loading,
+    load_transactions,
+    is_ready,
+    get_health,
+    get_readiness,
     get_all_transactions,
+    export_transactions,
     get_transaction_by_id,
+    get_transactions_by_ids,
     create_transaction,
     update_transaction,
     delete_transaction,
-    get_transaction_stats
+    get_transaction_stats,
+    get_ledger,
+    get_counterparty_stats,
+    get_alerts,
+    search_counterparties
 )
 
 
+def profiled(method):
+    """Run a request handler under cProfile when profiling is requested"""
+    @wraps(method)
+    def wrapper(self):
+        if not request_profiler.wants(self.headers):
+            return method(self)
+        return request_profiler.run(method, self, label="{} {}".format(self.command, self.path))
+    return wrapper
+
+
+# Dispatch table: (method, path, handler method, access)
+# access is 'public' (no auth), 'user' (any valid user), 'admin' (ADMIN_USERS)
+# or 'stream' (any valid user; long-lived, capped by MAX_STREAMS instead of MAX_IN_FLIGHT)
+# Paths without regex groups are matched with a dict lookup, the rest by
+# precompiled regexes tried in order.
+ROUTES = [
+    ('GET', '/healthz', '_handle_health', 'public'),
+    ('GET', '/readyz', '_handle_ready', 'public'),
+    ('GET', '/admin/profile', '_handle_profile_report', 'admin'),
+    ('POST', '/admin/profile', '_handle_profile_start', 'admin'),
+    ('DELETE', '/admin/profile', '_handle_profile_reset', 'admin'),
+    ('GET', '/transactions', '_handle_list', 'user'),
+    ('GET', '/transactions/stats', '_handle_stats', 'user'),
+    ('GET', '/transactions/stats/counterparties', '_handle_counterparties', 'user'),
+    ('GET', '/transactions/ledger', '_handle_ledger', 'user'),
+    ('GET', '/transactions/alerts', '_handle_alerts', 'user'),
+    ('GET', '/transactions/changes', '_handle_changes', 'stream'),
+    ('GET', '/transactions/export', '_handle_export', 'user'),
+    ('GET', r'/transactions/(\d+)', '_handle_get', 'user'),
+    ('POST', '/transactions', '_handle_create', 'user'),
+    ('POST', '/transactions/lookup', '_handle_lookup', 'user'),
+    ('PUT', r'/transactions/(\d+)', '_handle_update', 'user'),
+    ('PUT', '/transactions', '_handle_missing_id', 'user'),
+    ('DELETE', r'/transactions/(\d+)', '_handle_delete', 'user'),
+    ('DELETE', '/transactions', '_handle_missing_id', 'user'),
+    ('GET', '/counterparties/search', '_handle_counterparty_search', 'user'),
+    # The authenticated user's own account (multi-tenant store)
+    ('GET', '/account/transactions', '_handle_account_list', 'user'),
+    ('GET', '/account/transactions/stats', '_handle_account_stats', 'user'),
+    ('GET', '/account/transactions/stats/counterparties', '_handle_account_counterparties', 'user'),
+    ('GET', '/account/transactions/ledger', '_handle_account_ledger', 'user'),
+    ('GET', r'/account/transactions/(\d+)', '_handle_account_get', 'user'),
+    ('POST', '/account/transactions', '_handle_account_create', 'user'),
+    ('PUT', r'/account/transactions/(\d+)', '_handle_account_update', 'user'),
+    ('DELETE', r'/account/transactions/(\d+)', '_handle_account_delete', 'user'),
+    ('GET', '/admin/tenants', '_handle_tenants', 'admin'),
+]
+
+METHODS = ('GET', 'POST', 'PUT', 'DELETE')
+
+
+def compile_routes(routes):
+    """
+    Split the route table into exact-match and regex lookups
+
+    Returns:
+        tuple: ({(method, path): (handler, access)}, {method: [(regex, handler, access)]})
+    """
+    static = {}
+    dynamic = {}
+    for method, pattern, handler, access in routes:
+        if '(' in pattern:
+            dynamic.setdefault(method, []).append((re.compile('^' + pattern + '$'), handler, access))
+        else:
+            static[(method, pattern)] = (handler, access)
+    return static, dynamic
+
+
+_STATIC_ROUTES, _DYNAMIC_ROUTES = compile_routes(ROUTES)
+
+
+def resolve_route(method, path):
+    """
+    Find the handler for a request
+
+    Returns:
+        tuple: (handler name, access, regex match or None), or None if nothing matches
+    """
+    route = _STATIC_ROUTES.get((method, path))
+    if route is not None:
+        return route[0], route[1], None
+    for regex, handler, access in _DYNAMIC_ROUTES.get(method, ()):
+        match = regex.match(path)
+        if match:
+            return handler, access, match
+    return None
+
+
 class TransactionAPIHandler(BaseHTTPRequestHandler):
     """HTTP Request Handler for Transaction API"""
 
-    def _set_headers(self, status_code=200, content_type='application/json'):
+    # HTTP/1.1 keeps connections open between requests
+    protocol_version = 'HTTP/1.1'
+    # Idle keep-alive connections are closed after this many seconds
+    timeout = config.KEEPALIVE_TIMEOUT
+    # Headers and body go out in separate writes; don't let Nagle hold the
+    # body back waiting for the client's delayed ACK on a kept-alive socket
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self._requests_on_connection = 0
+
+    def handle_one_request(self):
+        self._request_start = time.perf_counter()
+        self._response_status = None
+        self._response_size = None
+        self._user = None
+        self._body_read = False
+        BaseHTTPRequestHandler.handle_one_request(self)
+        if self._response_status is not None:
+            self._log_access()
+
+    def parse_request(self):
+        if not BaseHTTPRequestHandler.parse_request(self):
+            return False
+        self._requests_on_connection += 1
+        # Pre-fork workers pick up writes made by the other workers
+        change_log = getattr(self.server, 'change_log', None)
+        if change_log is not None:
+            change_log.catch_up()
+        return True
+
+    def _write(self, op, fn, *args):
+        """Apply a store write, through the shared change log in pre-fork mode"""
+        change_log = getattr(self.server, 'change_log', None)
+        if change_log is None:
+            return fn(*args)
+        return change_log.write(op, fn, *args)
+
+    def _set_headers(self, status_code=200, content_type='application/json', headers=None,
+                     content_length=None):
         self.send_response(status_code)
         self.send_header('Content-Type', content_type)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Access-Control-Allow-Methods', 'GET, POST, PUT, DELETE, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type, Authorization')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type, Authorization, Idempotency-Key')
+        if content_length is not None:
+            self.send_header('Content-Length', str(content_length))
+        if self._requests_on_connection >= config.KEEPALIVE_MAX_REQUESTS:
+            # send_header also sets close_connection
+            self.send_header('Connection', 'close')
+        elif not self.close_connection:
+            self.send_header('Keep-Alive', 'timeout={}, max={}'.format(
+                int(self.timeout), config.KEEPALIVE_MAX_REQUESTS - self._requests_on_connection))
         self.end_headers()
 
-    def _send_response(self, data, status_code=200):
-        self._set_headers(status_code)
-        response = json.dumps(data, indent=2)
-        self.wfile.write(response.encode())
+    def _send_response(self, data, status_code=200, headers=None):
+        response = json.dumps(data, indent=2).encode()
+        self._set_headers(status_code, headers=headers, content_length=len(response))
+        self._response_size = len(response)
+        self.wfile.write(response)
 
-    def _send_error_response(self, message, status_code=400):
+    def _send_chunked(self, chunks, content_type, headers=None):
+        """
+        Stream a body of unknown length: chunked transfer encoding on
+        HTTP/1.1 (the connection stays usable), close-delimited on HTTP/1.0
+        """
+        headers = dict(headers or {})
+        chunked = self.request_version != 'HTTP/1.0'
+        if chunked:
+            headers['Transfer-Encoding'] = 'chunked'
+        else:
+            headers['Connection'] = 'close'
+        self._set_headers(200, content_type, headers=headers)
+        self._response_size = 0
+        try:
+            for chunk in chunks:
+                if not chunk:
+                    continue
+                if chunked:
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                else:
+                    self.wfile.write(chunk)
+                self._response_size += len(chunk)
+            if chunked:
+                self.wfile.write(b"0\r\n\r\n")
+        except Exception as e:
+            # Too late for an error status; ending without the last chunk
+            # tells the client the body is incomplete
+            self.close_connection = True
+            if not isinstance(e, OSError):
+                self.log_error("Streaming %s failed: %s", self.path, e)
+
+    def _send_error_response(self, message, status_code=400, headers=None):
         self._send_response({
             "status": "error",
             "message": message,
             "error_code": status_code
-        }, status_code)
+        }, status_code, headers)
+
+    def _send_result(self, result, success_status=200):
+        self._send_response(result, result.get('error_code', success_status))
 
     def _check_auth(self):
-        auth_header = self.headers.get('Authorization')
-        is_auth, error = require_auth(auth_header)
-        if not is_auth:
-            self._send_response(error, 401)
+        auth_result = authenticate(self.headers)
+        if auth_result['status'] != 200:
+            self._send_response({
+                'error': auth_result['error'],
+                'message': 'Please provide valid credentials'
+            }, auth_result['status'])
             return False
+        self._user = auth_result['user']
+        if config.RATE_LIMIT_ENABLED:
+            allowed, retry_after, quota = rate_limiter.check(self._user)
+            if not allowed:
+                body, headers = rate_limited_response(retry_after, quota)
+                self._send_response(body, 429, headers)
+                return False
         return True
 
-    def _parse_path(self):
-        parsed = urlparse(self.path)
-        path = parsed.path.rstrip('/')
-        match = re.match(r'^/transactions/(\d+)$', path)
-        if match:
-            return '/transactions', int(match.group(1))
-        return path, None
+    def _check_admin(self):
+        if not self._check_auth():
+            return False
+        if self._user not in config.ADMIN_USERS:
+            self._send_error_response("Admin access required", 403)
+            return False
+        return True
+
+    def _check_ready(self, path):
+        """
+        Fail fast with 503 + Retry-After while the store is still loading
+        (checked after auth, so only authenticated callers see the load progress)
+        """
+        if is_ready() or not path.startswith(('/transactions', '/counterparties')):
+            return True
+        self._send_response(get_readiness(), 503,
+                            headers={'Retry-After': str(config.RETRY_AFTER_SECONDS)})
+        return False
+
+    def _query(self):
+        return {k: v[0] for k, v in parse_qs(self._query_string).items()}
+
+    def _read_json_body(self):
+        """
+        Read and decode the JSON request body
+
+        Returns:
+            tuple: (data, None) or (None, error message)
+        """
+        length = int(self.headers.get('Content-Length', 0))
+        if length == 0:
+            return None, "Request body required"
+        body = self.rfile.read(length)
+        self._body_read = True
+        try:
+            return json.loads(body.decode()), None
+        except ValueError as e:
+            return None, "Invalid JSON or server error: {}".format(str(e))
+
+    def _finish_body(self):
+        """
+        Keep the connection usable when a handler didn't read the request body:
+        small bodies are drained, large ones close the connection
+        """
+        if self._body_read:
+            return
+        length = int(self.headers.get('Content-Length', 0) or 0)
+        if length <= 0:
+            return
+        if length <= 65536 and not self.close_connection:
+            self.rfile.read(length)
+        else:
+            self.close_connection = True
 
     def do_OPTIONS(self):
+        # A preflight's body (rare, but allowed) mustn't be read as the next request
+        self._finish_body()
         self._set_headers(204)
 
-    def do_GET(self):
-        if not self._check_auth():
+    @profiled
+    def _dispatch(self):
+        path, _, self._query_string = self.path.partition('?')
+        path = path.rstrip('/') or '/'
+        try:
+            route = resolve_route(self.command, path)
+            if route is None:
+                allowed = [m for m in METHODS if resolve_route(m, path) is not None]
+                if allowed:
+                    self._send_error_response("Method not allowed", 405,
+                                              headers={'Allow': ', '.join(allowed + ['OPTIONS'])})
+                else:
+                    self._send_error_response("Endpoint not found", 404)
+                return
+
+            handler, access, match = route
+            if access == 'public':
+                getattr(self, handler)(match)
+                return
+            # Shed load before doing any work for the request
+            limiter = stream_slots if access == 'stream' else in_flight
+            if not limiter.acquire():
+                body, headers = overloaded_response()
+                self._send_response(body, 503, headers)
+                return
+            try:
+                if access == 'admin' and not self._check_admin():
+                    return
+                if access in ('user', 'stream') and not self._check_auth():
+                    return
+                if not self._check_ready(path):
+                    return
+                getattr(self, handler)(match)
+            finally:
+                limiter.release()
+        finally:
+            self._finish_body()
+
+    do_GET = do_POST = do_PUT = do_DELETE = _dispatch
+
+    # Route handlers
+
+    def _handle_health(self, match):
+        self._send_result(get_health())
+
+    def _handle_ready(self, match):
+        self._send_result(get_readiness())
+
+    def _handle_profile_report(self, match):
+        self._send_result(get_profile_report(self._query().get('sort', 'cumulative')))
+
+    def _handle_profile_start(self, match):
+        query = self._query()
+        self._send_result(start_profiling(query.get('mode', 'cprofile'), query.get('seconds', 30)))
+
+    def _handle_profile_reset(self, match):
+        self._send_result(reset_profiles())
+
+    def _handle_list(self, match):
+        query = self._query()
+        ids = query.get('ids')
+        if ids is not None:
+            self._send_result(get_transactions_by_ids(ids))
             return
-        path, transaction_id = self._parse_path()
-
-        if self.path.rstrip('/') == '/transactions/stats':
-            result = get_transaction_stats()
-            self._send_response(result)
-        elif transaction_id is not None:
-            result = get_transaction_by_id(transaction_id)
-            status = 404 if result.get('error_code') == 404 else 200
-            self._send_response(result, status)
-        elif path == '/transactions':
-            result = get_all_transactions()
-            self._send_response(result)
-        else:
-            self._send_error_response("Endpoint not found", 404)
+        result = get_all_transactions(query.get('type'), query.get('from'), query.get('to'),
+                                      query.get('sort'), query.get('limit'))
+        if 'chunks' in result:
+            self._send_chunked(result['chunks'], result['content_type'])
+            return
+        self._send_result(result)
 
-    def do_POST(self):
-        if not self._check_auth():
+    def _handle_export(self, match):
+        query = self._query()
+        result = export_transactions(query.get('format', 'csv'), query.get('type'),
+                                     query.get('from'), query.get('to'))
+        if result['status'] != 'success':
+            self._send_result(result)
             return
-        path, _ = self._parse_path()
-        if path != '/transactions':
-            self._send_error_response("Endpoint not found", 404)
+        self._send_chunked(result['chunks'], result['content_type'], headers={
+            'Content-Disposition': 'attachment; filename="{}"'.format(result['filename'])})
+
+    def _handle_lookup(self, match):
+        data, error = self._read_json_body()
+        if error:
+            self._send_error_response(error, 400)
             return
-        length = int(self.headers.get('Content-Length', 0))
-        if length == 0:
-            self._send_error_response("Request body required", 400)
+        if not isinstance(data, dict) or 'ids' not in data:
+            self._send_error_response("Body must be a JSON object with an 'ids' list", 400)
+            return
+        self._send_result(get_transactions_by_ids(data['ids']))
+
+    def _handle_stats(self, match):
+        approx = self._query().get('approx', '').lower() in ('1', 'true', 'yes')
+        self._send_result(get_transaction_stats(approx))
+
+    def _handle_counterparties(self, match):
+        query = self._query()
+        self._send_result(get_counterparty_stats(query.get('by', 'amount'), query.get('k', 10),
+                                                 query.get('type'), query.get('from'), query.get('to')))
+
+    def _handle_alerts(self, match):
+        query = self._query()
+        self._send_result(get_alerts(query.get('since', 0), query.get('rule'), query.get('id'),
+                                     query.get('limit', 100)))
+
+    def _handle_counterparty_search(self, match):
+        query = self._query()
+        self._send_result(search_counterparties(query.get('q'), query.get('limit', 10),
+                                                query.get('min_similarity')))
+
+    def _handle_ledger(self, match):
+        query = self._query()
+        self._send_result(get_ledger(query.get('from'), query.get('to'), query.get('limit', 100)))
+
+    def _handle_changes(self, match):
+        query = self._query()
+        last_event_id = self.headers.get('Last-Event-ID')
+        change_log = getattr(self.server, 'change_log', None)
+        tick = change_log.catch_up if change_log is not None else None
+
+        if not wants_stream(self.headers.get('Accept'), query.get('stream')):
+            self._send_result(poll_changes(query.get('since'), query.get('wait', 0), last_event_id, tick))
             return
+
+        seq, error = parse_since(query.get('since'), last_event_id)
+        if error:
+            self._send_result(error)
+            return
+        # No Content-Length: the stream ends when the connection closes
+        self._set_headers(200, 'text/event-stream',
+                          headers={'Cache-Control': 'no-cache', 'Connection': 'close'})
+        self._response_size = 0
         try:
-            body = self.rfile.read(length)
-            data = json.loads(body.decode())
-            result = create_transaction(data)
-            status = 400 if result.get('error_code') == 400 else 201
-            self._send_response(result, status)
-        except Exception as e:
-            self._send_error_response("Invalid JSON or server error: {}".format(str(e)), 400)
+            for chunk in stream_changes(seq, tick):
+                data = chunk.encode()
+                self.wfile.write(data)
+                self._response_size += len(data)
+        except OSError:
+            # Client went away
+            pass
 
-    def do_PUT(self):
-        if not self._check_auth():
+    def _handle_get(self, match):
+        self._send_result(get_transaction_by_id(int(match.group(1))))
+
+    def _handle_create(self, match):
+        data, error = self._read_json_body()
+        if error:
+            self._send_error_response(error, 400)
             return
-        path, transaction_id = self._parse_path()
-        if transaction_id is None:
-            self._send_error_response("Transaction ID required", 400)
+        try:
+            result, status, headers = run_idempotent(
+                self.headers.get('Idempotency-Key'), self._user, 'POST /transactions', data,
+                lambda: self._write('create', create_transaction, data), 201)
+        except Exception as e:
+            self._send_error_response("Invalid JSON or server error: {}".format(str(e)), 400)
             return
-        length = int(self.headers.get('Content-Length', 0))
-        if length == 0:
-            self._send_error_response("Request body required", 400)
+        self._send_response(result, status, headers)
+
+    def _handle_update(self, match):
+        data, error = self._read_json_body()
+        if error:
+            self._send_error_response(error, 400)
             return
         try:
-            body = self.rfile.read(length)
-            data = json.loads(body.decode())
-            result = update_transaction(transaction_id, data)
-            status = 404 if result.get('error_code') == 404 else 200
-            self._send_response(result, status)
+            result = self._write('update', update_transaction, int(match.group(1)), data)
         except Exception as e:
             self._send_error_response("Invalid JSON or server error: {}".format(str(e)), 400)
+            return
+        self._send_result(result)
 
-    def do_DELETE(self):
-        if not self._check_auth():
+    def _handle_delete(self, match):
+        self._send_result(self._write('delete', delete_transaction, int(match.group(1))))
+
+    def _handle_missing_id(self, match):
+        self._send_error_response("Transaction ID required", 400)
+
+    # Account (tenant) handlers
+
+    def _account(self):
+        """The user's partition, or None after sending the error"""
+        partition, error = partition_for(self._user)
+        if error:
+            self._send_result(error)
+        return partition
+
+    def _handle_account_list(self, match):
+        partition = self._account()
+        if partition is None:
+            return
+        query = self._query()
+        if query.get('ids') is not None:
+            self._send_result(partition.get_by_ids(query['ids']))
+            return
+        self._send_result(partition.get_all(query.get('type'), query.get('from'), query.get('to'),
+                                            query.get('sort'), query.get('limit')))
+
+    def _handle_account_stats(self, match):
+        partition = self._account()
+        if partition is not None:
+            self._send_result(partition.stats())
+
+    def _handle_account_counterparties(self, match):
+        partition = self._account()
+        if partition is None:
+            return
+        query = self._query()
+        self._send_result(partition.top_counterparties(query.get('by', 'amount'), query.get('k', 10),
+                                                       query.get('type'), query.get('from'), query.get('to')))
+
+    def _handle_account_ledger(self, match):
+        partition = self._account()
+        if partition is None:
+            return
+        query = self._query()
+        self._send_result(partition.ledger_summary(query.get('from'), query.get('to'),
+                                                   query.get('limit', 100)))
+
+    def _handle_account_get(self, match):
+        partition = self._account()
+        if partition is not None:
+            self._send_result(partition.get(int(match.group(1))))
+
+    def _handle_account_create(self, match):
+        data, error = self._read_json_body()
+        if error:
+            self._send_error_response(error, 400)
+            return
+        if not isinstance(data, dict):
+            self._send_error_response("Body must be a JSON object", 400)
+            return
+        partition = self._account()
+        if partition is not None:
+            result, status, headers = run_idempotent(
+                self.headers.get('Idempotency-Key'), self._user, 'POST /account/transactions', data,
+                lambda: partition.create(data), 201)
+            self._send_response(result, status, headers)
+
+    def _handle_account_update(self, match):
+        data, error = self._read_json_body()
+        if error:
+            self._send_error_response(error, 400)
+            return
+        if not isinstance(data, dict):
+            self._send_error_response("Body must be a JSON object", 400)
             return
-        path, transaction_id = self._parse_path()
-        if transaction_id is None:
-            self._send_error_response("Transaction ID required", 400)
+        partition = self._account()
+        if partition is not None:
+            self._send_result(partition.update(int(match.group(1)), data))
+
+    def _handle_account_delete(self, match):
+        partition = self._account()
+        if partition is not None:
+            self._send_result(partition.delete(int(match.group(1))))
+
+    def _handle_tenants(self, match):
+        self._send_result(tenant_store.stats())
+
+    def log_request(self, code='-', size='-'):
+        # Called from send_response; the record is written once the
+        # request has finished so it can carry the full duration
+        self._response_status = int(code) if isinstance(code, int) else code
+
+    def _log_access(self):
+        logger = get_access_logger()
+        if logger is None:
             return
-        result = delete_transaction(transaction_id)
-        status = 404 if result.get('error_code') == 404 else 200
-        self._send_response(result, status)
+        logger.log(build_record(
+            self.command,
+            self.path,
+            self._response_status,
+            time.perf_counter() - self._request_start,
+            remote_addr=self.client_address[0],
+            user=self._user,
+            size=self._response_size
+        ))
 
     def log_message(self, format, *args):
-        # Python 3.5 compatible logging
+        # Python 3.5 compatible logging (errors only, requests go to the access log)
         print("[{}] {}".format(self.log_date_time_string(), format % args))
 
 
-def run_server(host='localhost', port=8000):
-    server_address = (host, port)
-    httpd = HTTPServer(server_address, TransactionAPIHandler)
+class APIServer(ThreadingHTTPServer):
+    """Thread-per-connection server so keep-alive clients don't block each other"""
+
+    daemon_threads = True
+    request_queue_size = config.LISTEN_BACKLOG
+
+
+def create_server(host='localhost', port=8000):
+    """Build the HTTP server used by run_server (port 0 picks a free port)"""
+    return APIServer((host, port), TransactionAPIHandler)
+
+
+def run_server(host='localhost', port=8000, workers=1):
+    """
+    Serve the API
+
+    Args:
+        host (str): Interface to bind
+        port (int): Port to bind
+        workers (int): With more than 1, pre-fork that many worker processes
+            sharing the listening socket (POSIX only)
+    """
+    httpd = create_server(host, port)
     print("="*60)
     print("Mobile Money Transaction API Server")
     print("="*60)
     print("Server running on http://{}:{}".format(host, port))
     print("Press Ctrl+C to stop server")
+
+    if workers > 1:
+        if hasattr(os, 'fork'):
+            from prefork import serve_prefork
+            # Workers fork from the loaded store, so load it up front
+            load_transactions()
+            serve_prefork(httpd, workers)
+            print("\nServer stopped")
+            return
+        print("Pre-fork mode needs os.fork; serving in a single process")
+
+    # Answer /healthz and /readyz right away while the store loads
+    start_loading()
+
     try:
         httpd.serve_forever()
     except KeyboardInterrupt:
@@ -151,5 +644,11 @@ def run_server(host='localhost', port=8000):
 
 
 if __name__ == "__main__":
-    run_server()
+    parser = argparse.ArgumentParser(description="Mobile Money Transaction API Server")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of pre-forked worker processes")
+    args = parser.parse_args()
+    run_server(args.host, args.port, args.workers)
 
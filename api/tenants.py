@@ -0,0 +1,598 @@
+"""
+Multi-tenant Store
+One API process serving many subscribers, each with their own SMS backup
+(<TENANT_DATA_DIR>/<tenant>.xml). The tenant of a request comes from the
+authenticated user (TENANT_USERS maps users to accounts; by default the
+account is the user name).
+
+Each tenant's transactions live in their own partition with their own
+dictionary, ledger and counterparty index. A partition is parsed the
+first time its tenant is used and kept in an LRU cache; when the
+estimated size of the loaded partitions goes over TENANT_MEMORY_BUDGET_MB
+the least recently used ones are dropped and parsed again on their next
+request.
+
+Writes are appended to a per-tenant journal (<tenant>.changes.jsonl, the
+same entries as the pre-fork change log) and replayed on load, so
+evicting a partition never loses them. The journal is also tailed before
+every use, so pre-fork workers see each other's writes.
+"""
+
+import collections
+import itertools
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows: a single process, the partition lock is enough
+    fcntl = None
+
+import config
+import routes
+from dsa.parse_xml import parse_xml_file, TemplateCache
+from dsa.dict_lookup import build_transaction_dict, dict_lookup_many
+from dsa.ledger import Ledger
+from dsa.counterparties import CounterpartyIndex, METRICS
+from dsa.sorting import parse_sort, top_k
+from dsa.snapshot_list import SnapshotList
+from schema import validate_transaction
+
+# Tenant names become file names, so no separators or leading dots
+_TENANT_RE = re.compile(r"^[A-Za-z0-9_-][A-Za-z0-9_.-]{0,63}$")
+
+# Transactions sampled when estimating a partition's size
+SIZE_SAMPLE = 64
+# Dictionary, ledger and counterparty index on top of the transaction
+# dicts themselves (measured with tracemalloc on data/modified_sms_v2.xml)
+PARTITION_OVERHEAD = 1.7
+
+
+def tenant_for_user(user):
+    """
+    The account whose backup a user works with
+
+    Returns:
+        str: Tenant name, or None if the user can't be mapped to a valid one
+    """
+    tenant = config.TENANT_USERS.get(user, user)
+    if not tenant or not _TENANT_RE.match(tenant):
+        return None
+    return tenant
+
+
+def estimate_size(transactions, sample=SIZE_SAMPLE):
+    """
+    Approximate memory held by a partition, in bytes
+
+    Deep-sizes an evenly spaced sample of transactions and scales it up;
+    exact accounting would cost as much as the data itself.
+    """
+    count = len(transactions)
+    if not count:
+        return 0
+    step = max(1, count // sample)
+    sampled = transactions[::step]
+    per_transaction = sum(
+        sys.getsizeof(t) + sum(sys.getsizeof(v) for v in t.values()) for t in sampled
+    ) / len(sampled)
+    return int(count * per_transaction * PARTITION_OVERHEAD) + sys.getsizeof(transactions)
+
+
+class Partition:
+    """
+    One tenant's transactions, indexes and journal
+
+    Operations return the same response dicts as the routes functions.
+    Like the routes store, the list is a SnapshotList and stored dicts are
+    never changed in place, so reads don't take the partition lock.
+    """
+
+    def __init__(self, tenant, data_dir):
+        self.tenant = tenant
+        self.xml_file = os.path.join(data_dir, tenant + ".xml")
+        self.journal_path = os.path.join(data_dir, tenant + ".changes.jsonl")
+        self.transaction_versions = SnapshotList(key="id")
+        self.transactions_dict = {}
+        self.next_id = 1
+        self.ledger = Ledger()
+        self.counterparties = CounterpartyIndex()
+        self.size = 0
+        self.loaded_at = None
+        self.load_seconds = None
+        self.requests = 0
+        self._journal_offset = 0
+        self._lock = threading.RLock()
+
+    def load(self):
+        """Parse the tenant's backup (if there is one) and replay its journal"""
+        start = time.perf_counter()
+        transactions = []
+        if os.path.exists(self.xml_file):
+            transactions = parse_xml_file(self.xml_file, backend=config.XML_PARSER,
+                                          templates=TemplateCache(config.MAX_TEMPLATES))
+        with self._lock:
+            self.transaction_versions.reset(transactions)
+            self.transactions_dict = build_transaction_dict(transactions)
+            self.next_id = max(t['id'] for t in transactions) + 1 if transactions else 1
+            self.ledger.rebuild(transactions)
+            self.counterparties.rebuild(transactions)
+            self.size = estimate_size(transactions)
+            self._journal_offset = 0
+            self.catch_up()
+        self.loaded_at = time.time()
+        self.load_seconds = time.perf_counter() - start
+
+    # Journal
+
+    def catch_up(self):
+        """Apply journal entries written since the last call (e.g. by another worker)"""
+        try:
+            size = os.path.getsize(self.journal_path)
+        except OSError:
+            return 0
+        if size <= self._journal_offset:
+            return 0
+        with self._lock, open(self.journal_path, "rb") as journal:
+            journal.seek(self._journal_offset)
+            data = journal.read(size - self._journal_offset)
+            # A writer may be mid-append; leave an incomplete last line for later
+            complete = data.rfind(b"\n") + 1
+            self._journal_offset += complete
+            lines = [line for line in data[:complete].split(b"\n") if line]
+            for line in lines:
+                self._apply(json.loads(line.decode()))
+            return len(lines)
+
+    def _apply(self, entry):
+        op = entry["op"]
+        if op == "create":
+            data = dict(entry["data"])
+            data.pop("id", None)
+            self.next_id = entry["id"]
+            self._create(data)
+        elif op == "update":
+            self._update(entry["id"], entry["data"])
+        elif op == "delete":
+            self._delete(entry["id"])
+
+    def _write(self, op, fn, *args):
+        """Apply a write and append it to the journal, under the journal lock"""
+        os.makedirs(os.path.dirname(self.journal_path), exist_ok=True)
+        with self._lock, open(self.journal_path, "a+b") as journal:
+            if fcntl is not None:
+                fcntl.flock(journal.fileno(), fcntl.LOCK_EX)
+            try:
+                self.catch_up()
+                result = fn(*args)
+                if result.get("status") == "success":
+                    entry = {"op": op, "id": args[0] if op != "create" else result["data"]["id"]}
+                    if op == "create":
+                        entry["data"] = result["data"]
+                    elif op == "update":
+                        entry["data"] = args[1]
+                    journal.seek(0, os.SEEK_END)
+                    journal.write((json.dumps(entry, default=str) + "\n").encode())
+                    journal.flush()
+                    self._journal_offset = journal.tell()
+                return result
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(journal.fileno(), fcntl.LOCK_UN)
+
+    # Reads
+
+    def get_all(self, t_type=None, start=None, end=None, sort=None, limit=None):
+        """GET /account/transactions (sort and limit as for GET /transactions)"""
+        order = None
+        if sort not in (None, ""):
+            order, message = parse_sort(sort)
+            if message:
+                return {
+                    "status": "error",
+                    "message": message,
+                    "error_code": 400
+                }
+        limit, error = routes._parse_limit(limit)
+        if error:
+            return error
+        if not t_type and start in (None, "") and end in (None, "") and order is None and limit is None:
+            data = self.transaction_versions.current().items()
+        else:
+            bounds, error = routes._parse_window(start, end)
+            if error:
+                return error
+            with self.transaction_versions.pin() as transactions:
+                rows = routes.filter_transactions(transactions, t_type, *bounds)
+                if order is None:
+                    data = list(itertools.islice(rows, limit))
+                else:
+                    data = top_k(rows, order[0], order[1], limit)
+        return {
+            "status": "success",
+            "tenant": self.tenant,
+            "count": len(data),
+            "data": data
+        }
+
+    def get_by_ids(self, ids):
+        """GET /account/transactions?ids=1,5,9"""
+        parsed, error = routes.parse_id_list(ids)
+        if error:
+            return {
+                "status": "error",
+                "message": error,
+                "error_code": 400
+            }
+        found, missing = dict_lookup_many(self.transactions_dict, parsed)
+        return {
+            "status": "success",
+            "tenant": self.tenant,
+            "count": len(found),
+            "data": found,
+            "missing": missing
+        }
+
+    def get(self, transaction_id):
+        """GET /account/transactions/{id}"""
+        transaction = self.transactions_dict.get(transaction_id)
+        if transaction is None:
+            return _not_found(transaction_id)
+        return {
+            "status": "success",
+            "data": transaction
+        }
+
+    def stats(self):
+        """GET /account/transactions/stats"""
+        types = collections.Counter()
+        total_amount = 0
+        total_fees = 0
+        with self.transaction_versions.pin() as transactions:
+            for t in transactions:
+                types[t.get("type", "UNKNOWN")] += 1
+                total_amount += t.get("amount") or 0
+                total_fees += t.get("fee") or 0
+            count = len(transactions)
+        return {
+            "status": "success",
+            "tenant": self.tenant,
+            "data": {
+                "total_transactions": count,
+                "transaction_types": dict(types),
+                "total_amount": total_amount,
+                "total_fees": total_fees
+            }
+        }
+
+    def ledger_summary(self, start=None, end=None, limit=100):
+        """GET /account/transactions/ledger"""
+        bounds, error = routes._parse_window(start, end)
+        if error:
+            return error
+        try:
+            limit = int(limit)
+        except (TypeError, ValueError):
+            return {
+                "status": "error",
+                "message": "limit must be an integer",
+                "error_code": 400
+            }
+        with self._lock:
+            summary = self.ledger.summary(bounds[0], bounds[1], max(0, limit))
+        return {
+            "status": "success",
+            "tenant": self.tenant,
+            "data": summary
+        }
+
+    def top_counterparties(self, by="amount", k=10, t_type=None, start=None, end=None):
+        """GET /account/transactions/stats/counterparties"""
+        if by not in METRICS:
+            return {
+                "status": "error",
+                "message": "by must be 'amount' or 'count'",
+                "error_code": 400
+            }
+        try:
+            k = int(k)
+        except (TypeError, ValueError):
+            k = 0
+        if not 1 <= k <= config.MAX_TOP_K:
+            return {
+                "status": "error",
+                "message": f"k must be between 1 and {config.MAX_TOP_K}",
+                "error_code": 400
+            }
+        bounds, error = routes._parse_window(start, end)
+        if error:
+            return error
+        with self._lock:
+            top = self.counterparties.top(by, k, t_type or None, *bounds)
+        return {
+            "status": "success",
+            "tenant": self.tenant,
+            "by": by,
+            "count": len(top),
+            "data": top
+        }
+
+    # Writes
+
+    def create(self, new_transaction):
+        """POST /account/transactions"""
+        return self._write("create", self._create, new_transaction)
+
+    def update(self, transaction_id, updated_data):
+        """PUT /account/transactions/{id}"""
+        return self._write("update", self._update, transaction_id, updated_data)
+
+    def delete(self, transaction_id):
+        """DELETE /account/transactions/{id}"""
+        return self._write("delete", self._delete, transaction_id)
+
+    def _create(self, new_transaction):
+        new_transaction, error = validate_transaction(new_transaction)
+        if error:
+            return {
+                "status": "error",
+                "message": error,
+                "error_code": 400
+            }
+        new_transaction['id'] = self.next_id
+        self.next_id += 1
+
+        self.transaction_versions.append(new_transaction)
+        self.transactions_dict[new_transaction['id']] = new_transaction
+        self.ledger.add(new_transaction)
+        self.counterparties.add(new_transaction)
+        self.size += estimate_size([new_transaction], 1)
+        return {
+            "status": "success",
+            "message": "Transaction created successfully",
+            "data": new_transaction
+        }
+
+    def _update(self, transaction_id, updated_data):
+        updated_data, error = validate_transaction(updated_data, partial=True)
+        if error:
+            return {
+                "status": "error",
+                "message": error,
+                "error_code": 400
+            }
+        previous = self.transactions_dict.get(transaction_id)
+        if previous is None:
+            return _not_found(transaction_id)
+        # A copy: readers may still hold the previous dict
+        transaction = dict(previous)
+        transaction.update(updated_data)
+        self.transactions_dict[transaction_id] = transaction
+        self.transaction_versions.replace(transaction_id, transaction)
+        for index in (self.ledger, self.counterparties):
+            index.remove(previous)
+            index.add(transaction)
+        self.size = max(0, self.size + estimate_size([transaction], 1) - estimate_size([previous], 1))
+        return {
+            "status": "success",
+            "message": "Transaction updated successfully",
+            "data": transaction
+        }
+
+    def _delete(self, transaction_id):
+        transaction = self.transactions_dict.pop(transaction_id, None)
+        if transaction is None:
+            return _not_found(transaction_id)
+        self.transaction_versions.remove(transaction_id)
+        self.ledger.remove(transaction)
+        self.counterparties.remove(transaction)
+        self.size = max(0, self.size - estimate_size([transaction], 1))
+        return {
+            "status": "success",
+            "message": f"Transaction {transaction_id} deleted successfully",
+            "deleted_transaction": transaction
+        }
+
+    def info(self):
+        return {
+            "tenant": self.tenant,
+            "transactions": len(self.transaction_versions),
+            "estimated_bytes": self.size,
+            "file": self.xml_file if os.path.exists(self.xml_file) else None,
+            "loaded_at": self.loaded_at,
+            "load_seconds": round(self.load_seconds or 0, 4),
+            "requests": self.requests
+        }
+
+
+def _not_found(transaction_id):
+    return {
+        "status": "error",
+        "message": f"Transaction with ID {transaction_id} not found",
+        "error_code": 404
+    }
+
+
+class TenantStore:
+    """
+    LRU cache of tenant partitions under a memory budget
+
+    A tenant is loaded once even when several requests need it at the same
+    time; loading happens outside the cache lock, so other tenants are
+    served meanwhile.
+    """
+
+    def __init__(self, data_dir=None, budget_bytes=None):
+        self.data_dir = data_dir or config.TENANT_DATA_DIR
+        self.budget_bytes = budget_bytes if budget_bytes is not None else config.TENANT_MEMORY_BUDGET
+        self._partitions = collections.OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.loads = 0
+        self.evictions = 0
+
+    def get(self, tenant):
+        """
+        The tenant's partition, loading it on first use
+
+        Returns:
+            Partition: Up to date with the tenant's journal
+        """
+        with self._lock:
+            partition = self._partitions.get(tenant)
+            if partition is not None:
+                self._partitions.move_to_end(tenant)
+                self.hits += 1
+            else:
+                load_lock = self._loading.setdefault(tenant, threading.Lock())
+
+        if partition is None:
+            with load_lock:
+                with self._lock:
+                    partition = self._partitions.get(tenant)
+                if partition is None:
+                    partition = Partition(tenant, self.data_dir)
+                    partition.load()
+                    with self._lock:
+                        self._partitions[tenant] = partition
+                        self._loading.pop(tenant, None)
+                        self.loads += 1
+                        self._evict(keep=tenant)
+
+        partition.catch_up()
+        partition.requests += 1
+        return partition
+
+    def evict(self, tenant):
+        """Drop a tenant's partition (its writes are in the journal)"""
+        with self._lock:
+            if self._partitions.pop(tenant, None) is not None:
+                self.evictions += 1
+                return True
+            return False
+
+    def memory_used(self):
+        with self._lock:
+            return sum(p.size for p in self._partitions.values())
+
+    def _evict(self, keep):
+        # Oldest first; the partition just loaded stays even if it alone is over budget
+        used = sum(p.size for p in self._partitions.values())
+        while used > self.budget_bytes and len(self._partitions) > 1:
+            tenant, partition = next(iter(self._partitions.items()))
+            if tenant == keep:
+                self._partitions.move_to_end(tenant)
+                continue
+            del self._partitions[tenant]
+            used -= partition.size
+            self.evictions += 1
+
+    def stats(self):
+        """
+        GET /admin/tenants - Cache and per-tenant statistics
+
+        Returns:
+            dict: Loaded partitions, most recently used first
+        """
+        with self._lock:
+            partitions = [p.info() for p in reversed(self._partitions.values())]
+            requests = self.hits + self.loads
+            return {
+                "status": "success",
+                "data": {
+                    "data_dir": self.data_dir,
+                    "budget_bytes": self.budget_bytes,
+                    "used_bytes": sum(p["estimated_bytes"] for p in partitions),
+                    "loaded": len(partitions),
+                    "hits": self.hits,
+                    "loads": self.loads,
+                    "evictions": self.evictions,
+                    "hit_rate": round(self.hits / requests, 4) if requests else None,
+                    "tenants": partitions
+                }
+            }
+
+
+tenant_store = TenantStore()
+
+
+def partition_for(user):
+    """
+    The partition of an authenticated user
+
+    Returns:
+        tuple: (Partition, None) or (None, error response)
+    """
+    tenant = tenant_for_user(user)
+    if tenant is None:
+        return None, {
+            "status": "error",
+            "message": "No account is configured for this user",
+            "error_code": 403
+        }
+    try:
+        return tenant_store.get(tenant), None
+    except Exception as e:
+        return None, {
+            "status": "error",
+            "message": f"Could not load account {tenant}: {e}",
+            "error_code": 500
+        }
+
+
+# Test the tenant store
+if __name__ == "__main__":
+    import shutil
+    import tempfile
+
+    print("Tenant Store Test")
+    print("=" * 50)
+
+    data_dir = tempfile.mkdtemp(prefix="momo-tenants-")
+    try:
+        for name in ("alice", "bob", "carol"):
+            shutil.copy(config.DATA_FILE, os.path.join(data_dir, name + ".xml"))
+
+        one = Partition("alice", data_dir)
+        one.load()
+        # Room for two backups
+        store = TenantStore(data_dir, budget_bytes=int(one.size * 2.5))
+        print(f"One backup: {len(one.transaction_versions)} transactions, ~{one.size / 1e6:.1f} MB")
+
+        for name in ("alice", "bob", "alice", "carol", "bob"):
+            start = time.perf_counter()
+            partition = store.get(name)
+            print(f"  get({name}): {(time.perf_counter() - start) * 1000:.1f} ms")
+        stats = store.stats()["data"]
+        print(f"Loaded: {[t['tenant'] for t in stats['tenants']]}, hits: {stats['hits']}, "
+              f"loads: {stats['loads']}, evictions: {stats['evictions']}")
+
+        # Writes survive eviction through the journal
+        created = store.get("alice").create({"transaction_type": "payment", "amount": 700})
+        store.get("alice").update(created["data"]["id"], {"amount": 750})
+        store.get("alice").delete(1)
+        store.evict("alice")
+        alice = store.get("alice")
+        assert alice.get(created["data"]["id"])["data"]["amount"] == 750
+        assert alice.get(1)["status"] == "error"
+        assert store.get("bob").get(1)["status"] == "success"
+        print(f"\n✓ Writes replayed after eviction ({len(alice.transaction_versions)} transactions for alice)")
+
+        # A listing taken before writes doesn't change under its reader
+        listing = alice.get_all()["data"]
+        before = [dict(t) for t in listing]
+        size = alice.size
+        alice.update(created["data"]["id"], {"raw_text": "x" * 2000})
+        alice.delete(2)
+        alice.create({"transaction_type": "payment", "amount": 1})
+        assert [dict(t) for t in listing] == before
+        assert alice.size > size
+        assert alice.get_all()["count"] == len(before)
+        print(f"✓ Earlier listing unchanged by writes; estimated size {size} -> {alice.size} bytes")
+    finally:
+        shutil.rmtree(data_dir)
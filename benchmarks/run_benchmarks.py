@@ -0,0 +1,461 @@
+"""
+Benchmark Suite for the API and DSA layers
+Generates synthetic SMS backups at the requested scales, then times XML
+parsing, load-to-ready, CRUD operations against the routes functions and
+end-to-end HTTP throughput/latency for server.py and app.py.
+
+Every measurement uses time.perf_counter with warmup and repeated runs.
+Results are written as JSON so two runs can be compared with --compare.
+
+Usage:
+    python benchmarks/run_benchmarks.py --scales 10000 100000 -o results.json
+    python benchmarks/run_benchmarks.py --scales 10000 --compare results.json
+"""
+
+import argparse
+import base64
+import datetime
+import http.client
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "api"))
+
+import config
+
+# Benchmarks must not pay for (or be slowed by) access logging, and the
+# load generator would trip the per-user rate limits
+config.ACCESS_LOG_SINK = "off"
+config.RATE_LIMIT_ENABLED = False
+
+from dsa.parse_xml import parse_xml_file, TemplateCache
+from dsa.xml_backends import available_backends, iter_records
+from dsa.generate_sms import write_sms_backup, default_model
+import routes
+from schema import validate_transaction
+
+AUTH_HEADER = "Basic " + base64.b64encode(b"admin:password123").decode()
+
+
+def summarize(times):
+    """Summary statistics (seconds) for a list of timings"""
+    return {
+        "runs": len(times),
+        "min_s": min(times),
+        "median_s": statistics.median(times),
+        "mean_s": statistics.mean(times),
+        "stdev_s": statistics.stdev(times) if len(times) > 1 else 0.0
+    }
+
+
+def measure(fn, repeat=5, warmup=1):
+    """
+    Time fn() with warmup runs and repeated measured runs
+
+    Args:
+        fn (callable): Function to time; may do its own setup per call
+        repeat (int): Number of measured runs
+        warmup (int): Number of unmeasured runs first
+
+    Returns:
+        dict: Summary statistics of the measured runs
+    """
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return summarize(times)
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(pct / 100.0 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def dataset_path(data_dir, scale, seed):
+    """Generate (or reuse) a synthetic backup with `scale` messages"""
+    path = os.path.join(data_dir, "synthetic_{}_{}.xml".format(scale, seed))
+    if not os.path.exists(path):
+        print("  generating {} messages -> {}".format(scale, path))
+        write_sms_backup(path, scale, seed, default_model())
+    return path
+
+
+def load_store(transactions):
+    """Install a parsed transaction list as the routes store"""
+    routes.install_transactions(transactions)
+
+
+def bench_parse(xml_file, scale, args, max_templates=None):
+    """Parse throughput; max_templates=0 runs the extraction rules on every message"""
+    if max_templates is None:
+        max_templates = config.MAX_TEMPLATES
+    templates = []
+
+    def parse():
+        templates.append(TemplateCache(max_templates))
+        parse_xml_file(xml_file, backend=config.XML_PARSER, templates=templates[-1])
+
+    result = measure(parse, args.repeat, args.warmup)
+    result["messages_per_s"] = scale / result["median_s"]
+    result["template_hit_rate"] = templates[-1].stats()["hit_rate"]
+    return result
+
+
+def bench_xml_backends(xml_file, scale, args):
+    """Reading the (body, readable_date, date) records only, with each backend that can run here"""
+    def read(backend):
+        for _ in iter_records(xml_file, backend):
+            pass
+
+    results = {}
+    for backend in available_backends():
+        result = measure(lambda: read(backend), args.repeat, args.warmup)
+        result["messages_per_s"] = scale / result["median_s"]
+        results[backend] = result
+    return results
+
+
+def bench_load_to_ready(xml_file, scale, args):
+    result = measure(lambda: load_store(parse_xml_file(xml_file)), args.repeat, args.warmup)
+    result["messages_per_s"] = scale / result["median_s"]
+    return result
+
+
+def bench_crud(scale, args):
+    """Operations per second for each routes CRUD function"""
+    rng = random.Random(args.seed)
+    n = args.crud_ops
+    ids = [rng.randint(1, scale) for _ in range(n)]
+    results = {}
+
+    def read():
+        for i in ids:
+            routes.get_transaction_by_id(i)
+
+    def create():
+        start = time.perf_counter()
+        created = [routes.create_transaction({"transaction_type": "PAYMENT", "amount": 5000})["data"]["id"]
+                   for _ in range(n)]
+        elapsed = time.perf_counter() - start
+        # Keep the store the same size across runs (untimed); deleting through
+        # the API keeps the indexes and write listeners in step
+        for i in created:
+            routes.delete_transaction(i)
+        return elapsed
+
+    def update():
+        for i in ids:
+            routes.update_transaction(i, {"amount": 6000})
+
+    # Schema validation of one POST body, on its own (it is part of create)
+    payload = {"transaction_type": "PAYMENT", "amount": 5000, "recipient": "John Doe"}
+
+    def validate():
+        for _ in range(n):
+            validate_transaction(payload)
+
+    def delete():
+        created = [routes.create_transaction({"transaction_type": "PAYMENT", "amount": 1})["data"]["id"]
+                   for _ in range(args.delete_ops)]
+        start = time.perf_counter()
+        for i in created:
+            routes.delete_transaction(i)
+        return time.perf_counter() - start
+
+    # create and delete return the time of their measured part only
+    for name, fn, count, self_timed in (("get_by_id", read, n, False), ("create", create, n, True),
+                                        ("update", update, n, False), ("validate", validate, n, False),
+                                        ("delete", delete, args.delete_ops, True)):
+        if self_timed:
+            for _ in range(args.warmup):
+                fn()
+            summary = summarize([fn() for _ in range(args.repeat)])
+        else:
+            summary = measure(fn, args.repeat, args.warmup)
+        summary["ops"] = count
+        summary["ops_per_s"] = count / summary["median_s"]
+        results[name] = summary
+
+    # Deletes don't take transactions back out of the ingest stages (the
+    # anomaly detector keeps what it has seen), so reinstall the store to
+    # leave every index and stage matching it for the HTTP runs
+    load_store(list(routes.current_transactions()))
+    return results
+
+
+def start_stdlib_server():
+    import server
+    httpd = server.create_server("127.0.0.1", 0)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+
+    def stop():
+        httpd.shutdown()
+        httpd.server_close()
+    return httpd.server_address[1], stop
+
+
+def start_flask_server():
+    try:
+        from werkzeug.serving import make_server
+        import app as flask_app
+    except ImportError:
+        return None, None
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    httpd = make_server("127.0.0.1", 0, flask_app.app, threaded=True)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+
+    def stop():
+        httpd.shutdown()
+        httpd.server_close()
+    return httpd.server_port, stop
+
+
+def http_load(port, make_request, total, concurrency):
+    """
+    Fire `total` requests from `concurrency` client threads
+
+    Args:
+        port (int): Server port on 127.0.0.1
+        make_request (callable): rng -> (method, path, body)
+        total (int): Total number of requests
+        concurrency (int): Number of client threads
+
+    Returns:
+        dict: Throughput and latency percentiles
+    """
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    per_thread = total // concurrency
+
+    def worker(seed):
+        rng = random.Random(seed)
+        local = []
+        conn = None
+        for _ in range(per_thread):
+            method, path, body = make_request(rng)
+            headers = {"Authorization": AUTH_HEADER}
+            if body is not None:
+                headers["Content-Type"] = "application/json"
+            start = time.perf_counter()
+            try:
+                if conn is None:
+                    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+                conn.request(method, path, body=body, headers=headers)
+                resp = conn.getresponse()
+                resp.read()
+                if resp.will_close:
+                    conn.close()
+                    conn = None
+                if resp.status >= 500:
+                    with lock:
+                        errors[0] += 1
+            except (OSError, http.client.HTTPException):
+                conn = None
+                with lock:
+                    errors[0] += 1
+            local.append(time.perf_counter() - start)
+        if conn is not None:
+            conn.close()
+        with lock:
+            latencies.extend(local)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "concurrency": concurrency,
+        "errors": errors[0],
+        "wall_s": wall,
+        "requests_per_s": len(latencies) / wall if wall else None,
+        "latency_ms": {
+            "p50": percentile(latencies, 50) * 1000,
+            "p90": percentile(latencies, 90) * 1000,
+            "p99": percentile(latencies, 99) * 1000,
+            "max": latencies[-1] * 1000
+        }
+    }
+
+
+def bench_http(scale, args):
+    """End-to-end HTTP benchmarks against both servers"""
+    scenarios = {
+        "get_by_id": lambda rng: ("GET", "/transactions/{}".format(rng.randint(1, scale)), None),
+        "create": lambda rng: ("POST", "/transactions",
+                               json.dumps({"transaction_type": "PAYMENT", "amount": rng.randint(1, 9999)})),
+    }
+    results = {}
+
+    for server_name, starter in (("server.py", start_stdlib_server), ("app.py", start_flask_server)):
+        port, stop = starter()
+        if port is None:
+            print("  {}: skipped (Flask not installed)".format(server_name))
+            continue
+        try:
+            for scenario, make_request in scenarios.items():
+                # Warmup, then keep the best-throughput run of the repeats
+                http_load(port, make_request, max(args.concurrency, args.http_requests // 10), args.concurrency)
+                runs = [http_load(port, make_request, args.http_requests, args.concurrency)
+                        for _ in range(args.repeat)]
+                best = max(runs, key=lambda r: r["requests_per_s"])
+                best["runs_requests_per_s"] = [r["requests_per_s"] for r in runs]
+                results["{} {}".format(server_name, scenario)] = best
+        finally:
+            stop()
+    return results
+
+
+def flatten(results):
+    """Map 'scale/benchmark/metric' -> value for the headline metrics"""
+    flat = {}
+    for scale, benches in results.items():
+        for name, value in benches.items():
+            if "messages_per_s" in value:
+                flat["{}/{}".format(scale, name)] = value["messages_per_s"]
+            elif name in ("crud", "http"):
+                for sub, sub_value in value.items():
+                    key = "{}/{}/{}".format(scale, name, sub)
+                    flat[key] = sub_value.get("ops_per_s", sub_value.get("requests_per_s"))
+            elif name == "xml_backends":
+                for sub, sub_value in value.items():
+                    flat["{}/{}/{}".format(scale, name, sub)] = sub_value["messages_per_s"]
+    return flat
+
+
+def compare(current, baseline_file, threshold):
+    """Print throughput changes against a previous results file"""
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+    old = flatten(baseline["results"])
+    new = flatten(current["results"])
+
+    print("\n" + "=" * 78)
+    print("{:<50} {:>12} {:>12}".format("Benchmark (higher is better)", "Baseline", "Change"))
+    print("=" * 78)
+    regressions = 0
+    for key in sorted(new):
+        if key not in old or not old[key]:
+            continue
+        change = (new[key] - old[key]) / old[key] * 100
+        flag = ""
+        if change < -threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        print("{:<50} {:>12.1f} {:>+11.1f}%{}".format(key, old[key], change, flag))
+    print("=" * 78)
+    return regressions
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the MoMo SMS API and DSA layers")
+    parser.add_argument("--scales", type=int, nargs="+", default=[10000],
+                        help="Synthetic backup sizes in messages (e.g. 10000 1000000)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--repeat", type=int, default=5, help="Measured runs per benchmark")
+    parser.add_argument("--warmup", type=int, default=1, help="Warmup runs per benchmark")
+    parser.add_argument("--crud-ops", type=int, default=1000)
+    parser.add_argument("--delete-ops", type=int, default=100)
+    parser.add_argument("--http-requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--skip-http", action="store_true")
+    parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "momo_bench"))
+    parser.add_argument("-o", "--output", default="bench_results.json")
+    parser.add_argument("--compare", help="Previous results file to compare against")
+    parser.add_argument("--threshold", type=float, default=10.0,
+                        help="Percent throughput drop reported as a regression")
+    args = parser.parse_args()
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    output = {
+        "meta": {
+            "timestamp": datetime.datetime.utcnow().isoformat() + "Z",
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "args": vars(args)
+        },
+        "results": {}
+    }
+
+    for scale in args.scales:
+        print("=" * 60)
+        print("Scale: {} messages".format(scale))
+        print("=" * 60)
+        xml_file = dataset_path(args.data_dir, scale, args.seed)
+        results = output["results"][str(scale)] = {}
+
+        results["parse"] = bench_parse(xml_file, scale, args)
+        print("  parse:         {:>12.0f} msg/s (template hit rate {:.1%})".format(
+            results["parse"]["messages_per_s"], results["parse"]["template_hit_rate"] or 0))
+
+        results["parse_no_templates"] = bench_parse(xml_file, scale, args, max_templates=0)
+        print("  parse, no templates: {:>6.0f} msg/s".format(results["parse_no_templates"]["messages_per_s"]))
+
+        results["xml_backends"] = bench_xml_backends(xml_file, scale, args)
+        for name, value in results["xml_backends"].items():
+            print("  xml {:<11} {:>12.0f} msg/s".format(name + ":", value["messages_per_s"]))
+
+        results["load_to_ready"] = bench_load_to_ready(xml_file, scale, args)
+        print("  load-to-ready: {:>12.0f} msg/s ({:.3f}s)".format(
+            results["load_to_ready"]["messages_per_s"], results["load_to_ready"]["median_s"]))
+
+        results["crud"] = bench_crud(scale, args)
+        for name, value in results["crud"].items():
+            print("  crud {:<10} {:>12.0f} ops/s".format(name + ":", value["ops_per_s"]))
+
+        if not args.skip_http:
+            results["http"] = bench_http(scale, args)
+            for name, value in results["http"].items():
+                print("  http {:<22} {:>9.0f} req/s  p50 {:.2f}ms  p99 {:.2f}ms".format(
+                    name + ":", value["requests_per_s"],
+                    value["latency_ms"]["p50"], value["latency_ms"]["p99"]))
+
+    with open(args.output, "w") as f:
+        json.dump(output, f, indent=2)
+    print("\n✓ Results written to {}".format(args.output))
+
+    if args.compare:
+        regressions = compare(output, args.compare, args.threshold)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
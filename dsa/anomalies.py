@@ -0,0 +1,317 @@
+"""
+Streaming Anomaly Detection
+Flags unusual transactions as they arrive, without looking back at
+history:
+  - velocity: a burst of outgoing transactions (more than `burst` within
+    `window` seconds) to one counterparty, or of one type
+  - amount: an amount far above what a counterparty (or a type) usually
+    moves, measured in standard deviations from a rolling mean
+
+Each counterparty and each type keeps a few numbers: the times of its last
+`burst + 1` outgoing transactions and an exponentially weighted mean and
+variance of its amounts (Welford's update until `half_life` transactions
+have been seen, then each new amount weighs 1 / half_life). Every event is
+O(1). Counterparties idle for `idle` seconds are forgotten, oldest first,
+so memory follows the active counterparties rather than all of history.
+"""
+
+import math
+import time
+from collections import OrderedDict, deque
+
+try:
+    from dsa.counterparties import counterparty, transaction_type
+    from dsa.ledger import DEBIT_TYPES, ledger_time
+except ImportError:
+    from counterparties import counterparty, transaction_type
+    from ledger import DEBIT_TYPES, ledger_time
+
+RULES = ("velocity", "amount")
+
+
+class _Stats:
+    """Velocity window and rolling amount statistics of one counterparty or type"""
+
+    __slots__ = ("times", "in_burst", "count", "mean", "variance", "last_seen")
+
+    def __init__(self, burst):
+        self.times = deque(maxlen=burst + 1)
+        self.in_burst = False
+        self.count = 0
+        self.mean = 0.0
+        self.variance = 0.0
+        self.last_seen = 0
+
+
+class AnomalyDetector:
+    """
+    Velocity and amount alerts, computed per event
+
+    Not thread-safe; the routes store calls it under its write lock.
+    """
+
+    def __init__(self, window=600, burst=5, type_burst=20, threshold=4.0, min_history=10,
+                 half_life=50, idle=30 * 86400, max_tracked=100000, max_alerts=10000):
+        """
+        Args:
+            window (float): Velocity window in seconds
+            burst (int): Most outgoing transactions to one counterparty per window
+            type_burst (int): Most outgoing transactions of one type per window
+            threshold (float): Standard deviations above the mean that count as unusual
+            min_history (int): Amounts seen before a counterparty's mean is trusted
+            half_life (int): Transactions after which old amounts start to fade
+            idle (float): Seconds without transactions before a counterparty is forgotten
+            max_tracked (int): Most counterparties and types tracked at once
+            max_alerts (int): Alerts kept for GET /transactions/alerts
+        """
+        self.window_ms = int(window * 1000)
+        self.burst = burst
+        self.type_burst = type_burst
+        self.threshold = threshold
+        self.min_history = min_history
+        self.alpha = 1.0 / half_life
+        self.idle_ms = int(idle * 1000)
+        self.max_tracked = max_tracked
+        self.max_alerts = max_alerts
+        self.reset()
+
+    def reset(self):
+        """Forget all state and alerts (before the store is reloaded)"""
+        # ("counterparty" | "type", key) -> _Stats, least recently seen first
+        self._tracked = OrderedDict()
+        self._alerts = deque(maxlen=self.max_alerts)
+        self._seq = 0
+        self._now = 0
+        self.observed = 0
+        self.expired = 0
+
+    def __len__(self):
+        return len(self._tracked)
+
+    def _stats(self, scope, key, now):
+        stats = self._tracked.get((scope, key))
+        if stats is None:
+            stats = self._tracked[(scope, key)] = _Stats(self.burst if scope == "counterparty" else self.type_burst)
+        else:
+            self._tracked.move_to_end((scope, key))
+        stats.last_seen = now
+        return stats
+
+    def _expire(self):
+        # Oldest first: stop at the first one still active
+        tracked = self._tracked
+        cutoff = self._now - self.idle_ms
+        while tracked:
+            stats = next(iter(tracked.values()))
+            if stats.last_seen >= cutoff and len(tracked) <= self.max_tracked:
+                break
+            tracked.popitem(last=False)
+            self.expired += 1
+
+    def _alert(self, rule, scope, key, transaction, now, **detail):
+        self._seq += 1
+        alert = {
+            "seq": self._seq,
+            "rule": rule,
+            "scope": scope,
+            "key": key,
+            "transaction_id": transaction.get("id"),
+            "time": now,
+            **detail
+        }
+        self._alerts.append(alert)
+        return alert
+
+    def _check_velocity(self, stats, scope, key, limit, transaction, now):
+        times = stats.times
+        times.append(now)
+        # times holds the last limit + 1 events: a full deque spanning less
+        # than the window means more than `limit` in one window
+        if len(times) > limit and now - times[0] <= self.window_ms:
+            if not stats.in_burst:
+                # One alert per burst, not one per transaction in it
+                stats.in_burst = True
+                return self._alert("velocity", scope, key, transaction, now,
+                                   count=len(times), window_seconds=self.window_ms / 1000)
+        else:
+            stats.in_burst = False
+        return None
+
+    def _check_amount(self, stats, scope, key, amount, transaction, now):
+        alert = None
+        if stats.count >= self.min_history:
+            # Spread of at least 10% of the mean, so a counterparty that
+            # always pays exactly the same isn't flagged for one franc more
+            spread = max(math.sqrt(stats.variance), 0.1 * abs(stats.mean), 1.0)
+            score = (amount - stats.mean) / spread
+            if score > self.threshold:
+                alert = self._alert("amount", scope, key, transaction, now, amount=amount,
+                                    mean=round(stats.mean, 2), std=round(math.sqrt(stats.variance), 2),
+                                    score=round(score, 2))
+        # Rolling mean/variance: exact (Welford) for the first half_life
+        # amounts, then exponentially weighted
+        stats.count += 1
+        weight = max(self.alpha, 1.0 / stats.count)
+        diff = amount - stats.mean
+        step = weight * diff
+        stats.mean += step
+        stats.variance = (1 - weight) * (stats.variance + diff * step)
+        return alert
+
+    def observe(self, transaction):
+        """
+        Update the statistics with a new transaction and check it
+
+        Args:
+            transaction (dict): Parsed or API-created transaction; its time is
+                `date` (epoch ms or ISO), or now if it has none
+
+        Returns:
+            list: Alerts raised by this transaction (usually empty)
+        """
+        self.observed += 1
+        now = ledger_time(transaction)
+        if now is None:
+            now = int(time.time() * 1000)
+        # Windows only move forward: an older message counts as arriving now
+        now = max(now, self._now)
+        self._now = now
+
+        t_type = transaction_type(transaction)
+        name = counterparty(transaction)
+        amount = transaction.get("amount")
+        if isinstance(amount, bool) or not isinstance(amount, (int, float)):
+            amount = None
+        outgoing = t_type in DEBIT_TYPES
+
+        alerts = []
+        scopes = [("type", t_type, self.type_burst)]
+        if name is not None:
+            scopes.append(("counterparty", name, self.burst))
+        for scope, key, limit in scopes:
+            stats = self._stats(scope, key, now)
+            if outgoing:
+                alert = self._check_velocity(stats, scope, key, limit, transaction, now)
+                if alert:
+                    alerts.append(alert)
+            if amount is not None:
+                alert = self._check_amount(stats, scope, key, amount, transaction, now)
+                if alert:
+                    alerts.append(alert)
+        self._expire()
+        return alerts
+
+    def alerts(self, since=0, rule=None, transaction_id=None, limit=100):
+        """
+        Alerts with a sequence number above since, oldest first
+
+        Args:
+            since (int): Last sequence number already seen
+            rule (str): Only 'velocity' or 'amount' alerts
+            transaction_id (int): Only alerts raised by this transaction
+            limit (int): Most alerts to return
+
+        Returns:
+            list: Alert dictionaries
+        """
+        result = []
+        for alert in self._alerts:
+            if alert["seq"] <= since:
+                continue
+            if rule is not None and alert["rule"] != rule:
+                continue
+            if transaction_id is not None and alert["transaction_id"] != transaction_id:
+                continue
+            result.append(alert)
+            if len(result) >= limit:
+                break
+        return result
+
+    def stats(self):
+        """Counters for the alerts endpoint"""
+        return {
+            "observed": self.observed,
+            "tracked": len(self._tracked),
+            "expired": self.expired,
+            "alerts_raised": self._seq,
+            "alerts_kept": len(self._alerts),
+            "last_seq": self._seq
+        }
+
+
+# Test the anomaly detector
+if __name__ == "__main__":
+    import random
+    import sys
+
+    print("Anomaly Detector Test")
+    print("=" * 50)
+
+    minute = 60 * 1000
+    detector = AnomalyDetector(window=600, burst=3, type_burst=100, min_history=5, idle=3600)
+    start = 1715351458724
+
+    # Five transfers to one person in four minutes: one velocity alert
+    alerts = []
+    for i in range(5):
+        alerts += detector.observe({"id": i + 1, "type": "sent", "amount": 1000, "receiver": "Jane Smith",
+                                    "date": start + i * minute})
+    assert [a["rule"] for a in alerts] == ["velocity"] and alerts[0]["transaction_id"] == 4, alerts
+    print(f"Burst: {alerts}")
+
+    # Spread out: no alert
+    for i in range(5):
+        assert not detector.observe({"id": 10 + i, "type": "sent", "amount": 1000, "receiver": "alex doe",
+                                     "date": start + (10 + 20 * i) * minute})
+
+    # A usual amount, then one far above it
+    for i in range(20):
+        assert not detector.observe({"id": 20 + i, "type": "received", "amount": 5000 + 100 * (i % 3),
+                                     "sender": "samuel carter", "date": start + (200 + i * 30) * minute})
+    alerts = detector.observe({"id": 99, "type": "received", "amount": 50000, "sender": "samuel carter",
+                               "date": start + 900 * minute})
+    assert sorted(a["scope"] for a in alerts if a["rule"] == "amount") == ["counterparty", "type"], alerts
+    print(f"Large amount: {alerts}")
+
+    # Counterparties idle for an hour are forgotten
+    detector.observe({"id": 100, "type": "sent", "amount": 1, "receiver": "someone", "date": start + 2000 * minute})
+    assert ("counterparty", "jane smith") not in detector._tracked
+    print(f"Stats: {detector.stats()}")
+
+    # Rolling mean and variance match a direct computation over the first half_life amounts
+    detector = AnomalyDetector(half_life=1000)
+    rng = random.Random(7)
+    amounts = [rng.randint(100, 10000) for _ in range(500)]
+    for i, amount in enumerate(amounts):
+        detector.observe({"id": i, "type": "deposit", "amount": amount, "date": start})
+    stats = detector._tracked[("type", "deposit")]
+    mean = sum(amounts) / len(amounts)
+    variance = sum((a - mean) ** 2 for a in amounts) / len(amounts)
+    assert abs(stats.mean - mean) < 1e-6 and abs(stats.variance - variance) < 1e-3 * variance
+    print(f"Welford: mean {stats.mean:.1f} (exact {mean:.1f}), variance {stats.variance:.0f} (exact {variance:.0f})")
+
+    # Memory stays bounded with many one-off counterparties
+    detector = AnomalyDetector(idle=3600, max_tracked=5000)
+    begin = time.perf_counter()
+    events = 200000
+    for i in range(events):
+        detector.observe({"id": i, "type": "sent", "amount": rng.randint(100, 100000),
+                          "receiver": f"person {rng.randrange(1000000)}", "date": start + i * 1000})
+    elapsed = time.perf_counter() - begin
+    assert len(detector) <= 5000
+    print(f"{events} events in {elapsed:.2f}s ({events / elapsed:.0f}/s), tracking {len(detector)}, "
+          f"expired {detector.expired}, alerts {detector.stats()['alerts_raised']}")
+
+    if len(sys.argv) > 1:
+        try:
+            from dsa.parse_xml import parse_xml_file
+        except ImportError:
+            from parse_xml import parse_xml_file
+        detector = AnomalyDetector()
+        for transaction in parse_xml_file(sys.argv[1]):
+            detector.observe(transaction)
+        print(f"\n{sys.argv[1]}: {detector.stats()}")
+        for alert in detector.alerts(limit=10):
+            print(f"  {alert}")
+
+    print("\n✓ Anomaly detector checks passed")
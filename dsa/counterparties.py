@@ -0,0 +1,285 @@
+"""
+Counterparty Aggregates
+Keeps a running count and total amount per counterparty (who we pay or
+receive from), updated on every write, so "top 10 counterparties by
+amount" doesn't group the whole transaction list on every request.
+
+Top-k uses a heap with lazy invalidation: every change pushes the new
+value, and stale entries are only thrown away when a query meets them.
+Updates are O(log n); a query is O(k log n) plus the stale entries it
+discards (each is discarded once).
+
+Time-window queries use an ordered (time, id) index and only visit the
+transactions inside the window.
+"""
+
+import heapq
+
+try:
+    from dsa.sorted_index import SortedIndex
+    from dsa.ledger import ledger_time
+except ImportError:
+    from sorted_index import SortedIndex
+    from ledger import ledger_time
+
+METRICS = ("amount", "count")
+
+
+class LazyTopK:
+    """Largest values of a changing key -> value mapping"""
+
+    def __init__(self):
+        self._values = {}
+        self._heap = []
+
+    def __len__(self):
+        return len(self._values)
+
+    def rebuild(self, values):
+        """Replace all values at once - O(n)"""
+        self._values = {key: value for key, value in values.items() if value}
+        self._heap = [(-value, key) for key, value in self._values.items()]
+        heapq.heapify(self._heap)
+
+    def set(self, key, value):
+        """Set the value of key (0 or None removes it) - O(log n)"""
+        if value:
+            self._values[key] = value
+            heapq.heappush(self._heap, (-value, key))
+        else:
+            self._values.pop(key, None)
+        # Too many stale entries: rebuild from the live values
+        if len(self._heap) > 2 * len(self._values) + 64:
+            self.rebuild(self._values)
+
+    def top(self, k):
+        """
+        The k keys with the largest values
+
+        Returns:
+            list: (key, value) pairs, largest first (ties by key)
+        """
+        heap = self._heap
+        result = []
+        kept = []
+        seen = set()
+        while heap and len(result) < k:
+            entry = heapq.heappop(heap)
+            key = entry[1]
+            if key in seen or self._values.get(key) != -entry[0]:
+                continue  # stale or duplicate: drop it for good
+            seen.add(key)
+            kept.append(entry)
+            result.append((key, -entry[0]))
+        for entry in kept:
+            heapq.heappush(heap, entry)
+        return result
+
+
+def transaction_type(transaction):
+    """Lower-case type of a parsed or API-created transaction"""
+    return str(transaction.get("type", transaction.get("transaction_type")) or "unknown").lower()
+
+
+def normalize_name(value):
+    """
+    Lower-case a name and collapse its whitespace
+
+    Returns:
+        str: The name, or None for non-strings, blanks and "self" (our side)
+    """
+    if not isinstance(value, str):
+        return None
+    name = " ".join(value.lower().split())
+    return name if name and name != "self" else None
+
+
+def counterparty(transaction):
+    """
+    The other party of a transaction
+
+    Parsed SMS have sender/receiver with "self" on our side; API-created
+    transactions use recipient/sender.
+
+    Returns:
+        str: Normalised (lower-case) name, or None if there isn't one
+    """
+    for field in ("receiver", "recipient", "sender"):
+        name = normalize_name(transaction.get(field))
+        if name is not None:
+            return name
+    return None
+
+
+def _amount(transaction):
+    amount = transaction.get("amount")
+    if isinstance(amount, bool) or not isinstance(amount, (int, float)):
+        return 0
+    return amount
+
+
+class CounterpartyIndex:
+    """
+    Per-counterparty count and amount, overall and per transaction type
+
+    Has the rebuild/add/remove interface of the routes store indexes.
+    Not thread-safe; top() reorganises the heaps, so callers hold the
+    store's write lock for queries too.
+    """
+
+    def __init__(self):
+        self.rebuild([])
+
+    def rebuild(self, transactions):
+        """Replace the aggregates with those of a transaction list"""
+        # scope (None = all types, else a type) -> name -> [count, amount]
+        self._totals = {}
+        self._top = {}
+        entries = []
+        for transaction in transactions:
+            entry = self._entry(transaction)
+            if entry is None:
+                continue
+            name, t_type, amount, key = entry
+            for scope in (None, t_type):
+                total = self._totals.setdefault(scope, {}).setdefault(name, [0, 0])
+                total[0] += 1
+                total[1] += amount
+            if key is not None:
+                entries.append((key, (name, t_type, amount)))
+
+        for scope, totals in self._totals.items():
+            self._scope_top(scope, "count").rebuild({n: t[0] for n, t in totals.items()})
+            self._scope_top(scope, "amount").rebuild({n: t[1] for n, t in totals.items()})
+        self._by_time = SortedIndex(entries)
+
+    def add(self, transaction):
+        self._apply(transaction, 1)
+
+    def remove(self, transaction):
+        self._apply(transaction, -1)
+
+    def top(self, by="amount", k=10, t_type=None, start=None, end=None):
+        """
+        Top counterparties
+
+        Args:
+            by (str): 'amount' or 'count'
+            k (int): Number of counterparties
+            t_type (str): Only this transaction type (None = all)
+            start (int): Window start in epoch ms, inclusive (None = no bound)
+            end (int): Window end in epoch ms, inclusive (None = no bound)
+
+        Returns:
+            list: Dicts with name, count and amount, best first
+        """
+        t_type = t_type.lower() if t_type else None
+        if start is None and end is None:
+            totals = self._totals.get(t_type, {})
+            return [{"name": name, "count": totals[name][0], "amount": totals[name][1]}
+                    for name, _ in self._scope_top(t_type, by).top(k)]
+
+        # Time window: aggregate only the transactions inside it
+        low = None if start is None else (start, float("-inf"))
+        high = None if end is None else (end, float("inf"))
+        window = {}
+        for _, (name, entry_type, amount) in self._by_time.irange(low, high):
+            if t_type is not None and entry_type != t_type:
+                continue
+            total = window.setdefault(name, [0, 0])
+            total[0] += 1
+            total[1] += amount
+        index = 0 if by == "count" else 1
+        best = heapq.nsmallest(k, window.items(), key=lambda item: (-item[1][index], item[0]))
+        return [{"name": name, "count": count, "amount": amount} for name, (count, amount) in best]
+
+    # Internal helpers
+
+    def _scope_top(self, scope, by):
+        top = self._top.get((scope, by))
+        if top is None:
+            top = self._top[(scope, by)] = LazyTopK()
+        return top
+
+    def _entry(self, transaction):
+        name = counterparty(transaction)
+        if name is None:
+            return None
+        time_ms = ledger_time(transaction)
+        key = None if time_ms is None else (time_ms, transaction.get("id"))
+        return name, transaction_type(transaction), _amount(transaction), key
+
+    def _apply(self, transaction, sign):
+        entry = self._entry(transaction)
+        if entry is None:
+            return
+        name, t_type, amount, key = entry
+        for scope in (None, t_type):
+            totals = self._totals.setdefault(scope, {})
+            total = totals.setdefault(name, [0, 0])
+            total[0] += sign
+            total[1] += sign * amount
+            if total[0] <= 0:
+                del totals[name]
+                total = [0, 0]
+            self._scope_top(scope, "count").set(name, total[0])
+            self._scope_top(scope, "amount").set(name, total[1])
+        if key is not None:
+            if sign > 0:
+                self._by_time.insert(key, (name, t_type, amount))
+            else:
+                self._by_time.pop(key)
+
+
+# Test the counterparty index
+if __name__ == "__main__":
+    import random
+
+    print("Counterparty Index Test")
+    print("=" * 50)
+
+    sample = [
+        {"id": 1, "type": "received", "amount": 2000, "sender": "jane smith", "receiver": "self", "date": 1000},
+        {"id": 2, "type": "sent", "amount": 1000, "sender": "self", "receiver": "jane smith", "date": 2000},
+        {"id": 3, "type": "sent", "amount": 600, "sender": "self", "receiver": "samuel carter", "date": 3000},
+        {"id": 4, "type": "sent", "amount": 10000, "sender": "self", "receiver": "samuel carter", "date": 4000},
+    ]
+    index = CounterpartyIndex()
+    index.rebuild(sample)
+    print(f"Top by amount: {index.top('amount', 5)}")
+    print(f"Top by count (sent): {index.top('count', 5, 'sent')}")
+    print(f"Top by amount, dates 1000-2000: {index.top('amount', 5, start=1000, end=2000)}")
+
+    # Check incremental updates against brute-force grouping
+    rng = random.Random(5)
+    names = ["name {}".format(i) for i in range(40)]
+    store = {}
+    for _ in range(5000):
+        transaction_id = rng.randint(1, 300)
+        if transaction_id in store:
+            index.remove(store.pop(transaction_id))
+        if rng.random() < 0.7:
+            transaction = {"id": transaction_id, "type": rng.choice(["sent", "received"]),
+                           "amount": rng.randint(1, 100) * 100, "receiver": rng.choice(names),
+                           "date": rng.randint(1, 1000)}
+            store[transaction_id] = transaction
+            index.add(transaction)
+
+    for by in METRICS:
+        for t_type in (None, "sent"):
+            for start, end in ((None, None), (100, 600)):
+                expected = {}
+                for t in store.values():
+                    if t_type and t["type"] != t_type:
+                        continue
+                    if start is not None and not start <= t["date"] <= end:
+                        continue
+                    total = expected.setdefault(t["receiver"], [0, 0])
+                    total[0] += 1
+                    total[1] += t["amount"]
+                column = 0 if by == "count" else 1
+                ranked = sorted(expected.items(), key=lambda item: (-item[1][column], item[0]))[:10]
+                got = index.top(by, 10, t_type, start, end)
+                assert [(r["name"], r["count"], r["amount"]) for r in got] == \
+                    [(name, c, a) for name, (c, a) in ranked], (by, t_type, start)
+    print(f"\n✓ Top-k matches brute-force grouping ({len(store)} transactions)")
@@ -56,6 +56,37 @@ def dict_lookup_with_count(transaction_dict, target_id):
     return result, comparisons
 
 
+def dict_lookup_many(transaction_dict, target_ids):
+    """
+    Look up many transaction IDs in a single pass
+    Each ID costs one O(1) hash lookup, so k IDs cost O(k) no matter how
+    many transactions are stored
+
+    Args:
+        transaction_dict (dict): Dictionary of transactions
+        target_ids (iterable): Transaction IDs to look up (duplicates are ignored)
+
+    Returns:
+        tuple: (found transactions in request order, missing IDs)
+    """
+    found = []
+    missing = []
+    seen = set()
+    get = transaction_dict.get
+
+    for target_id in target_ids:
+        if target_id in seen:
+            continue
+        seen.add(target_id)
+        transaction = get(target_id)
+        if transaction is None:
+            missing.append(target_id)
+        else:
+            found.append(transaction)
+
+    return found, missing
+
+
 # Test the dictionary lookup
 if __name__ == "__main__":
     # Sample test data
@@ -97,6 +128,12 @@ if __name__ == "__main__":
     else:
         print(f" Not found")
     
+    # Test batch lookup
+    found, missing = dict_lookup_many(trans_dict, [1, 5, 99, 3, 5])
+    print(f"\nBatch lookup of [1, 5, 99, 3, 5]:")
+    print(f" Found IDs: {[t['id'] for t in found]}")
+    print(f" Missing IDs: {missing}")
+
     print("\n" + "*" * 50)
     print("Why is dictionary lookup faster?")
     print("*" * 50)
@@ -1,8 +1,10 @@
 """
-Efficiency Test - Compare Linear Search vs Dictionary Lookup
-Tests both algorithms with real transaction data and measures performance
+Efficiency Test - Compare Linear Search vs Dictionary Lookup vs Sorted Index
+Tests the algorithms with real transaction data and measures performance,
+then benchmarks point lookups, range scans and updates at larger scale
 """
 
+import random
 import time
 import sys
 import os
@@ -13,6 +15,10 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from parse_xml import parse_xml_file
 from linear_search import linear_search_with_count
 from dict_lookup import build_transaction_dict, dict_lookup_with_count
+from sorted_index import build_sorted_index
+
+# Dataset sizes for the scale benchmark
+SCALE_SIZES = (10000, 100000, 1000000)
 
 
 def test_search_efficiency(transactions, search_ids):
@@ -32,9 +38,9 @@ def test_search_efficiency(transactions, search_ids):
     
     # Build dictionary for dict lookup
     print("\nBuilding dictionary...")
-    start_time = time.time()
+    start_time = time.perf_counter()
     trans_dict = build_transaction_dict(transactions)
-    build_time = time.time() - start_time
+    build_time = time.perf_counter() - start_time
     print(f"✓ Dictionary built in {build_time:.6f} seconds")
     
     # Test Linear Search
@@ -42,13 +48,13 @@ def test_search_efficiency(transactions, search_ids):
     linear_comparisons = 0
     linear_found = 0
     
-    start_time = time.time()
+    start_time = time.perf_counter()
     for search_id in search_ids:
         result, comparisons = linear_search_with_count(transactions, search_id)
         linear_comparisons += comparisons
         if result:
             linear_found += 1
-    linear_time = time.time() - start_time
+    linear_time = time.perf_counter() - start_time
     
     print(f"Time taken: {linear_time:.6f} seconds")
     print(f"Total comparisons: {linear_comparisons}")
@@ -60,13 +66,13 @@ def test_search_efficiency(transactions, search_ids):
     dict_comparisons = 0
     dict_found = 0
     
-    start_time = time.time()
+    start_time = time.perf_counter()
     for search_id in search_ids:
         result, comparisons = dict_lookup_with_count(trans_dict, search_id)
         dict_comparisons += comparisons
         if result:
             dict_found += 1
-    dict_time = time.time() - start_time
+    dict_time = time.perf_counter() - start_time
     
     print(f"Time taken: {dict_time:.6f} seconds")
     print(f"Total comparisons: {dict_comparisons}")
@@ -102,7 +108,8 @@ def run_efficiency_test():
     Main function to run the efficiency test
     """
     # Check if XML file exists
-    xml_file = "../data/modified_sms_v2.xml"
+    xml_file = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                            "data", "modified_sms_v2.xml")
     
     if not os.path.exists(xml_file):
         print(f"✗ Error: {xml_file} not found!")
@@ -168,5 +175,149 @@ That's why we use dictionaries in real APIs!
     """)
 
 
+def _timed(fn, repeat):
+    """Run fn() `repeat` times and return the average time in microseconds"""
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start_time) / repeat * 1e6
+
+
+def _synthetic_transactions(size, seed=0):
+    """
+    Sorted IDs with gaps (like a store after deletes), so ID ranges are sparse
+    """
+    rng = random.Random(seed)
+    transactions = []
+    next_id = 1
+    for _ in range(size):
+        transactions.append({"id": next_id, "type": "received", "amount": rng.randint(100, 100000)})
+        next_id += rng.randint(1, 3)
+    return transactions
+
+
+def test_index_at_scale(sizes=SCALE_SIZES, range_width=400, page_size=100, seed=0):
+    """
+    Benchmark the three structures at growing sizes
+
+    - Point lookup of one ID
+    - Range scan "IDs lo..hi" (linear: scan and filter, dict: probe every
+      ID in the range, sorted index: binary search then iterate)
+    - Page "next page_size transactions after ID X" (dict can't bound this,
+      so it probes IDs until it has collected a page)
+    - Insert + delete of one ID (linear: list insert at the sorted position)
+
+    Args:
+        sizes (tuple): Numbers of transactions to test with
+        range_width (int): Width of the ID ranges queried
+        page_size (int): Page size for "next N after X"
+        seed (int): Random seed for data and queries
+    """
+    print("\n" + "=" * 70)
+    print("SCALE BENCHMARK: Linear Search vs Dictionary vs Sorted Index")
+    print("(average microseconds per operation)")
+    print("=" * 70)
+
+    rng = random.Random(seed)
+    for size in sizes:
+        transactions = _synthetic_transactions(size, seed)
+        max_id = transactions[-1]["id"]
+
+        start_time = time.perf_counter()
+        trans_dict = build_transaction_dict(transactions)
+        dict_build = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        index = build_sorted_index(transactions)
+        index_build = time.perf_counter() - start_time
+
+        lookup_ids = [rng.randint(1, max_id) for _ in range(1000)]
+        ranges = [(lo, lo + range_width) for lo in (rng.randint(1, max_id) for _ in range(200))]
+        # Linear search is slow at scale; give it fewer queries
+        linear_repeat = max(3, 2000000 // size)
+
+        queries = iter(lookup_ids * 1000)
+        linear_point = _timed(lambda: linear_search_with_count(transactions, next(queries)), linear_repeat)
+        queries = iter(lookup_ids * 1000)
+        dict_point = _timed(lambda: trans_dict.get(next(queries)), 100000)
+        queries = iter(lookup_ids * 1000)
+        index_point = _timed(lambda: index.get(next(queries)), 100000)
+
+        bounds = iter(ranges * 1000)
+        linear_range = _timed(lambda: _linear_range(transactions, *next(bounds)), linear_repeat)
+        bounds = iter(ranges * 1000)
+        dict_range = _timed(lambda: _dict_range(trans_dict, *next(bounds)), 2000)
+        bounds = iter(ranges * 1000)
+        index_range = _timed(lambda: list(index.irange(*next(bounds))), 2000)
+
+        queries = iter(lookup_ids * 1000)
+        linear_page = _timed(lambda: _linear_page(transactions, next(queries), page_size), linear_repeat)
+        queries = iter(lookup_ids * 1000)
+        dict_page = _timed(lambda: _dict_page(trans_dict, next(queries), page_size, max_id), 2000)
+        queries = iter(lookup_ids * 1000)
+        index_page = _timed(lambda: index.after(next(queries), page_size), 2000)
+
+        # Insert then delete a new ID, so the structures keep their size
+        new_ids = iter([max_id + 1 + i for i in range(10000)] * 100)
+        sorted_ids = [t["id"] for t in transactions]
+        linear_update = _timed(lambda: _linear_insert_delete(transactions, sorted_ids, rng.randint(1, max_id)),
+                               linear_repeat)
+        dict_update = _timed(lambda: _dict_insert_delete(trans_dict, next(new_ids)), 10000)
+        index_update = _timed(lambda: _index_insert_delete(index, rng.randint(1, max_id)), 10000)
+
+        print(f"\n{size:,} transactions (dict built in {dict_build:.3f}s, index in {index_build:.3f}s)")
+        print(f"{'Operation':<30} {'Linear Search':>14} {'Dict Lookup':>14} {'Sorted Index':>14}")
+        print("-" * 74)
+        print(f"{'Point lookup':<30} {linear_point:>14.2f} {dict_point:>14.2f} {index_point:>14.2f}")
+        print(f"{f'Range of {range_width} IDs':<30} {linear_range:>14.2f} {dict_range:>14.2f} {index_range:>14.2f}")
+        print(f"{f'Next {page_size} after ID':<30} {linear_page:>14.2f} {dict_page:>14.2f} {index_page:>14.2f}")
+        print(f"{'Insert + delete':<30} {linear_update:>14.2f} {dict_update:>14.2f} {index_update:>14.2f}")
+        print(f"{'Rank of an ID':<30} {'O(n)':>14} {'n/a':>14} "
+              f"{_timed(lambda: index.rank(rng.randint(1, max_id)), 10000):>14.2f}")
+
+
+def _linear_range(transactions, low, high):
+    return [t for t in transactions if low <= t["id"] <= high]
+
+
+def _dict_range(trans_dict, low, high):
+    return [trans_dict[i] for i in range(low, high + 1) if i in trans_dict]
+
+
+def _linear_page(transactions, after_id, limit):
+    return sorted((t for t in transactions if t["id"] > after_id), key=lambda t: t["id"])[:limit]
+
+
+def _dict_page(trans_dict, after_id, limit, max_id):
+    page = []
+    i = after_id + 1
+    while len(page) < limit and i <= max_id:
+        transaction = trans_dict.get(i)
+        if transaction is not None:
+            page.append(transaction)
+        i += 1
+    return page
+
+
+def _linear_insert_delete(transactions, sorted_ids, new_id):
+    # Keeping a plain list sorted costs O(n) per update
+    from bisect import bisect_left
+    position = bisect_left(sorted_ids, new_id)
+    transactions.insert(position, {"id": new_id})
+    sorted_ids.insert(position, new_id)
+    del transactions[position]
+    del sorted_ids[position]
+
+
+def _dict_insert_delete(trans_dict, new_id):
+    trans_dict[new_id] = {"id": new_id}
+    del trans_dict[new_id]
+
+
+def _index_insert_delete(index, new_id):
+    if index.insert(new_id, {"id": new_id}):
+        index.pop(new_id)
+
+
 if __name__ == "__main__":
     run_efficiency_test()
+    test_index_at_scale()
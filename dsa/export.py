@@ -0,0 +1,272 @@
+"""
+Transaction Export
+Writes transactions as CSV, NDJSON or Parquet in batches, from any
+iterable of transactions (the API store or iter_xml_transactions), so
+the whole export never has to be held in memory.
+
+Command line: convert an SMS XML backup straight to one of the formats
+    python export.py ../data/modified_sms_v2.xml transactions.csv
+    python export.py backup.xml - --format ndjson | gzip > transactions.ndjson.gz
+    python export.py backup.xml transactions.parquet      (needs pyarrow)
+"""
+
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+import time
+
+FORMATS = ("csv", "ndjson", "parquet")
+
+CONTENT_TYPES = {
+    "csv": "text/csv; charset=utf-8",
+    "ndjson": "application/x-ndjson",
+    "parquet": "application/vnd.apache.parquet"
+}
+
+# Export columns; API-created transactions use transaction_type/recipient,
+# which are exported as type/receiver
+FIELDS = ("id", "type", "amount", "fee", "balance", "sender", "receiver", "date", "timestamp", "raw_text")
+NUMERIC_FIELDS = {"id", "amount", "fee", "balance", "date"}
+
+# Rows written per chunk (and per Parquet row group)
+BATCH_SIZE = 5000
+
+
+class ExportError(Exception):
+    """The requested export can't be produced (e.g. pyarrow missing)"""
+
+
+_NUMERIC_POSITIONS = [i for i, field in enumerate(FIELDS) if field in NUMERIC_FIELDS]
+_STRING_POSITIONS = [i for i, field in enumerate(FIELDS) if field not in NUMERIC_FIELDS]
+_TYPE = FIELDS.index("type")
+_RECEIVER = FIELDS.index("receiver")
+
+# One shared encoder: json.dumps builds a new one per call when given options
+_json_encoder = json.JSONEncoder(ensure_ascii=False)
+
+
+def export_values(transaction):
+    """
+    Flatten a transaction into the export columns
+
+    Numbers that aren't numbers become None, so every row fits the
+    Parquet schema.
+
+    Returns:
+        list: One value per FIELDS entry
+    """
+    get = transaction.get
+    values = [get(field) for field in FIELDS]
+    if values[_TYPE] is None:
+        values[_TYPE] = get("transaction_type")
+    if values[_RECEIVER] is None:
+        values[_RECEIVER] = get("recipient")
+    for i in _NUMERIC_POSITIONS:
+        value = values[i]
+        if value is not None and (type(value) is bool or not isinstance(value, (int, float))):
+            values[i] = None
+    for i in _STRING_POSITIONS:
+        value = values[i]
+        if value is not None and type(value) is not str:
+            values[i] = str(value)
+    return values
+
+
+def export_row(transaction):
+    """Like export_values, as a dict keyed by column name"""
+    return dict(zip(FIELDS, export_values(transaction)))
+
+
+def _batches(transactions, batch_size, row=export_values):
+    batch = []
+    for transaction in transactions:
+        batch.append(row(transaction))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def iter_csv(transactions, batch_size=BATCH_SIZE):
+    """
+    Yields:
+        bytes: UTF-8 CSV, header first, then batch_size rows per chunk
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(FIELDS)
+    yield buffer.getvalue().encode()
+    for batch in _batches(transactions, batch_size):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(batch)
+        yield buffer.getvalue().encode()
+
+
+def iter_ndjson(transactions, batch_size=BATCH_SIZE):
+    """
+    Yields:
+        bytes: One JSON object per line, batch_size lines per chunk
+    """
+    encode = _json_encoder.encode
+    for batch in _batches(transactions, batch_size, export_row):
+        yield "".join([encode(row) + "\n" for row in batch]).encode()
+
+
+class _ChunkSink:
+    """Write-only file object that hands back what was written since last time"""
+
+    def __init__(self):
+        self._chunks = []
+        self.closed = False
+        self._position = 0
+
+    def write(self, data):
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def take(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _require_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ExportError("Parquet export needs pyarrow (pip install pyarrow)")
+    return pyarrow, pyarrow.parquet
+
+
+def iter_parquet(transactions, batch_size=BATCH_SIZE):
+    """
+    Parquet file, one row group per batch
+
+    Yields:
+        bytes: The file in pieces, as row groups are written
+
+    Raises:
+        ExportError: pyarrow is not installed
+    """
+    pa, pq = _require_pyarrow()
+    schema = pa.schema([(field, pa.int64() if field in ("id", "date") else
+                         pa.float64() if field in NUMERIC_FIELDS else pa.string())
+                        for field in FIELDS])
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(pa.PythonFile(sink, mode="w"), schema)
+    try:
+        for batch in _batches(transactions, batch_size, export_row):
+            writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+            yield sink.take()
+    finally:
+        writer.close()
+    yield sink.take()
+
+
+def iter_export(transactions, export_format, batch_size=BATCH_SIZE):
+    """
+    Export chunks for any format
+
+    Args:
+        transactions (iterable): Transaction dictionaries
+        export_format (str): 'csv', 'ndjson' or 'parquet'
+        batch_size (int): Rows per chunk
+
+    Returns:
+        generator: bytes chunks
+
+    Raises:
+        ExportError: Unknown format, or Parquet without pyarrow
+    """
+    if export_format == "csv":
+        return iter_csv(transactions, batch_size)
+    if export_format == "ndjson":
+        return iter_ndjson(transactions, batch_size)
+    if export_format == "parquet":
+        # Check for pyarrow now rather than when the first chunk is requested
+        _require_pyarrow()
+        return iter_parquet(transactions, batch_size)
+    raise ExportError("format must be one of: {}".format(", ".join(FORMATS)))
+
+
+def export_file(xml_file, output, export_format=None, batch_size=BATCH_SIZE):
+    """
+    Convert an SMS XML backup to CSV, NDJSON or Parquet
+
+    Args:
+        xml_file (str): The <smses> backup
+        output (str): Output file, or - for stdout
+        export_format (str): Format; guessed from the output extension when None
+        batch_size (int): Rows per chunk
+
+    Returns:
+        int: Number of transactions written
+    """
+    try:
+        from dsa.parse_xml import iter_xml_transactions
+    except ImportError:
+        from parse_xml import iter_xml_transactions
+
+    if export_format is None:
+        export_format = os.path.splitext(output)[1].lstrip(".").lower() if output != "-" else "csv"
+
+    count = [0]
+
+    def counted():
+        for transaction in iter_xml_transactions(xml_file):
+            count[0] += 1
+            yield transaction
+
+    chunks = iter_export(counted(), export_format, batch_size)
+    if output == "-":
+        out = sys.stdout.buffer
+        for chunk in chunks:
+            out.write(chunk)
+        out.flush()
+    else:
+        with open(output, "wb") as out:
+            for chunk in chunks:
+                out.write(chunk)
+    return count[0]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert an SMS XML backup to CSV, NDJSON or Parquet")
+    parser.add_argument("xml_file", help="SMS backup (<smses> XML)")
+    parser.add_argument("output", help="Output file, or - for stdout")
+    parser.add_argument("--format", choices=FORMATS,
+                        help="Output format (default: from the output extension, csv for stdout)")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Rows per chunk / row group")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    try:
+        written = export_file(args.xml_file, args.output, args.format, args.batch_size)
+    except ExportError as e:
+        sys.exit("✗ {}".format(e))
+    elapsed = time.perf_counter() - start
+    print("✓ Exported {} transactions in {:.2f}s ({:.0f} msg/s)".format(
+        written, elapsed, written / elapsed if elapsed else 0), file=sys.stderr)
@@ -0,0 +1,437 @@
+"""
+Synthetic SMS Backup Generator
+Writes MTN MoMo style <smses> backups of any size for load and scale testing.
+
+The message model (templates, amount/fee distributions, counterparty names
+and time gaps between messages) is learned from a real backup such as
+data/modified_sms_v2.xml, with built-in templates as a fallback. Output is
+streamed record by record, is fully determined by the seed and can be split
+across several files for parallel ingest.
+"""
+
+import argparse
+import calendar
+import collections
+import datetime
+import os
+import random
+import re
+import sys
+import uuid
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import quoteattr
+
+
+DEFAULT_SOURCE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                              "data", "modified_sms_v2.xml")
+
+# Built-in message templates modelled on data/modified_sms_v2.xml
+# kind: "credit" adds to the balance, "debit" subtracts amount + fee, "none" leaves it
+TEMPLATES = [
+    {
+        "name": "received",
+        "kind": "credit",
+        "weight": 10,
+        "text": "You have received {amount} RWF from {name} (*********{masked}) on your "
+                "mobile money account at {datetime}. Message from sender: . "
+                "Your new balance:{balance} RWF. Financial Transaction Id: {txid}."
+    },
+    {
+        "name": "payment",
+        "kind": "debit",
+        "weight": 40,
+        "fees": [0],
+        "text": "TxId: {txid}. Your payment of {amount_c} RWF to {name} {code} has been "
+                "completed at {datetime}. Your new balance: {balance_c} RWF. Fee was {fee} RWF."
+                "Kanda*182*16# wiyandikishe muri poromosiyo ya BivaMoMotima, ugire amahirwe "
+                "yo gutsindira ibihembo bishimishije."
+    },
+    {
+        "name": "deposit",
+        "kind": "credit",
+        "weight": 15,
+        "text": "*113*R*A bank deposit of {amount} RWF has been added to your mobile money "
+                "account at {datetime}. Your NEW BALANCE :{balance} RWF. Cash Deposit::CASH::::0::"
+                "250795963036.Thank you for using MTN MobileMoney.*EN#"
+    },
+    {
+        "name": "transfer",
+        "kind": "debit",
+        "weight": 30,
+        "fees": [100, 100, 100, 250],
+        "text": "*165*S*{amount} RWF transferred to {name} ({phone}) from 36521838 at {datetime} . "
+                "Fee was: {fee} RWF. New balance: {balance} RWF. Kugura ama inite cg interineti "
+                "kuri MoMo, Kanda *182*2*1# .*EN#"
+    },
+    {
+        "name": "airtime",
+        "kind": "debit",
+        "weight": 4,
+        "fees": [0],
+        "text": "*162*TxId:{txid}*S*Your payment of {amount} RWF to Airtime with token  has been "
+                "completed at {datetime}. Fee was {fee} RWF. Your new balance: {balance} RWF . "
+                "Message: - -. *EN#"
+    },
+    {
+        "name": "otp",
+        "kind": "none",
+        "weight": 1,
+        "text": "<#> Dear Customer, your MTN MoMo application one-time password is :{otp}."
+                "MTN MoMo does not recommend that you share or expose your one-time password "
+                "with anyone. Be Vigilant."
+    },
+]
+
+NAMES = ["Jane Smith", "Alex Doe", "Samuel Carter", "Robert Brown", "Linda Green"]
+PHONES = ["250791666666", "250788999999", "250790777777", "250795963036"]
+AMOUNTS = [50, 100, 200, 300, 500, 600, 800, 1000, 1500, 1800, 2000, 2500, 2800,
+           3000, 3500, 4000, 5000, 8000, 10000, 12000, 20000, 25000, 40000, 50000]
+
+BUILTIN_MODEL = {
+    "templates": TEMPLATES,
+    "names": [(name, 1) for name in NAMES],
+    "gaps": None,
+    "max_balance": 250000
+}
+
+# Patterns used to turn a real message body into a template
+_DATETIME_RE = re.compile(r"\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}")
+_BALANCE_RE = re.compile(r"(?i)(new balance\s*:?\s*)(\d[\d,]*)")
+_FEE_RE = re.compile(r"(?i)(fee (?:was|paid)\s*:?\s*)(\d[\d,]*)")
+_AMOUNT_RE = re.compile(r"(?<![\d,{])(\d[\d,]*)( ?RWF)")
+_NAME_RE = re.compile(r"\b(from|to|agent:) ([A-Z][a-z]+(?: [A-Z][a-z]+)+)")
+_MASKED_RE = re.compile(r"(\*{9})(\d{3})")
+_DIGITS_RE = re.compile(r"(?<![\d{])\d{5,}(?![\d}])")
+_CREDIT_WORDS = ("received", "deposit")
+_DEBIT_WORDS = ("payment of", "transferred to", "transaction of", "withdrawn")
+_SAMPLE_CAP = 1000
+
+
+class _MessageValues(dict):
+    """Field values for one message; digitsN fields are made up on first use"""
+
+    def __init__(self, rng, values):
+        dict.__init__(self, values)
+        self.rng = rng
+
+    def __missing__(self, key):
+        if key.startswith("digits"):
+            width = int(key[6:])
+            value = "%0*d" % (width, self.rng.randrange(10 ** width))
+            self[key] = value
+            return value
+        raise KeyError(key)
+
+
+def _to_int(text):
+    return int(text.replace(",", ""))
+
+
+def _templatize(body):
+    """
+    Replace the variable parts of a message body with template fields
+
+    Returns:
+        tuple: (template text, {field: raw value}, set of fields written with commas)
+    """
+    fields = {}
+    commas = set()
+    text = body.replace("{", "{{").replace("}", "}}")
+
+    def slot(field, value):
+        if "," in value:
+            commas.add(field)
+        fields.setdefault(field, value)
+        return "{" + field + "}"
+
+    text = _DATETIME_RE.sub("{datetime}", text)
+    text = _BALANCE_RE.sub(lambda m: m.group(1) + slot("balance", m.group(2)), text, count=1)
+    text = _FEE_RE.sub(lambda m: m.group(1) + slot("fee", m.group(2)), text, count=1)
+    text = _AMOUNT_RE.sub(lambda m: slot("amount", m.group(1)) + m.group(2), text, count=1)
+    text = _NAME_RE.sub(lambda m: m.group(1) + " " + slot("name", m.group(2)), text)
+    text = _MASKED_RE.sub(lambda m: m.group(1) + "{digits3}", text)
+    text = _DIGITS_RE.sub(lambda m: "{digits%d}" % len(m.group(0)), text)
+    return text, fields, commas
+
+
+def _template_kind(text):
+    """credit/debit if the message moves the balance it reports, otherwise none"""
+    if "{balance" not in text or "{amount" not in text:
+        return "none"
+    lower = text.lower()
+    if any(word in lower for word in _CREDIT_WORDS):
+        return "credit"
+    if any(word in lower for word in _DEBIT_WORDS):
+        return "debit"
+    return "none"
+
+
+def learn_model(file_path=DEFAULT_SOURCE):
+    """
+    Learn a message model from an existing SMS backup
+
+    Every body is reduced to a template by replacing dates, amounts,
+    balances, fees, counterparty names and long digit runs with fields.
+    Identical templates are grouped and keep their frequency plus samples
+    of the amounts and fees seen with them.
+
+    Args:
+        file_path (str): Path to an <smses> backup
+
+    Returns:
+        dict: Model with "templates", "names", "gaps" (seconds between
+        messages) and "max_balance" (largest balance seen)
+    """
+    sample_rng = random.Random(0)
+    groups = {}
+    names = collections.Counter()
+    dates = []
+    max_balance = 0
+
+    for _, elem in ET.iterparse(file_path):
+        if elem.tag != "sms":
+            continue
+        body = elem.get("body") or ""
+        date = elem.get("date")
+        elem.clear()
+
+        text, fields, commas = _templatize(body)
+        group = groups.get(text)
+        if group is None:
+            group = groups[text] = {"count": 0, "commas": set(), "amounts": [], "fees": []}
+        group["count"] += 1
+        group["commas"] |= commas
+
+        for field, samples in (("amount", group["amounts"]), ("fee", group["fees"])):
+            if field not in fields:
+                continue
+            value = _to_int(fields[field])
+            # Reservoir sample so huge sources stay bounded
+            if len(samples) < _SAMPLE_CAP:
+                samples.append(value)
+            else:
+                j = sample_rng.randrange(group["count"])
+                if j < _SAMPLE_CAP:
+                    samples[j] = value
+        if "balance" in fields:
+            max_balance = max(max_balance, _to_int(fields["balance"]))
+        if "name" in fields:
+            names[fields["name"]] += 1
+        if date and date.isdigit():
+            dates.append(int(date) // 1000)
+
+    templates = []
+    for text, group in sorted(groups.items(), key=lambda item: (-item[1]["count"], item[0])):
+        for field in group["commas"]:
+            text = text.replace("{" + field + "}", "{" + field + "_c}")
+        template = {
+            "name": "learned_{}".format(len(templates) + 1),
+            "kind": _template_kind(text),
+            "weight": group["count"],
+            "text": text
+        }
+        if group["amounts"]:
+            template["amounts"] = group["amounts"]
+        if group["fees"]:
+            template["fees"] = group["fees"]
+        templates.append(template)
+
+    dates.sort()
+    gaps = [b - a for a, b in zip(dates, dates[1:]) if b > a]
+
+    return {
+        "templates": templates,
+        "names": sorted(names.items(), key=lambda item: (-item[1], item[0])) or BUILTIN_MODEL["names"],
+        "gaps": gaps or None,
+        "max_balance": max_balance or BUILTIN_MODEL["max_balance"]
+    }
+
+
+def default_model():
+    """Model learned from data/modified_sms_v2.xml, or the built-in one if it is missing"""
+    if os.path.exists(DEFAULT_SOURCE):
+        return learn_model(DEFAULT_SOURCE)
+    return BUILTIN_MODEL
+
+
+def _readable_date(dt):
+    """Format like the backup app: '1 Jun 2024 1:29:05 AM'"""
+    hour = dt.hour % 12 or 12
+    return "{} {} {}:{} {}".format(dt.day, dt.strftime("%b %Y"), hour,
+                                   dt.strftime("%M:%S"), dt.strftime("%p"))
+
+
+def _fill(template, rng, balance, names, max_balance=None):
+    """
+    Choose field values for one message
+
+    Returns:
+        tuple: (field values, or None if a debit can't be covered or a credit
+        would push the balance past max_balance; new balance)
+    """
+    amount = rng.choice(template.get("amounts", AMOUNTS))
+    fee = rng.choice(template.get("fees", [0]))
+
+    if template["kind"] == "credit":
+        if max_balance and balance + amount > max_balance:
+            return None, balance
+        balance += amount
+    elif template["kind"] == "debit":
+        if amount + fee > balance:
+            return None, balance
+        balance -= amount + fee
+
+    values = {
+        "amount": amount,
+        "amount_c": "{:,}".format(amount),
+        "balance": balance,
+        "balance_c": "{:,}".format(balance),
+        "fee": fee,
+        "fee_c": "{:,}".format(fee),
+        "name": rng.choices(names[0], cum_weights=names[1])[0],
+        "phone": rng.choice(PHONES),
+        "masked": "{:03d}".format(rng.randrange(1000)),
+        "code": "{:05d}".format(rng.randrange(100000)),
+        "txid": str(rng.randrange(10 ** 10, 10 ** 11)),
+        "otp": "{:04d}".format(rng.randrange(10000)),
+    }
+    return _MessageValues(rng, values), balance
+
+
+def iter_sms_elements(count, seed=0, start=None, model=None):
+    """
+    Yield <sms .../> lines one at a time
+
+    A running balance is carried across messages so the "new balance"
+    figures agree with the amounts and fees. A debit the balance can't
+    cover is replaced by a credit, and a credit that would take the balance
+    past the model's max_balance by a debit, so balances stay in the range
+    seen in the source.
+
+    Args:
+        count (int): Number of messages to generate
+        seed (int): Random seed; the same seed always gives the same output
+        start (datetime): Timestamp of the first message
+        model (dict): Model from learn_model() (defaults to BUILTIN_MODEL)
+
+    Yields:
+        str: One <sms> element per message
+    """
+    rng = random.Random(seed)
+    model = model or BUILTIN_MODEL
+    templates = model["templates"]
+    gaps = model.get("gaps")
+    cum_weights = list(_accumulate(t["weight"] for t in templates))
+    name_list = [name for name, _ in model["names"]]
+    names = (name_list, list(_accumulate(weight for _, weight in model["names"])))
+    credit = [t for t in templates if t["kind"] == "credit"] or TEMPLATES[:1]
+    debit = [t for t in templates if t["kind"] == "debit"] or TEMPLATES[1:2]
+    max_balance = model.get("max_balance")
+    current = start or datetime.datetime(2024, 5, 10, 16, 30, 51)
+    balance = 0
+
+    for _ in range(count):
+        gap = rng.choice(gaps) if gaps else rng.randint(30, 3600)
+        current += datetime.timedelta(seconds=gap)
+        template = rng.choices(templates, cum_weights=cum_weights)[0]
+        values, balance = _fill(template, rng, balance, names, max_balance)
+        if values is None:
+            template = rng.choice(debit if template["kind"] == "credit" else credit)
+            values, balance = _fill(template, rng, balance, names)
+        if values is None:
+            # A large debit near the cap: a credit always fits without one
+            template = rng.choice(credit)
+            values, balance = _fill(template, rng, balance, names)
+
+        values["datetime"] = current.strftime("%Y-%m-%d %H:%M:%S")
+        body = template["text"].format_map(values)
+        date_ms = calendar.timegm(current.timetuple()) * 1000 + rng.randrange(1000)
+
+        yield ('  <sms protocol="0" address="M-Money" date="{date}" type="1" subject="null" '
+               'body={body} toa="null" sc_toa="null" service_center="+250788110381" read="1" '
+               'status="-1" locked="0" date_sent="{sent}" sub_id="6" readable_date="{readable}" '
+               'contact_name="(Unknown)" />\n').format(
+                   date=date_ms,
+                   body=quoteattr(body),
+                   sent=date_ms - rng.randint(1000, 9000),
+                   readable=_readable_date(current))
+
+
+def _accumulate(values):
+    total = 0
+    for value in values:
+        total += value
+        yield total
+
+
+def _write_backup(f, lines, count, backup_set):
+    f.write("<?xml version='1.0' encoding='utf-8'?>\n")
+    f.write('<smses count="{}" backup_set="{}" backup_date="{}" type="full">\n'.format(
+        count, backup_set, 1737023646162))
+    for _ in range(count):
+        f.write(next(lines))
+    f.write("</smses>\n")
+
+
+def part_paths(file_path, parts):
+    """File names used when a backup is split: out.xml -> out.part1.xml, out.part2.xml ..."""
+    if parts <= 1:
+        return [file_path]
+    base, ext = os.path.splitext(file_path)
+    return ["{}.part{}{}".format(base, i, ext or ".xml") for i in range(1, parts + 1)]
+
+
+def write_sms_backup(file_path, count, seed=0, model=None, parts=1):
+    """
+    Stream a complete <smses> backup to disk (or stdout when file_path is "-")
+
+    With parts > 1 the message sequence is cut into consecutive, roughly
+    equal chunks, each written as its own valid backup file.
+
+    Args:
+        file_path (str): Output path or "-"
+        count (int): Total number of messages
+        seed (int): Random seed
+        model (dict): Model from learn_model() (defaults to BUILTIN_MODEL)
+        parts (int): Number of files to split the output into
+
+    Returns:
+        list: The paths written
+    """
+    rng = random.Random(seed)
+    backup_set = uuid.UUID(int=rng.getrandbits(128))
+    lines = iter_sms_elements(count, seed, model=model)
+
+    if file_path == "-":
+        _write_backup(sys.stdout, lines, count, backup_set)
+        return [file_path]
+
+    paths = part_paths(file_path, parts)
+    for i, path in enumerate(paths):
+        part_count = count * (i + 1) // len(paths) - count * i // len(paths)
+        with open(path, "w", encoding="utf-8") as f:
+            _write_backup(f, lines, part_count, backup_set)
+    return paths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic MoMo SMS backup")
+    parser.add_argument("output", help="Output XML file, or - for stdout")
+    parser.add_argument("-n", "--count", type=int, default=10000, help="Number of messages")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument("--source", default=DEFAULT_SOURCE,
+                        help="Backup to learn message templates from")
+    parser.add_argument("--builtin", action="store_true",
+                        help="Use the built-in templates instead of learning them")
+    parser.add_argument("--parts", type=int, default=1, help="Split the output into N files")
+    args = parser.parse_args()
+
+    if args.builtin or not os.path.exists(args.source):
+        model = BUILTIN_MODEL
+    else:
+        model = learn_model(args.source)
+
+    paths = write_sms_backup(args.output, args.count, args.seed, model, args.parts)
+    if args.output != "-":
+        print("✓ Wrote {} messages from {} templates to {}".format(
+            args.count, len(model["templates"]), ", ".join(paths)), file=sys.stderr)
@@ -0,0 +1,502 @@
+"""
+Running-Balance Ledger
+Keeps transactions ordered by message time with prefix sums of money in,
+money out and fees, so the net flow between two dates is O(log n) instead
+of a scan over every transaction.
+
+The prefix sums live in small sorted blocks (like SortedIndex): each block
+keeps running totals of its own entries, and a Fenwick tree over the block
+totals adds up everything before a block. Inserting or removing an entry
+only rewrites the running totals of one block.
+
+The ledger also checks the "new balance" figure in each SMS: starting from
+the previous message that reported a balance, it adds the flows in between
+and flags messages whose reported balance disagrees.
+"""
+
+import datetime
+from bisect import bisect_left, bisect_right
+
+try:
+    from dsa.sorted_index import SortedIndex
+except ImportError:
+    from sorted_index import SortedIndex
+
+DEFAULT_LOAD = 128
+
+# Transaction types that add to / take from the balance
+CREDIT_TYPES = {"received", "deposit"}
+DEBIT_TYPES = {"sent", "payment", "transfer", "withdrawal", "airtime"}
+
+# Sum vector stored per entry: (inflow, outflow, fees, count)
+WIDTH = 4
+
+
+class PrefixSumIndex:
+    """
+    Sorted keys, each with a vector of numbers, and O(log n) range sums
+
+    Updates rewrite the running totals of one block (at most 2 * load
+    entries) and adjust the Fenwick tree over block totals.
+    """
+
+    def __init__(self, width=WIDTH, load=DEFAULT_LOAD):
+        self._width = width
+        self._load = load
+        self._keys = []
+        self._values = []
+        # _running[b][i] = sum of _values[b][0..i]
+        self._running = []
+        self._maxes = []
+        self._tree = None
+
+    def __len__(self):
+        return sum(len(block) for block in self._keys)
+
+    def insert(self, key, vector):
+        """
+        Add (or replace) the vector stored under key
+
+        Args:
+            key: Sort key
+            vector (tuple): `width` numbers
+        """
+        if not self._maxes:
+            self._keys.append([key])
+            self._values.append([tuple(vector)])
+            self._running.append([tuple(vector)])
+            self._maxes.append(key)
+            self._tree = None
+            return
+
+        b = bisect_left(self._maxes, key)
+        if b == len(self._maxes):
+            b -= 1
+            i = len(self._keys[b])
+            self._maxes[b] = key
+        else:
+            i = bisect_left(self._keys[b], key)
+
+        old = None
+        if i < len(self._keys[b]) and self._keys[b][i] == key:
+            old = self._values[b][i]
+            self._values[b][i] = tuple(vector)
+        else:
+            self._keys[b].insert(i, key)
+            self._values[b].insert(i, tuple(vector))
+            self._running[b].insert(i, None)
+
+        self._recompute(b, i)
+        if len(self._keys[b]) > 2 * self._load:
+            self._split(b)
+        else:
+            delta = vector if old is None else [v - o for v, o in zip(vector, old)]
+            self._tree_add(b, delta)
+
+    def pop(self, key):
+        """
+        Remove key
+
+        Returns:
+            tuple: The removed vector, or None if key was not present
+        """
+        b = bisect_left(self._maxes, key)
+        if b == len(self._maxes):
+            return None
+        i = bisect_left(self._keys[b], key)
+        if self._keys[b][i] != key:
+            return None
+
+        del self._keys[b][i]
+        old = self._values[b].pop(i)
+        del self._running[b][i]
+
+        if not self._keys[b]:
+            del self._keys[b], self._values[b], self._running[b], self._maxes[b]
+            self._tree = None
+        else:
+            self._maxes[b] = self._keys[b][-1]
+            self._recompute(b, i)
+            if len(self._keys[b]) < self._load // 2 and len(self._keys) > 1:
+                self._merge(b)
+            else:
+                self._tree_add(b, [-v for v in old])
+        return old
+
+    def prefix(self, key, inclusive=False):
+        """
+        Sum of the vectors of all keys < key (<= key if inclusive) - O(log n)
+
+        Returns:
+            list: `width` sums
+        """
+        search = bisect_right if inclusive else bisect_left
+        b = search(self._maxes, key)
+        if b == len(self._maxes):
+            return self._blocks_sum(b)
+        total = self._blocks_sum(b)
+        i = search(self._keys[b], key)
+        if i:
+            total = [t + r for t, r in zip(total, self._running[b][i - 1])]
+        return total
+
+    def range_sum(self, low=None, high=None):
+        """
+        Sum of the vectors of all keys with low <= key <= high - O(log n)
+
+        Args:
+            low: Lower bound (None = no bound)
+            high: Upper bound (None = no bound)
+
+        Returns:
+            list: `width` sums
+        """
+        upper = self._blocks_sum(len(self._maxes)) if high is None else self.prefix(high, inclusive=True)
+        if low is None:
+            return upper
+        lower = self.prefix(low)
+        return [u - l for u, l in zip(upper, lower)]
+
+    # Internal helpers
+
+    def _recompute(self, b, i):
+        values = self._values[b]
+        running = self._running[b]
+        total = running[i - 1] if i else (0,) * self._width
+        for j in range(i, len(values)):
+            total = tuple(t + v for t, v in zip(total, values[j]))
+            running[j] = total
+
+    def _split(self, b):
+        half = len(self._keys[b]) // 2
+        for blocks in (self._keys, self._values, self._running):
+            blocks.insert(b + 1, blocks[b][half:])
+            del blocks[b][half:]
+        self._maxes.insert(b, self._keys[b][-1])
+        self._recompute(b + 1, 0)
+        self._tree = None
+
+    def _merge(self, b):
+        if b == len(self._keys) - 1:
+            b -= 1
+        for blocks in (self._keys, self._values, self._running):
+            blocks[b].extend(blocks.pop(b + 1))
+        del self._maxes[b]
+        self._maxes[b] = self._keys[b][-1]
+        self._recompute(b, 0)
+        self._tree = None
+        if len(self._keys[b]) > 2 * self._load:
+            self._split(b)
+
+    def _build_tree(self):
+        zero = (0,) * self._width
+        tree = [list(zero)] + [list(running[-1]) for running in self._running]
+        for i in range(1, len(tree)):
+            parent = i + (i & -i)
+            if parent < len(tree):
+                tree[parent] = [p + c for p, c in zip(tree[parent], tree[i])]
+        self._tree = tree
+
+    def _tree_add(self, b, delta):
+        tree = self._tree
+        if tree is None:
+            return
+        i = b + 1
+        while i < len(tree):
+            node = tree[i]
+            for d in range(self._width):
+                node[d] += delta[d]
+            i += i & -i
+
+    def _blocks_sum(self, b):
+        """Sum of blocks 0..b-1"""
+        if self._tree is None:
+            self._build_tree()
+        tree = self._tree
+        total = [0] * self._width
+        while b > 0:
+            node = tree[b]
+            for d in range(self._width):
+                total[d] += node[d]
+            b -= b & -b
+        return total
+
+
+def parse_time(value):
+    """
+    Convert a time to milliseconds since the epoch
+
+    Args:
+        value: Epoch milliseconds (int or digit string) or an ISO 8601
+            date/datetime string ("2024-05-10", "2024-05-10T16:30:00");
+            ISO times without a timezone are taken as UTC
+
+    Returns:
+        int: Milliseconds since the epoch, or None if value isn't a time
+    """
+    if isinstance(value, bool) or value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    if not isinstance(value, str):
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    try:
+        moment = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=datetime.timezone.utc)
+    return int(moment.timestamp() * 1000)
+
+
+def ledger_time(transaction):
+    """
+    Time of a transaction in milliseconds since the epoch, or None
+
+    Parsed SMS carry the backup's `date` attribute; API-created
+    transactions may give `date` as epoch milliseconds, an ISO string,
+    or leave it out (those are counted as undated).
+    """
+    return parse_time(transaction.get("date"))
+
+
+def signed_flows(transaction):
+    """
+    Inflow, outflow and fee of a transaction
+
+    Returns:
+        tuple: (inflow, outflow, fee); unknown types move no money
+    """
+    amount = transaction.get("amount") or 0
+    fee = transaction.get("fee") or 0
+    t_type = str(transaction.get("type", transaction.get("transaction_type", ""))).lower()
+    if not isinstance(amount, (int, float)) or not isinstance(fee, (int, float)):
+        return 0, 0, 0
+    if t_type in CREDIT_TYPES:
+        return amount, 0, fee
+    if t_type in DEBIT_TYPES:
+        return 0, amount, fee
+    return 0, 0, fee
+
+
+class Ledger:
+    """
+    Transactions ordered by (time, id) with flow totals and balance checks
+
+    Not thread-safe on its own; the routes store updates it under its
+    write lock.
+    """
+
+    def __init__(self, tolerance=0):
+        """
+        Args:
+            tolerance (int): Largest difference (RWF) not reported as a mismatch
+        """
+        self.tolerance = tolerance
+        self.rebuild([])
+
+    def rebuild(self, transactions):
+        """Replace the ledger contents with a list of transactions"""
+        self._sums = PrefixSumIndex()
+        # (time, id) -> reported balance, for messages that report one
+        self._anchors = SortedIndex()
+        self._keys = {}
+        self.mismatches = SortedIndex()
+        self.undated = set()
+
+        entries = []
+        for transaction in transactions:
+            key = self._key(transaction)
+            if key is None:
+                continue
+            entries.append((key, transaction))
+
+        # Bulk load in time order, then check every balance once
+        entries.sort(key=lambda entry: entry[0])
+        previous_balance = None
+        flow_since = 0
+        anchors = []
+        for key, transaction in entries:
+            inflow, outflow, fee = signed_flows(transaction)
+            self._sums.insert(key, (inflow, outflow, fee, 1))
+            flow_since += inflow - outflow - fee
+            balance = self._balance(transaction)
+            if balance is not None:
+                anchors.append((key, balance))
+                if previous_balance is not None:
+                    self._record(key, previous_balance + flow_since, balance)
+                previous_balance = balance
+                flow_since = 0
+        self._anchors.update(anchors)
+
+    def add(self, transaction):
+        """Add a transaction (store insert)"""
+        key = self._key(transaction)
+        if key is None:
+            return
+        inflow, outflow, fee = signed_flows(transaction)
+        self._sums.insert(key, (inflow, outflow, fee, 1))
+        balance = self._balance(transaction)
+        if balance is not None:
+            self._anchors.insert(key, balance)
+            self._check(key)
+        self._check_next(key)
+
+    def remove(self, transaction):
+        """Remove a transaction (store delete, or the old version on update)"""
+        transaction_id = transaction.get("id")
+        self.undated.discard(transaction_id)
+        key = self._keys.pop(transaction_id, None)
+        if key is None:
+            return
+        self._sums.pop(key)
+        self._anchors.pop(key)
+        self.mismatches.pop(key)
+        self._check_next(key)
+
+    def summary(self, start=None, end=None, limit=100):
+        """
+        Net flow between two times (inclusive) - O(log n) plus the mismatches listed
+
+        Args:
+            start (int): From, in epoch milliseconds (None = beginning)
+            end (int): To, in epoch milliseconds (None = end)
+            limit (int): Most mismatches to list
+
+        Returns:
+            dict: inflow, outflow, fees, net, count and balance mismatches
+        """
+        low = None if start is None else (start, float("-inf"))
+        high = None if end is None else (end, float("inf"))
+        inflow, outflow, fees, count = self._sums.range_sum(low, high)
+
+        mismatches = []
+        mismatch_count = self.mismatches.count_range(low, high)
+        for _, mismatch in self.mismatches.irange(low, high):
+            if len(mismatches) >= limit:
+                break
+            mismatches.append(mismatch)
+
+        return {
+            "from": start,
+            "to": end,
+            "count": count,
+            "inflow": inflow,
+            "outflow": outflow,
+            "fees": fees,
+            "net": inflow - outflow - fees,
+            "balance_mismatch_count": mismatch_count,
+            "balance_mismatches": mismatches,
+            "undated_transactions": len(self.undated)
+        }
+
+    # Internal helpers
+
+    def _key(self, transaction):
+        time_ms = ledger_time(transaction)
+        transaction_id = transaction.get("id")
+        if time_ms is None:
+            self.undated.add(transaction_id)
+            return None
+        key = (time_ms, transaction_id)
+        self._keys[transaction_id] = key
+        return key
+
+    @staticmethod
+    def _balance(transaction):
+        balance = transaction.get("balance")
+        if isinstance(balance, bool) or not isinstance(balance, (int, float)):
+            return None
+        return balance
+
+    def _check(self, key):
+        """Compare the balance reported at key with the previous balance plus flows since"""
+        reported = self._anchors.get(key)
+        if reported is None:
+            return
+        previous = next(self._anchors.irange(high=key, inclusive=(True, False), reverse=True), None)
+        if previous is None:
+            self.mismatches.pop(key)
+            return
+        previous_key, previous_balance = previous
+        # Flows after the previous balance (which already reflects its own message) up to this one
+        inflow, outflow, fees, _ = [a - b for a, b in zip(self._sums.prefix(key, inclusive=True),
+                                                          self._sums.prefix(previous_key, inclusive=True))]
+        self._record(key, previous_balance + inflow - outflow - fees, reported)
+
+    def _check_next(self, key):
+        """Re-check the first balance-reporting message after key"""
+        following = next(self._anchors.irange(low=key, inclusive=(False, True)), None)
+        if following is not None:
+            self._check(following[0])
+
+    def _record(self, key, expected, reported):
+        if abs(expected - reported) > self.tolerance:
+            self.mismatches.insert(key, {
+                "id": key[1],
+                "date": key[0],
+                "reported_balance": reported,
+                "expected_balance": expected,
+                "difference": reported - expected
+            })
+        else:
+            self.mismatches.pop(key)
+
+
+# Test the ledger
+if __name__ == "__main__":
+    import random
+
+    print("Ledger Test")
+    print("=" * 50)
+
+    day = 86400000
+    sample = [
+        {"id": 1, "type": "received", "amount": 2000, "fee": 0, "balance": 2000, "date": 1 * day},
+        {"id": 2, "type": "sent", "amount": 1000, "fee": 0, "balance": 1000, "date": 2 * day},
+        {"id": 3, "type": "deposit", "amount": 40000, "fee": None, "balance": 41000, "date": 3 * day},
+        {"id": 4, "type": "sent", "amount": 10000, "fee": 100, "balance": 30000, "date": 4 * day},
+    ]
+    ledger = Ledger()
+    ledger.rebuild(sample)
+    summary = ledger.summary(2 * day, 4 * day)
+    print(f"Days 2-4: in {summary['inflow']}, out {summary['outflow']}, fees {summary['fees']}, "
+          f"net {summary['net']}")
+    print(f"Mismatches: {summary['balance_mismatches']}")
+
+    # Check incremental updates against a full rebuild and brute force sums
+    rng = random.Random(3)
+    store = {}
+    incremental = Ledger()
+    for step in range(3000):
+        transaction_id = rng.randint(1, 400)
+        if transaction_id in store:
+            incremental.remove(store.pop(transaction_id))
+        if rng.random() < 0.7:
+            transaction = {
+                "id": transaction_id,
+                "type": rng.choice(["received", "sent", "deposit", "unknown"]),
+                "amount": rng.randint(1, 50) * 100,
+                "fee": rng.choice([0, 0, 100, None]),
+                "balance": rng.choice([None, rng.randint(0, 20) * 1000]),
+                "date": rng.randint(1, 60) * day
+            }
+            store[transaction_id] = transaction
+            incremental.add(transaction)
+
+    full = Ledger()
+    full.rebuild(list(store.values()))
+    for _ in range(300):
+        start, end = sorted(rng.randint(0, 61) * day for _ in range(2))
+        expected = [0, 0, 0, 0]
+        for transaction in store.values():
+            if start <= transaction["date"] <= end:
+                flows = signed_flows(transaction) + (1,)
+                expected = [e + f for e, f in zip(expected, flows)]
+        for result in (incremental.summary(start, end), full.summary(start, end)):
+            assert [result["inflow"], result["outflow"], result["fees"], result["count"]] == expected
+        assert incremental.summary(start, end)["balance_mismatches"] == full.summary(start, end)["balance_mismatches"]
+    print(f"\n✓ Incremental ledger matches a rebuild and brute-force sums ({len(store)} transactions)")
@@ -1,65 +1,336 @@
-import xml.etree.ElementTree as ET
 import os
 import re
+from collections import OrderedDict
 
+try:
+    from dsa.xml_backends import expected_count, iter_records
+except ImportError:
+    from xml_backends import expected_count, iter_records
 
-def parse_xml_file(file_path):
-    # Check if XML file exists
-    if not os.path.exists(file_path):
-        print("XML file not found")
-        return []
+_BALANCE_RE = re.compile(r"new balance\s*:?\s*([\d,]+)\s*rwf")
+_FEE_RE = re.compile(r"fee (?:was|paid)\s*:?\s*([\d,]+)\s*rwf")
+_RECEIVED_AMOUNT_RE = re.compile(r"received\s+([\d,]+)\s+rwf")
+_SENDER_RE = re.compile(r"from\s+([a-z ]+)")
+_PAYMENT_AMOUNT_RE = re.compile(r"of\s+([\d,]+)\s+rwf")
+_TRANSFER_AMOUNT_RE = re.compile(r"([\d,]+)\s+rwf\s+transferred to")
+_RECEIVER_RE = re.compile(r"to\s+([a-z ]+)")
+_DEPOSIT_AMOUNT_RE = re.compile(r"deposit of\s+([\d,]+)\s+rwf")
+
+# Every ASCII digit becomes a byte UTF-8 never uses, so a fingerprint keeps
+# where the digits are but not what they are
+_DIGIT_PLACEHOLDERS = bytes.maketrans(b"0123456789", b"\xff" * 10)
+
+DEFAULT_MAX_TEMPLATES = 4096
+
+
+def _to_int(text):
+    return int(text.replace(",", ""))
+
+
+def _match_rule(body):
+    """
+    Run the extraction rules on a lower-cased SMS body
+
+    Returns:
+        tuple: (type, sender, receiver, numbers), numbers being
+        ((field, start, end), ...) spans of the figures in the body
+    """
+    numbers = []
+    sender = receiver = None
+
+    # Figures reported by the message itself
+    balance = _BALANCE_RE.search(body)
+    fee = _FEE_RE.search(body)
+    if balance:
+        numbers.append(("balance",) + balance.span(1))
+    if fee:
+        numbers.append(("fee",) + fee.span(1))
+
+    if "received" in body:
+        transaction_type = "received"
+
+        amount = _RECEIVED_AMOUNT_RE.search(body)
+        name = _SENDER_RE.search(body)
+
+        if amount:
+            numbers.append(("amount",) + amount.span(1))
+        if name:
+            sender = name.group(1).strip()
+
+        receiver = "self"
+
+    elif "payment of" in body or "transferred to" in body:
+        transaction_type = "sent"
+
+        amount = _PAYMENT_AMOUNT_RE.search(body) or _TRANSFER_AMOUNT_RE.search(body)
+        name = _RECEIVER_RE.search(body)
+
+        if amount:
+            numbers.append(("amount",) + amount.span(1))
+        if name:
+            receiver = name.group(1).strip()
+
+        sender = "self"
+
+    elif "bank deposit of" in body:
+        transaction_type = "deposit"
+
+        amount = _DEPOSIT_AMOUNT_RE.search(body)
+        if amount:
+            numbers.append(("amount",) + amount.span(1))
+
+        sender = "bank"
+        receiver = "self"
+
+    else:
+        transaction_type = "unknown"
+
+    return transaction_type, sender, receiver, tuple(numbers)
+
+
+class TemplateCache:
+    """
+    Extraction rules remembered per message template
+
+    MoMo messages come from a few dozen templates, so most bodies differ
+    from one seen before only in their digits. The fingerprint of a body is
+    the body with each digit replaced by a placeholder. The rules look at
+    digits only as "some digit", so two bodies with the same fingerprint get
+    the same type, sender and receiver, and their figures sit at the same
+    offsets: a hit slices the figures out instead of running the rules.
 
-    tree = ET.parse(file_path)
-    root = tree.getroot()
+    Names stay in the fingerprint: rules read them (a name containing
+    "received" changes the type), so each template is learned once per
+    counterparty.
 
-    transactions = []
+    Holds at most max_templates rules, least recently used evicted first.
+    Not thread-safe; use one per parse.
+    """
 
-    for index, sms in enumerate(root.findall("sms"), start=1):
-        body = sms.get("body", "").lower()
+    def __init__(self, max_templates=DEFAULT_MAX_TEMPLATES):
+        self.max_templates = max_templates
+        self._rules = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
 
-        transaction = {
-            "id": index,
-            "type": "unknown",
-            "amount": None,
-            "sender": None,
-            "receiver": None,
-            "timestamp": sms.get("readable_date"),
-            "raw_text": sms.get("body")
+    def __len__(self):
+        return len(self._rules)
+
+    def rule(self, body_text):
+        """
+        The extraction rule for an SMS body, learned on a miss
+
+        Returns:
+            tuple: (rule, body), body being the text the rule's spans index
+            (see _match_rule)
+        """
+        if self.max_templates <= 0:
+            self.misses += 1
+            body = body_text.lower()
+            return _match_rule(body), body
+
+        fingerprint = body_text.encode("utf-8", "surrogatepass").translate(_DIGIT_PLACEHOLDERS)
+        rule = self._rules.get(fingerprint)
+        if rule is not None:
+            self.hits += 1
+            self._rules.move_to_end(fingerprint)
+            return rule, body_text
+
+        self.misses += 1
+        body = body_text.lower()
+        rule = _match_rule(body)
+        # Spans index the lower-cased text; they fit the original only when
+        # lowering kept every character one character
+        if len(body) == len(body_text):
+            self._rules[fingerprint] = rule
+            if len(self._rules) > self.max_templates:
+                self._rules.popitem(last=False)
+                self.evictions += 1
+        return rule, body
+
+    def stats(self):
+        """Template count, hits, misses and hit rate"""
+        lookups = self.hits + self.misses
+        return {
+            "templates": len(self._rules),
+            "max_templates": self.max_templates,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else None,
+            "evictions": self.evictions
         }
 
-        if "received" in body:
-            transaction["type"] = "received"
 
-            amount = re.search(r"received\s+([\d,]+)\s+rwf", body)
-            sender = re.search(r"from\s+([a-z ]+)", body)
+def parse_sms(index, body_text, readable_date, date=None, templates=None):
+    """
+    Turn one SMS body into a transaction dict
+
+    Args:
+        index (int): Transaction ID to assign
+        body_text (str): The SMS body
+        readable_date (str): The readable_date attribute
+        date (str): The date attribute (milliseconds since the epoch)
+        templates (TemplateCache): Rules already learned for similar
+            bodies; without one the rules run on every body
+
+    Returns:
+        dict: Parsed transaction
+    """
+    if templates is not None and body_text:
+        (transaction_type, sender, receiver, numbers), body = templates.rule(body_text)
+    else:
+        body = (body_text or "").lower()
+        transaction_type, sender, receiver, numbers = _match_rule(body)
 
-            if amount:
-                transaction["amount"] = int(amount.group(1).replace(",", ""))
-            if sender:
-                transaction["sender"] = sender.group(1).strip()
+    transaction = {
+        "id": index,
+        "type": transaction_type,
+        "amount": None,
+        "sender": sender,
+        "receiver": receiver,
+        "fee": None,
+        "balance": None,
+        "timestamp": readable_date,
+        "date": int(date) if date and date.isdigit() else None,
+        "raw_text": body_text
+    }
+    for field, start, end in numbers:
+        transaction[field] = _to_int(body[start:end])
 
-            transaction["receiver"] = "self"
+    return transaction
 
-        elif "payment of" in body or "transferred to" in body:
-            transaction["type"] = "sent"
 
-            amount = re.search(r"of\s+([\d,]+)\s+rwf", body)
-            receiver = re.search(r"to\s+([a-z ]+)", body)
+def iter_xml_transactions(file_path, progress=None, progress_every=1000, backend=None, templates=None):
+    """
+    Parse an SMS backup one transaction at a time
 
-            if amount:
-                transaction["amount"] = int(amount.group(1).replace(",", ""))
-            if receiver:
-                transaction["receiver"] = receiver.group(1).strip()
+    The file is read incrementally and nothing is kept once a message is
+    parsed, so memory stays flat however large the backup is.
 
-            transaction["sender"] = "self"
+    Args:
+        file_path (str): Path to the <smses> XML backup
+        progress (callable): Optional progress(parsed_count, expected_total)
+            callback; expected_total comes from the backup's count attribute
+            and may be None
+        progress_every (int): Messages between progress callbacks
+        backend (str): XML parser backend, 'auto' (default), 'etree', 'lxml'
+            or 'scan' (see xml_backends)
+        templates (TemplateCache): Template rules to use and learn; pass
+            one to read its hit rate afterwards. Defaults to a new cache of
+            DEFAULT_MAX_TEMPLATES; TemplateCache(0) learns nothing
 
-        transactions.append(transaction)
+    Yields:
+        dict: Transactions, with IDs 1, 2, 3... in file order
+    """
+    expected = expected_count(file_path) if progress else None
+    if templates is None:
+        templates = TemplateCache()
+    index = 0
 
-    return transactions
+    for index, (body, readable_date, date) in enumerate(iter_records(file_path, backend), 1):
+        yield parse_sms(index, body, readable_date, date, templates)
 
+        if progress and index % progress_every == 0:
+            progress(index, expected)
 
+    if progress:
+        progress(index, expected)
+
+
+def parse_xml_file(file_path, progress=None, progress_every=1000, backend=None, templates=None):
+    """
+    Parse an SMS backup into a list of transactions
+
+    The file is read incrementally, so progress can be reported while it loads.
+
+    Args:
+        file_path (str): Path to the <smses> XML backup
+        progress (callable): Optional progress(parsed_count, expected_total)
+            callback; expected_total comes from the backup's count attribute
+            and may be None
+        progress_every (int): Messages between progress callbacks
+        backend (str): XML parser backend (see iter_xml_transactions)
+        templates (TemplateCache): Template rules (see iter_xml_transactions)
+
+    Returns:
+        list: Transaction dictionaries
+    """
+    # Check if XML file exists
+    if not os.path.exists(file_path):
+        print("XML file not found")
+        return []
+
+    return list(iter_xml_transactions(file_path, progress, progress_every, backend, templates))
+
+
+# Parse the sample backup, then check and time the template cache
 if __name__ == "__main__":
-    data = parse_xml_file("../data/modified_sms_v2.xml")
+    import sys
+    import tempfile
+    import time
+
+    try:
+        from dsa.generate_sms import write_sms_backup
+    except ImportError:
+        from generate_sms import write_sms_backup
+
+    sample = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "modified_sms_v2.xml")
+    data = parse_xml_file(sample)
     print("Total transactions:", len(data))
     print(data[:2])
 
+    # Bodies a fingerprint mustn't lump together
+    tricky = ["You have received 2000 RWF from Jane Smith (*1) at 10:00. Your new balance:2000 RWF.",
+              "You have received 15,000 RWF from Jane Smith (*2) at 11:00. Your new balance:17,000 RWF.",
+              "You have received 2000 RWF from Jane Received (*1) at 10:00.",
+              "Your payment of 1,000 RWF to Jane Smith 12845 has been completed. Fee was 0 RWF.",
+              "Your payment of 9,500 RWF to Jane Smith 99999 has been completed. Fee was 20 RWF.",
+              "Your payment of 1,000 RWF to Jane Smith 12845 has been completed.",
+              "Your payment of 1,0 RWF to Jane Smith 12845 has been completed. Fee was 00 RWF.",
+              "A bank deposit of 40000 RWF has been added. Your NEW BALANCE :40400 RWF.",
+              "A bank deposit of 40000 RWF has been added. Your NEW BALANCE :40400 RWF. İ",
+              "Yello! 500FRW(800MB)", ""]
+    templates = TemplateCache()
+    for _ in range(2):
+        for i, body in enumerate(tricky):
+            assert parse_sms(i, body, None, None, templates) == parse_sms(i, body, None), body
+    print(f"✓ Tricky bodies parse the same with templates: {templates.stats()}")
+
+    # A small table still gives the same answers, evicting as it goes
+    small = TemplateCache(8)
+    assert parse_xml_file(sample, templates=small) == parse_xml_file(sample, templates=TemplateCache(0)) == data
+    assert len(small) == 8 and small.evictions > 0
+    print(f"✓ Sample backup parses the same with an 8-template table ({small.evictions} evictions)")
+
+    # A large backup, with and without templates
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "synthetic.xml")
+    write_sms_backup(path, count, seed=3)
+    records = list(iter_records(path))
+
+    def parse_all(cache):
+        return [parse_sms(i, body, readable_date, date, cache)
+                for i, (body, readable_date, date) in enumerate(records, 1)]
+
+    timings = {}
+    for label, make in (("rules every time", lambda: TemplateCache(0)), ("templates", TemplateCache)):
+        best = float("inf")
+        for _ in range(3):
+            cache = make()
+            begin = time.perf_counter()
+            result = parse_all(cache)
+            best = min(best, time.perf_counter() - begin)
+        timings[label] = (best, result, cache)
+
+    (plain_time, plain, _), (cached_time, cached, cache) = timings.values()
+    assert cached == plain
+    stats = cache.stats()
+    print(f"\n{count} synthetic messages (records already read):")
+    print(f"  rules every time {count / plain_time:>10.0f} msg/s")
+    print(f"  templates        {count / cached_time:>10.0f} msg/s  ({plain_time / cached_time:.1f}x)")
+    print(f"  {stats['templates']} templates, hit rate {stats['hit_rate']:.1%}")
+
+    os.remove(path)
+    os.rmdir(directory)
@@ -0,0 +1,604 @@
+"""
+Cold Storage Segments
+Older transactions can be moved out of memory into immutable segment
+files: transactions sorted by ID, in blocks of BLOCK_SIZE, each block
+zlib-compressed JSON. A footer indexes the blocks (ID range, time range
+and types), so a lookup reads one block and a filtered scan skips the
+blocks that can't match.
+
+Blocks are read through an LRU block cache with a memory budget. Blocks
+read by scans enter at the cold end of the LRU, so one big export doesn't
+push out the blocks serving point lookups.
+
+Segments never change. Updates and deletes of cold transactions are kept
+as patches (ID -> new transaction, or None when deleted) in the store's
+manifest, which, like the segments list, is replaced rather than modified,
+so a reader holding a manifest sees a consistent cold tier.
+"""
+
+import bisect
+import glob
+import json
+import os
+import struct
+import sys
+import threading
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    from dsa.counterparties import transaction_type
+    from dsa.ledger import ledger_time
+except ImportError:
+    from counterparties import transaction_type
+    from ledger import ledger_time
+
+MAGIC = b"MOMOSEG1"
+# index offset, index length, magic
+_TRAILER = struct.Struct("<QQ8s")
+
+# Transactions per compressed block: bigger blocks compress a little
+# better, smaller ones are quicker to decompress for a single lookup
+BLOCK_SIZE = 64
+COMPRESSION_LEVEL = 6
+# Memory held by decoded transactions per byte of their JSON (measured on
+# parsed SMS); cheaper than sizing every dict of a block
+_JSON_TO_MEMORY = 3
+
+
+def transaction_size(transaction):
+    """Approximate memory held by one transaction dict, in bytes"""
+    return sys.getsizeof(transaction) + sum(sys.getsizeof(value) for value in transaction.values())
+
+
+def _read_at(handle, offset, length):
+    if hasattr(os, "pread"):
+        return os.pread(handle.fileno(), length, offset)
+    handle.seek(offset)
+    return handle.read(length)
+
+
+class Segment:
+    """One immutable segment file: compressed blocks plus their index"""
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str): Segment file written by write_segment()
+
+        Raises:
+            ValueError: The file isn't a complete segment
+        """
+        self.path = path
+        self._file = open(path, "rb")
+        self._lock = threading.Lock()
+        size = os.fstat(self._file.fileno()).st_size
+        if size < len(MAGIC) + _TRAILER.size:
+            raise ValueError(f"{path}: not a segment file")
+        with self._lock:
+            trailer = _read_at(self._file, size - _TRAILER.size, _TRAILER.size)
+            offset, length, magic = _TRAILER.unpack(trailer)
+            if magic != MAGIC:
+                raise ValueError(f"{path}: not a segment file")
+            index = json.loads(_read_at(self._file, offset, length))
+        # Per block: [first_id, last_id, offset, length, count, min_time, max_time, types]
+        self.blocks = index["blocks"]
+        self.count = index["count"]
+        self.bytes = size
+        self._firsts = [block[0] for block in self.blocks]
+        self.first_id = self.blocks[0][0] if self.blocks else None
+        self.last_id = self.blocks[-1][1] if self.blocks else None
+
+    def find(self, transaction_id):
+        """Number of the block that would hold an ID, or None"""
+        number = bisect.bisect_right(self._firsts, transaction_id) - 1
+        if number < 0 or transaction_id > self.blocks[number][1]:
+            return None
+        return number
+
+    def read_block(self, number):
+        """
+        Decompress one block
+
+        Returns:
+            tuple: (transactions sorted by ID, approximate memory they hold)
+        """
+        block = self.blocks[number]
+        with self._lock:
+            data = _read_at(self._file, block[2], block[3])
+        data = zlib.decompress(data)
+        return json.loads(data), len(data) * _JSON_TO_MEMORY
+
+    def close(self):
+        self._file.close()
+
+
+def write_segment(path, transactions, block_size=BLOCK_SIZE, level=COMPRESSION_LEVEL):
+    """
+    Write transactions (sorted by ID) to a new segment file
+
+    The file is written under a temporary name and renamed when complete.
+
+    Args:
+        path (str): Segment file to create
+        transactions (list): Transaction dicts, sorted by ID
+        block_size (int): Transactions per block
+        level (int): zlib compression level
+
+    Returns:
+        Segment: The new segment, open for reading
+    """
+    temporary = path + ".tmp"
+    blocks = []
+    with open(temporary, "wb") as out:
+        out.write(MAGIC)
+        offset = len(MAGIC)
+        for start in range(0, len(transactions), block_size):
+            chunk = transactions[start:start + block_size]
+            data = zlib.compress(json.dumps(chunk, separators=(",", ":")).encode(), level)
+            out.write(data)
+            times = [t for t in map(ledger_time, chunk) if t is not None]
+            blocks.append([chunk[0]["id"], chunk[-1]["id"], offset, len(data), len(chunk),
+                           min(times) if times else None, max(times) if times else None,
+                           sorted({transaction_type(t) for t in chunk})])
+            offset += len(data)
+        index = json.dumps({"count": len(transactions), "blocks": blocks}).encode()
+        out.write(index)
+        out.write(_TRAILER.pack(offset, len(index), MAGIC))
+        out.flush()
+        os.fsync(out.fileno())
+    os.replace(temporary, path)
+    return Segment(path)
+
+
+class BlockCache:
+    """
+    Decompressed blocks, least recently used evicted first
+
+    Thread-safe: lookups come from readers that don't hold the store lock.
+    """
+
+    def __init__(self, budget_bytes):
+        """
+        Args:
+            budget_bytes (int): Most memory (estimated) held by cached blocks
+        """
+        self.budget_bytes = budget_bytes
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            # (segment path, block number) -> (ids, transactions, size)
+            self._blocks = OrderedDict()
+            self.used_bytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def get(self, segment, number, scan=False):
+        """
+        A block's (ids, transactions), read from the segment on a miss
+
+        Args:
+            segment (Segment): Segment holding the block
+            number (int): Block number
+            scan (bool): Read by a scan: a miss is cached at the cold end
+
+        Returns:
+            tuple: (list of IDs, list of transactions), both sorted by ID
+        """
+        key = (segment.path, number)
+        with self._lock:
+            entry = self._blocks.get(key)
+            if entry is not None:
+                self.hits += 1
+                self._blocks.move_to_end(key)
+                return entry[0], entry[1]
+            self.misses += 1
+
+        # Decompress outside the lock; two readers may both load a block
+        transactions, size = segment.read_block(number)
+        ids = [t["id"] for t in transactions]
+        if size > self.budget_bytes:
+            return ids, transactions
+
+        with self._lock:
+            if key not in self._blocks:
+                self._blocks[key] = (ids, transactions, size)
+                self.used_bytes += size
+                if scan:
+                    self._blocks.move_to_end(key, last=False)
+                while self.used_bytes > self.budget_bytes:
+                    _, (_, _, evicted) = self._blocks.popitem(last=False)
+                    self.used_bytes -= evicted
+                    self.evictions += 1
+        return ids, transactions
+
+    def discard(self, path):
+        """Drop the blocks of a segment that is going away"""
+        with self._lock:
+            for key in [key for key in self._blocks if key[0] == path]:
+                self.used_bytes -= self._blocks.pop(key)[2]
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "budget_bytes": self.budget_bytes,
+                "used_bytes": self.used_bytes,
+                "blocks": len(self._blocks),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None
+            }
+
+
+class Manifest:
+    """The cold tier at one moment: segments, patches and the live count"""
+
+    __slots__ = ("segments", "patches", "patch_ids", "count")
+
+    def __init__(self, segments=(), patches=None, count=0):
+        self.segments = tuple(segments)
+        # ID -> updated transaction, or None if deleted
+        self.patches = patches or {}
+        self.patch_ids = sorted(self.patches)
+        self.count = count
+
+
+def _writer_exited(name):
+    """True if the process that wrote this segment file (named <pid>-<n>.seg) is gone"""
+    if os.name != "posix":
+        # No harmless way to probe another process; leave the file
+        return False
+    try:
+        pid = int(name.split("-", 1)[0])
+    except ValueError:
+        return False
+    if pid == os.getpid():
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return True
+    except OSError:
+        # Exists, owned by someone else
+        return False
+    return False
+
+
+class ColdStore:
+    """
+    Segments of older transactions, with a block cache and patches
+
+    Writes (compact, patch, reset) are made by one writer at a time (the
+    routes store holds its write lock); reads work from whichever manifest
+    they picked up and need no lock.
+    """
+
+    def __init__(self, directory, cache_bytes, block_size=BLOCK_SIZE):
+        """
+        Args:
+            directory (str): Where segment files are written
+            cache_bytes (int): Block cache budget
+            block_size (int): Transactions per block
+        """
+        self.directory = directory
+        self.block_size = block_size
+        self.cache = BlockCache(cache_bytes)
+        self.manifest = Manifest()
+        # Odd while a change spanning the hot and cold tiers is being published
+        self.seq = 0
+        self._next_segment = 0
+        # (process ID, path) of each segment file written; reset() removes
+        # only this process's, so stores sharing a directory (or a pre-fork
+        # parent's segments, still read by its workers) are left alone
+        self._written = []
+
+    def __len__(self):
+        return self.manifest.count
+
+    @contextmanager
+    def publishing(self):
+        """Mark a change that readers must not see half-done (see the seq check in routes.snapshot)"""
+        self.seq += 1
+        try:
+            yield
+        finally:
+            self.seq += 1
+
+    def reset(self):
+        """
+        Drop every segment (before the store is reloaded)
+
+        Deletes the files this process wrote, and those left in the
+        directory by processes that have exited; files of other running
+        servers are theirs to delete.
+        """
+        for segment in self.manifest.segments:
+            self.cache.discard(segment.path)
+        self.manifest = Manifest()
+        pid = os.getpid()
+        stale = [path for path in glob.glob(os.path.join(self.directory, "*.seg"))
+                 if _writer_exited(os.path.basename(path))]
+        for path in [path for writer, path in self._written if writer == pid] + stale:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self._written = [(writer, path) for writer, path in self._written if writer != pid]
+
+    def write_segment(self, transactions):
+        """
+        Write transactions (sorted by ID) to a new segment file
+
+        The segment isn't visible to readers until add_segment().
+
+        Returns:
+            Segment: The new segment
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        self._next_segment += 1
+        # The process ID keeps pre-fork workers' segment names apart
+        name = "{}-{:06d}.seg".format(os.getpid(), self._next_segment)
+        path = os.path.join(self.directory, name)
+        self._written.append((os.getpid(), path))
+        return write_segment(path, transactions, self.block_size)
+
+    def add_segment(self, segment):
+        """Publish a segment written by write_segment()"""
+        manifest = self.manifest
+        self.manifest = Manifest(manifest.segments + (segment,), manifest.patches,
+                                 manifest.count + segment.count)
+
+    def patch(self, transaction_id, transaction):
+        """
+        Replace (or, with None, delete) a cold transaction
+
+        Copies the patch table, which is small: it only holds cold
+        transactions changed since they were compacted.
+        """
+        manifest = self.manifest
+        patches = dict(manifest.patches)
+        count = manifest.count - (1 if transaction is None else 0)
+        patches[transaction_id] = transaction
+        self.manifest = Manifest(manifest.segments, patches, count)
+
+    def get(self, transaction_id, manifest=None):
+        """
+        A cold transaction by ID
+
+        Returns:
+            dict: The transaction (shared - don't modify it), or None
+        """
+        manifest = manifest or self.manifest
+        if transaction_id in manifest.patches:
+            return manifest.patches[transaction_id]
+        segments = manifest.segments
+        if not segments or not isinstance(transaction_id, int):
+            return None
+        position = bisect.bisect_right([s.first_id for s in segments], transaction_id) - 1
+        if position < 0:
+            return None
+        segment = segments[position]
+        number = segment.find(transaction_id)
+        if number is None:
+            return None
+        ids, transactions = self.cache.get(segment, number)
+        at = bisect.bisect_left(ids, transaction_id)
+        if at < len(ids) and ids[at] == transaction_id:
+            return transactions[at]
+        return None
+
+    def scan(self, manifest=None, t_type=None, start=None, end=None):
+        """
+        Cold transactions in ID order, skipping blocks that can't match
+
+        Blocks are only skipped, not filtered: the caller still checks
+        each transaction against t_type, start and end.
+
+        Args:
+            manifest (Manifest): The cold tier to read (default: current)
+            t_type (str): Type the caller is looking for, lower-case
+            start (int): Window start in epoch ms
+            end (int): Window end in epoch ms
+
+        Yields:
+            dict: Transactions (shared - don't modify them)
+        """
+        manifest = manifest or self.manifest
+        patches = manifest.patches
+        patch_ids = manifest.patch_ids
+        for segment in manifest.segments:
+            for number, block in enumerate(segment.blocks):
+                first_id, last_id, _, _, _, min_time, max_time, types = block
+                skip = (t_type is not None and t_type not in types) or (
+                    (start is not None or end is not None) and (
+                        min_time is None
+                        or (start is not None and max_time < start)
+                        or (end is not None and min_time > end)))
+                if skip:
+                    # Patched transactions may no longer fit the block's index
+                    low = bisect.bisect_left(patch_ids, first_id)
+                    high = bisect.bisect_right(patch_ids, last_id)
+                    for transaction_id in patch_ids[low:high]:
+                        if patches[transaction_id] is not None:
+                            yield patches[transaction_id]
+                    continue
+                _, transactions = self.cache.get(segment, number, scan=True)
+                if not patches:
+                    yield from transactions
+                    continue
+                for transaction in transactions:
+                    transaction_id = transaction["id"]
+                    if transaction_id in patches:
+                        transaction = patches[transaction_id]
+                        if transaction is None:
+                            continue
+                    yield transaction
+
+    def stats(self):
+        manifest = self.manifest
+        return {
+            "transactions": manifest.count,
+            "segments": len(manifest.segments),
+            "segment_bytes": sum(segment.bytes for segment in manifest.segments),
+            "patches": len(manifest.patches),
+            "block_cache": self.cache.stats()
+        }
+
+
+class TieredView:
+    """
+    A pinned hot version with the cold tier underneath, as one ID-ordered
+    sequence (cold IDs are all below the hot ones)
+    """
+
+    def __init__(self, cold_store, manifest, hot):
+        self._cold = cold_store
+        self._manifest = manifest
+        self._hot = hot
+
+    def __len__(self):
+        return self._manifest.count + len(self._hot)
+
+    def __iter__(self):
+        return self.scan()
+
+    def scan(self, t_type=None, start=None, end=None):
+        """Like iter(), skipping cold blocks that can't match the filters"""
+        yield from self._cold.scan(self._manifest, t_type, start, end)
+        yield from self._hot
+
+
+# Test segments and the cold store
+if __name__ == "__main__":
+    import random
+    import shutil
+    import tempfile
+    import time
+
+    print("Cold Storage Segments Test")
+    print("=" * 50)
+
+    rng = random.Random(3)
+    start_ms = 1715351458724
+    types = ["sent", "received", "deposit", "payment"]
+    transactions = []
+    for i in range(1, 100001):
+        name = rng.choice(["Jane Smith", "Alex Doe", "Samuel Carter", "Linda Green"])
+        amount = rng.randint(100, 50000)
+        transactions.append({
+            "id": i, "type": rng.choice(types), "amount": amount, "fee": rng.choice([0, 100, 250]),
+            "sender": "self", "receiver": name, "balance": rng.randint(0, 10 ** 6),
+            "date": start_ms + i * 60000, "timestamp": None,
+            "raw_text": f"*165*S*{amount} RWF transferred to {name} (250791666666) at 2024-05-10 "
+                        f"16:30:51 . Fee was: 100 RWF. New balance: 40400 RWF. TxId: {7000000000 + i}."
+        })
+
+    directory = tempfile.mkdtemp()
+    try:
+        store = ColdStore(directory, cache_bytes=4 * 1024 * 1024)
+        memory = sum(map(transaction_size, transactions))
+        begin = time.perf_counter()
+        for first in range(0, 80000, 40000):
+            store.add_segment(store.write_segment(transactions[first:first + 40000]))
+        elapsed = time.perf_counter() - begin
+        on_disk = store.stats()["segment_bytes"]
+        print(f"Compacted 80000 transactions in {elapsed:.2f}s: {memory * 0.8 / 1e6:.1f} MB in memory "
+              f"-> {on_disk / 1e6:.1f} MB on disk ({memory * 0.8 / on_disk:.0f}x smaller)")
+
+        # Lookups
+        for transaction_id in (1, 256, 257, 40000, 40001, 80000):
+            assert store.get(transaction_id) == transactions[transaction_id - 1], transaction_id
+        assert store.get(80001) is None and store.get(0) is None
+
+        # Patches: update one, delete one
+        changed = dict(transactions[9], amount=1, type="payment")
+        with store.publishing():
+            store.patch(10, changed)
+            store.patch(11, None)
+        assert store.get(10) == changed and store.get(11) is None and len(store) == 79999
+
+        # Scans match a plain filter, including patched transactions
+        def expected(t_type, low, high):
+            result = []
+            for transaction in transactions[:80000]:
+                transaction = {10: changed, 11: None}.get(transaction["id"], transaction)
+                if transaction is None:
+                    continue
+                if t_type and transaction["type"] != t_type:
+                    continue
+                if low is not None and transaction["date"] < low:
+                    continue
+                if high is not None and transaction["date"] > high:
+                    continue
+                result.append(transaction)
+            return result
+
+        def scanned(t_type, low, high):
+            return [t for t in store.scan(None, t_type, low, high)
+                    if (not t_type or t["type"] == t_type)
+                    and (low is None or t["date"] >= low) and (high is None or t["date"] <= high)]
+
+        window = (start_ms + 500 * 60000, start_ms + 900 * 60000)
+        for t_type, low, high in ((None, None, None), ("payment", None, None), (None, *window),
+                                  ("payment", start_ms, start_ms + 20 * 60000)):
+            assert scanned(t_type, low, high) == expected(t_type, low, high)
+        view = TieredView(store, store.manifest, transactions[80000:])
+        assert len(view) == 99999 and len(list(view)) == 99999
+        print("✓ Lookups, patches and filtered scans match the in-memory data")
+
+        # Lookup speed: cached and uncached blocks
+        store.cache.clear()
+        ids = [rng.randint(1, 80000) for _ in range(20000)]
+        begin = time.perf_counter()
+        for transaction_id in ids:
+            store.get(transaction_id)
+        elapsed = time.perf_counter() - begin
+        stats = store.cache.stats()
+        print(f"Random cold lookups: {elapsed / len(ids) * 1e6:.1f} µs each, "
+              f"block cache hit rate {stats['hit_rate']}, {stats['used_bytes'] / 1e6:.1f} MB cached")
+        hot_ids = [rng.randint(1, 2000) for _ in range(20000)]
+        begin = time.perf_counter()
+        for transaction_id in hot_ids:
+            store.get(transaction_id)
+        print(f"Lookups in recently used blocks: {(time.perf_counter() - begin) / len(hot_ids) * 1e6:.1f} µs each")
+
+        # A window scan only opens the blocks inside the window
+        store.cache.clear()
+        begin = time.perf_counter()
+        count = len(scanned(None, *window))
+        print(f"Time-window scan: {count} transactions in {(time.perf_counter() - begin) * 1000:.1f} ms, "
+              f"{store.cache.stats()['misses']} of {sum(len(s.blocks) for s in store.manifest.segments)} blocks read")
+
+        # Scans don't push out blocks used by lookups
+        store.cache.clear()
+        for transaction_id in hot_ids[:2000]:
+            store.get(transaction_id)
+        warm = store.cache.stats()["blocks"]
+        for _ in store.scan():
+            pass
+        misses = store.cache.misses
+        for transaction_id in hot_ids[:2000]:
+            store.get(transaction_id)
+        assert store.cache.misses == misses, "lookup blocks were evicted by the scan"
+        print(f"✓ Full scan kept the {warm} blocks used by lookups cached")
+
+        # reset() deletes this store's segments and those of exited processes,
+        # not another running store's in the same directory
+        other = ColdStore(directory, cache_bytes=0)
+        other._next_segment = 1000
+        kept = other.write_segment(transactions[:100]).path
+        parent = os.path.join(directory, "{}-000001.seg".format(os.getppid()))
+        shutil.copy(kept, parent)
+        exited = os.path.join(directory, "999999999-000001.seg")
+        shutil.copy(kept, exited)
+        store.reset()
+        assert sorted(glob.glob(os.path.join(directory, "*.seg"))) == sorted([kept, parent]) and len(store) == 0
+    finally:
+        shutil.rmtree(directory)
+    print("\n✓ Segment checks passed")
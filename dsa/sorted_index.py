@@ -0,0 +1,446 @@
+"""
+Sorted Index Implementation
+Keeps transactions ordered by ID so we can answer range queries
+("IDs 500 to 900", "next 100 after ID X") and rank queries without
+scanning the whole list.
+
+Keys are stored in a list of sorted blocks (each at most 2 * load keys):
+- Finding a key is two binary searches: one over the block maxima, one
+  inside the block - O(log n)
+- Inserting or deleting shifts at most one small block, so updates stay
+  O(log n) in practice instead of O(n) for one big sorted list
+- A Fenwick tree over the block sizes turns "how many keys come before
+  this one" (rank) and "which key is at position i" (select) into
+  O(log n) operations
+"""
+
+from bisect import bisect_left, bisect_right
+from itertools import islice
+
+DEFAULT_LOAD = 256
+
+
+class SortedIndex:
+    """
+    Ordered mapping of key -> value with range, rank and select queries
+
+    Not thread-safe; callers that share an index between threads must
+    hold their own write lock (like the routes store does).
+    """
+
+    def __init__(self, items=None, load=DEFAULT_LOAD):
+        """
+        Args:
+            items (iterable): Optional (key, value) pairs
+            load (int): Target block size
+        """
+        self._load = load
+        self._keys = []
+        self._values = []
+        self._maxes = []
+        self._len = 0
+        # Fenwick tree over block sizes; None when it has to be rebuilt
+        self._tree = None
+        if items is not None:
+            self.update(items)
+
+    def __len__(self):
+        return self._len
+
+    def __contains__(self, key):
+        return self._find(key) is not None
+
+    def __iter__(self):
+        for block in self._keys:
+            yield from block
+
+    def update(self, items):
+        """
+        Insert many (key, value) pairs at once (later pairs win on duplicate keys)
+        Cheaper than repeated insert(): one sort, then the blocks are rebuilt
+
+        Args:
+            items (iterable): (key, value) pairs
+        """
+        merged = dict(self.items())
+        merged.update(items)
+        keys = sorted(merged)
+        values = [merged[k] for k in keys]
+
+        load = self._load
+        self._keys = [keys[i:i + load] for i in range(0, len(keys), load)]
+        self._values = [values[i:i + load] for i in range(0, len(keys), load)]
+        self._maxes = [block[-1] for block in self._keys]
+        self._len = len(keys)
+        self._tree = None
+
+    def insert(self, key, value):
+        """
+        Add a key, or replace the value of an existing key
+
+        Args:
+            key: Sort key (e.g. transaction ID)
+            value: Data stored under the key
+
+        Returns:
+            bool: True if the key was new, False if its value was replaced
+        """
+        if not self._maxes:
+            self._keys.append([key])
+            self._values.append([value])
+            self._maxes.append(key)
+            self._len = 1
+            self._tree = None
+            return True
+
+        b = bisect_left(self._maxes, key)
+        if b == len(self._maxes):
+            # Larger than every key: append to the last block
+            b -= 1
+            self._keys[b].append(key)
+            self._values[b].append(value)
+            self._maxes[b] = key
+        else:
+            block = self._keys[b]
+            i = bisect_left(block, key)
+            if block[i] == key:
+                self._values[b][i] = value
+                return False
+            block.insert(i, key)
+            self._values[b].insert(i, value)
+
+        self._len += 1
+        if len(self._keys[b]) > 2 * self._load:
+            self._split(b)
+        else:
+            self._tree_add(b, 1)
+        return True
+
+    def pop(self, key, default=None):
+        """
+        Remove a key
+
+        Args:
+            key: Key to remove
+
+        Returns:
+            The removed value, or default if the key was not present
+        """
+        found = self._find(key)
+        if found is None:
+            return default
+        b, i = found
+
+        block = self._keys[b]
+        del block[i]
+        value = self._values[b].pop(i)
+        self._len -= 1
+
+        if not block:
+            del self._keys[b]
+            del self._values[b]
+            del self._maxes[b]
+            self._tree = None
+        else:
+            self._maxes[b] = block[-1]
+            if len(block) < self._load // 2 and len(self._keys) > 1:
+                self._merge(b)
+            else:
+                self._tree_add(b, -1)
+        return value
+
+    def get(self, key, default=None):
+        """
+        Point lookup - O(log n)
+
+        Returns:
+            The value stored under key, or default
+        """
+        found = self._find(key)
+        if found is None:
+            return default
+        b, i = found
+        return self._values[b][i]
+
+    def get_with_count(self, key):
+        """
+        Point lookup that also counts comparisons (binary search steps)
+        Mirrors linear_search_with_count / dict_lookup_with_count
+
+        Returns:
+            tuple: (value or None, comparison_count)
+        """
+        comparisons = len(self._maxes).bit_length()
+        b = bisect_left(self._maxes, key)
+        if b == len(self._maxes):
+            return None, comparisons
+        block = self._keys[b]
+        comparisons += len(block).bit_length()
+        i = bisect_left(block, key)
+        if block[i] != key:
+            return None, comparisons
+        return self._values[b][i], comparisons
+
+    def rank(self, key):
+        """
+        Number of keys smaller than key - O(log n)
+        """
+        b = bisect_left(self._maxes, key)
+        if b == len(self._maxes):
+            return self._len
+        return self._prefix(b) + bisect_left(self._keys[b], key)
+
+    def select(self, position):
+        """
+        The key/value pair at a position in sorted order - O(log n)
+
+        Args:
+            position (int): 0-based position (negative counts from the end)
+
+        Returns:
+            tuple: (key, value)
+        """
+        if position < 0:
+            position += self._len
+        if not 0 <= position < self._len:
+            raise IndexError("SortedIndex position out of range")
+        b, i = self._locate(position)
+        return self._keys[b][i], self._values[b][i]
+
+    def irange(self, low=None, high=None, inclusive=(True, True), reverse=False):
+        """
+        Iterate (key, value) pairs with low <= key <= high in key order
+
+        The index must not be modified while iterating.
+
+        Args:
+            low: Lower bound (None = from the smallest key)
+            high: Upper bound (None = to the largest key)
+            inclusive (tuple): Whether low and high themselves are included
+            reverse (bool): Iterate from high down to low
+
+        Yields:
+            tuple: (key, value)
+        """
+        if not self._maxes:
+            return
+
+        # Position of the first key in range
+        if low is None:
+            start = (0, 0)
+        else:
+            search = bisect_left if inclusive[0] else bisect_right
+            b = search(self._maxes, low)
+            if b == len(self._maxes):
+                return
+            start = (b, search(self._keys[b], low))
+
+        # Position just past the last key in range
+        if high is None:
+            end = (len(self._keys) - 1, len(self._keys[-1]))
+        else:
+            search = bisect_right if inclusive[1] else bisect_left
+            b = search(self._maxes, high)
+            if b == len(self._maxes):
+                end = (b - 1, len(self._keys[b - 1]))
+            else:
+                end = (b, search(self._keys[b], high))
+
+        if start >= end:
+            return
+
+        if reverse:
+            yield from self._iter_reverse(start, end)
+        else:
+            yield from self._iter_forward(start, end)
+
+    def after(self, key, limit):
+        """
+        The next `limit` pairs with keys strictly greater than key
+        (cursor-style pagination: "next 100 after ID X")
+
+        Returns:
+            list: (key, value) pairs
+        """
+        return list(islice(self.irange(low=key, inclusive=(False, True)), limit))
+
+    def count_range(self, low=None, high=None):
+        """
+        Number of keys with low <= key <= high, without iterating them - O(log n)
+        """
+        start = 0 if low is None else self.rank(low)
+        if high is None:
+            end = self._len
+        else:
+            b = bisect_right(self._maxes, high)
+            if b == len(self._maxes):
+                end = self._len
+            else:
+                end = self._prefix(b) + bisect_right(self._keys[b], high)
+        return max(0, end - start)
+
+    def items(self):
+        """All (key, value) pairs in key order"""
+        for keys, values in zip(self._keys, self._values):
+            yield from zip(keys, values)
+
+    def values(self):
+        """All values in key order"""
+        for values in self._values:
+            yield from values
+
+    # Internal helpers
+
+    def _find(self, key):
+        b = bisect_left(self._maxes, key)
+        if b == len(self._maxes):
+            return None
+        block = self._keys[b]
+        i = bisect_left(block, key)
+        if block[i] != key:
+            return None
+        return b, i
+
+    def _iter_forward(self, start, end):
+        b, i = start
+        end_b, end_i = end
+        while b < end_b:
+            yield from zip(self._keys[b][i:], self._values[b][i:])
+            b += 1
+            i = 0
+        yield from zip(self._keys[b][i:end_i], self._values[b][i:end_i])
+
+    def _iter_reverse(self, start, end):
+        start_b, start_i = start
+        b, i = end
+        while b > start_b:
+            keys, values = self._keys[b], self._values[b]
+            for j in range(i - 1, -1, -1):
+                yield keys[j], values[j]
+            b -= 1
+            i = len(self._keys[b])
+        keys, values = self._keys[b], self._values[b]
+        for j in range(i - 1, start_i - 1, -1):
+            yield keys[j], values[j]
+
+    def _split(self, b):
+        half = len(self._keys[b]) // 2
+        self._keys.insert(b + 1, self._keys[b][half:])
+        self._values.insert(b + 1, self._values[b][half:])
+        del self._keys[b][half:]
+        del self._values[b][half:]
+        self._maxes.insert(b, self._keys[b][-1])
+        self._tree = None
+
+    def _merge(self, b):
+        # Join block b with a neighbour, then split again if that made it too big
+        if b == len(self._keys) - 1:
+            b -= 1
+        self._keys[b].extend(self._keys.pop(b + 1))
+        self._values[b].extend(self._values.pop(b + 1))
+        del self._maxes[b]
+        self._maxes[b] = self._keys[b][-1]
+        self._tree = None
+        if len(self._keys[b]) > 2 * self._load:
+            self._split(b)
+
+    def _build_tree(self):
+        # O(number of blocks) Fenwick construction
+        tree = [0] + [len(block) for block in self._keys]
+        for i in range(1, len(tree)):
+            parent = i + (i & -i)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+        self._tree = tree
+
+    def _tree_add(self, b, delta):
+        tree = self._tree
+        if tree is None:
+            return
+        i = b + 1
+        while i < len(tree):
+            tree[i] += delta
+            i += i & -i
+
+    def _prefix(self, b):
+        """Total size of blocks 0..b-1"""
+        if self._tree is None:
+            self._build_tree()
+        tree = self._tree
+        total = 0
+        while b > 0:
+            total += tree[b]
+            b -= b & -b
+        return total
+
+    def _locate(self, position):
+        """Block and offset of the key at a sorted position"""
+        if self._tree is None:
+            self._build_tree()
+        tree = self._tree
+        b = 0
+        step = 1 << (len(tree) - 1).bit_length()
+        while step:
+            nxt = b + step
+            if nxt < len(tree) and tree[nxt] <= position:
+                b = nxt
+                position -= tree[nxt]
+            step >>= 1
+        return b, position
+
+
+def build_sorted_index(transactions, key='id', load=DEFAULT_LOAD):
+    """
+    Build a sorted index over a list of transactions
+
+    Args:
+        transactions (list): List of transaction dictionaries
+        key (str): Field to order by
+        load (int): Target block size
+
+    Returns:
+        SortedIndex: Index of key -> transaction
+    """
+    return SortedIndex(((t[key], t) for t in transactions), load=load)
+
+
+# Test the sorted index
+if __name__ == "__main__":
+    import random
+
+    print("Sorted Index Test")
+    print("=" * 50)
+
+    test_transactions = [{"id": i, "amount": i * 100} for i in range(1, 1001)]
+    index = build_sorted_index(test_transactions, load=16)
+
+    print(f"Point lookup 500: {index.get(500)}")
+    print(f"IDs 500-505: {[k for k, _ in index.irange(500, 505)]}")
+    print(f"Next 5 after 990: {[k for k, _ in index.after(990, 5)]}")
+    print(f"Rank of 250: {index.rank(250)}, select(249): {index.select(249)[0]}")
+    print(f"Count of IDs 100-199: {index.count_range(100, 199)}")
+
+    # Check against a plain sorted list after random inserts and deletes
+    rng = random.Random(7)
+    reference = {t["id"]: t for t in test_transactions}
+    for _ in range(20000):
+        k = rng.randint(1, 3000)
+        if rng.random() < 0.5:
+            assert index.insert(k, {"id": k}) == (k not in reference)
+            reference[k] = {"id": k}
+        else:
+            assert index.pop(k) == reference.pop(k, None)
+    keys = sorted(reference)
+    assert list(index) == keys
+    assert len(index) == len(keys)
+    for _ in range(2000):
+        lo, hi = sorted(rng.randint(0, 3100) for _ in range(2))
+        expected = [k for k in keys if lo <= k <= hi]
+        assert [k for k, _ in index.irange(lo, hi)] == expected
+        assert [k for k, _ in index.irange(lo, hi, reverse=True)] == expected[::-1]
+        assert [k for k, _ in index.irange(lo, hi, inclusive=(False, False))] == [k for k in expected if lo < k < hi]
+        assert index.count_range(lo, hi) == len(expected)
+        assert index.rank(lo) == bisect_left(keys, lo)
+        position = rng.randrange(len(keys))
+        assert index.select(position)[0] == keys[position]
+    print(f"\n✓ {len(index)} keys match a sorted list after 20000 random updates")
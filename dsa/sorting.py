@@ -0,0 +1,273 @@
+"""
+Sorted Results
+Server-side ordering for GET /transactions?sort=&limit=.
+
+Returning the top k of n transactions shouldn't sort all n:
+- timestamp: a TimeIndex keeps (time, ID) keys in order, so the first k
+  of a window are read straight off it - O(log n + k) when no type filter
+  has to skip entries
+- amount, fee: heap selection over one scan - O(n log k) time, O(k) memory
+
+Transactions missing the sort field come last in either direction; ties
+are broken by ID in the sort direction.
+"""
+
+import heapq
+
+try:
+    from dsa.sorted_index import SortedIndex
+    from dsa.ledger import ledger_time
+except ImportError:
+    from sorted_index import SortedIndex
+    from ledger import ledger_time
+
+SORT_FIELDS = ("amount", "fee", "timestamp")
+# Other names accepted for sort fields
+_ALIASES = {"date": "timestamp", "time": "timestamp"}
+
+
+def parse_sort(value):
+    """
+    Parse a sort parameter: "amount", "-amount", "amount:desc" or "amount:asc"
+
+    Returns:
+        tuple: ((field, descending), None), or (None, error message)
+    """
+    text = str(value).strip().lower()
+    descending = False
+    if text.startswith("-"):
+        text, descending = text[1:], True
+    elif ":" in text:
+        text, _, direction = text.partition(":")
+        if direction not in ("asc", "desc"):
+            return None, "sort direction must be asc or desc"
+        descending = direction == "desc"
+    field = _ALIASES.get(text, text)
+    if field not in SORT_FIELDS:
+        return None, "sort must be one of: {} (prefix with - or add :desc for descending)".format(
+            ", ".join(SORT_FIELDS))
+    return (field, descending), None
+
+
+def sort_value(transaction, field):
+    """A transaction's value for a sort field (None when it has none)"""
+    if field == "timestamp":
+        return ledger_time(transaction)
+    value = transaction.get(field)
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    return value
+
+
+def sort_key(field, descending=False):
+    """Key function putting transactions in sort order (missing values last)"""
+    sign = -1 if descending else 1
+
+    def key(transaction):
+        value = sort_value(transaction, field)
+        transaction_id = transaction.get("id")
+        if not isinstance(transaction_id, int):
+            transaction_id = 0
+        if value is None:
+            return (1, 0, sign * transaction_id)
+        return (0, sign * value, sign * transaction_id)
+    return key
+
+
+def top_k(transactions, field, descending=False, k=None):
+    """
+    The first k transactions in sort order
+
+    Args:
+        transactions (iterable): Transactions to choose from (read once)
+        field (str): One of SORT_FIELDS
+        descending (bool): Largest first
+        k (int): How many (None = all, which is a full sort)
+
+    Returns:
+        list: Up to k transactions, in order
+    """
+    key = sort_key(field, descending)
+    if k is None:
+        return sorted(transactions, key=key)
+    return heapq.nsmallest(k, transactions, key=key)
+
+
+class TimeIndex:
+    """
+    Transaction IDs in message-time order
+
+    Has the rebuild/add/remove interface of the routes store indexes. Not
+    thread-safe; readers hold the store's write lock.
+    """
+
+    def __init__(self):
+        self.rebuild([])
+
+    def __len__(self):
+        return len(self._timed) + len(self._untimed)
+
+    def rebuild(self, transactions):
+        timed = []
+        untimed = []
+        for transaction in transactions:
+            key = self._key(transaction)
+            if key[0] is None:
+                untimed.append((key[1], None))
+            else:
+                timed.append((key, None))
+        timed.sort()
+        untimed.sort()
+        self._timed = SortedIndex(timed)
+        self._untimed = SortedIndex(untimed)
+
+    def add(self, transaction):
+        key = self._key(transaction)
+        if key[0] is None:
+            self._untimed.insert(key[1], None)
+        else:
+            self._timed.insert(key, None)
+
+    def remove(self, transaction):
+        key = self._key(transaction)
+        if key[0] is None:
+            self._untimed.pop(key[1])
+        else:
+            self._timed.pop(key)
+
+    def ids(self, start=None, end=None, descending=False):
+        """
+        IDs in time order, then (without a window) those with no time
+
+        Args:
+            start (int): Window start in epoch ms, inclusive (None = no bound)
+            end (int): Window end in epoch ms, inclusive (None = no bound)
+            descending (bool): Latest first
+
+        Yields:
+            int: Transaction IDs
+        """
+        for key in self.keys(start, end, descending):
+            yield key[1]
+
+    def keys(self, start=None, end=None, descending=False, after=None):
+        """
+        Like ids(), as (time, ID) keys (time None for the untimed ones)
+
+        Args:
+            after (tuple): A key yielded earlier: carry on just past it, so
+                a walk can be resumed after the index was changed
+
+        Yields:
+            tuple: (time in epoch ms or None, transaction ID)
+        """
+        resume_untimed = after is not None and after[0] is None
+        if not resume_untimed:
+            low = None if start is None else (start, float("-inf"))
+            high = None if end is None else (end, float("inf"))
+            low, high, inclusive = self._resume(low, high, after, descending)
+            for key, _ in self._timed.irange(low, high, inclusive, reverse=descending):
+                yield key
+        if start is None and end is None:
+            low, high, inclusive = self._resume(None, None, after[1] if resume_untimed else None, descending)
+            for transaction_id, _ in self._untimed.irange(low, high, inclusive, reverse=descending):
+                yield None, transaction_id
+
+    @staticmethod
+    def _resume(low, high, after, descending):
+        """irange bounds that start just past after (if given) in walk order"""
+        if after is None:
+            return low, high, (True, True)
+        if descending:
+            return low, after, (True, False)
+        return after, high, (False, True)
+
+    @staticmethod
+    def _key(transaction):
+        return ledger_time(transaction), transaction.get("id")
+
+
+# Test sorting against a full sort
+if __name__ == "__main__":
+    import random
+    import time
+    from itertools import islice
+
+    print("Sorted Results Test")
+    print("=" * 50)
+
+    print(f"parse_sort('-amount') = {parse_sort('-amount')}")
+    print(f"parse_sort('date:asc') = {parse_sort('date:asc')}")
+    print(f"parse_sort('balance') = {parse_sort('balance')}")
+
+    rng = random.Random(11)
+    start = 1715351458724
+    transactions = []
+    for i in range(1, 20001):
+        transactions.append({
+            "id": i,
+            "type": rng.choice(["sent", "received", "payment"]),
+            "amount": rng.choice([None, rng.randint(1, 500) * 100]),
+            "fee": rng.choice([0, 100, 250, None]),
+            # Not in ID order, with ties and missing times
+            "date": rng.choice([None, start + rng.randint(0, 5000) * 60000])
+        })
+
+    def reference(items, field, descending):
+        present = [t for t in items if sort_value(t, field) is not None]
+        missing = [t for t in items if sort_value(t, field) is None]
+        present.sort(key=lambda t: (sort_value(t, field), t["id"]), reverse=descending)
+        missing.sort(key=lambda t: t["id"], reverse=descending)
+        return present + missing
+
+    for field in SORT_FIELDS:
+        for descending in (False, True):
+            expected = reference(transactions, field, descending)
+            for k in (1, 20, 500, None):
+                assert top_k(transactions, field, descending, k) == expected[:k], (field, descending, k)
+    print("✓ Heap selection matches a full sort (missing values last, ties by ID)")
+
+    # The time index, kept up to date through adds and removes
+    index = TimeIndex()
+    index.rebuild(transactions[:15000])
+    store = {t["id"]: t for t in transactions[:15000]}
+    for transaction in transactions[15000:]:
+        index.add(transaction)
+        store[transaction["id"]] = transaction
+    for transaction_id in rng.sample(sorted(store), 3000):
+        index.remove(store.pop(transaction_id))
+    live = list(store.values())
+    for descending in (False, True):
+        expected = [t["id"] for t in reference(live, "timestamp", descending)]
+        assert list(index.ids(descending=descending)) == expected
+        low, high = start + 1000 * 60000, start + 1500 * 60000
+        window = [t for t in live if t["date"] is not None and low <= t["date"] <= high]
+        assert list(index.ids(low, high, descending)) == [t["id"] for t in reference(window, "timestamp", descending)]
+        # Resumed a page at a time, the walk gives the same order
+        for bounds in ((None, None), (low, high)):
+            paged, after = [], None
+            while True:
+                page = list(islice(index.keys(*bounds, descending, after), 97))
+                if not page:
+                    break
+                paged.extend(key[1] for key in page)
+                after = page[-1]
+            assert paged == list(index.ids(*bounds, descending))
+    print(f"✓ Time index order matches a full sort ({len(index)} transactions), also walked in pages")
+
+    # Cost of the top 50 against sorting everything
+    big = [{"id": i, "amount": rng.randint(1, 10 ** 6), "date": start + rng.randint(0, 10 ** 9)}
+           for i in range(1, 1000001)]
+    begin = time.perf_counter()
+    full = sorted(big, key=sort_key("amount", True))[:50]
+    sort_time = time.perf_counter() - begin
+    begin = time.perf_counter()
+    assert top_k(big, "amount", True, 50) == full
+    heap_time = time.perf_counter() - begin
+    index.rebuild(big)
+    begin = time.perf_counter()
+    latest = list(islice(index.ids(descending=True), 50))
+    index_time = time.perf_counter() - begin
+    assert latest == [t["id"] for t in sorted(big, key=sort_key("timestamp", True))[:50]]
+    print(f"Top 50 of {len(big)} by amount: full sort {sort_time * 1000:.0f} ms, heap {heap_time * 1000:.0f} ms")
+    print(f"Latest 50 from the time index: {index_time * 1e6:.0f} µs")
@@ -0,0 +1,432 @@
+"""
+XML Parser Backends
+Ways of reading the body, readable_date and date attributes of each
+<sms> element in a backup. parse_xml turns them into transactions; the
+backend only decides how the file is read:
+
+- etree: xml.etree.ElementTree.iterparse. The reference: every other
+  backend must give exactly the same records
+- lxml: lxml.etree.iterparse, when lxml is installed
+- scan: reads the memory-mapped file in chunks and pulls each column
+  (every body, every date...) out of a chunk with one compiled regex, so
+  no element objects are built, the other dozen attributes (toa, sc_toa,
+  service_center...) are never decoded and little is done per message in
+  Python. Values are decoded the way an XML parser does it: whitespace
+  normalised, then entities expanded
+
+"auto" picks scan, which checks the quoting of each <sms> tag but, unlike
+the tree parsers, not the structure of the rest of the file.
+"""
+
+import mmap
+import os
+import re
+import xml.etree.ElementTree as ET
+
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
+DEFAULT_BACKEND = "auto"
+
+# Record fields, in the order backends yield them
+FIELDS = ("body", "readable_date", "date")
+
+_HEAD_BYTES = 65536
+_ROOT_RE = re.compile(rb"<smses\b[^>]*>")
+_COUNT_RE = re.compile(rb"""\scount\s*=\s*["'](\d+)["']""")
+_ENCODING_RE = re.compile(rb"""^<\?xml[^>]*\sencoding\s*=\s*["']([\w.:-]+)["']""")
+_UTF8 = ("utf-8", "utf8", "ascii", "us-ascii")
+
+
+def expected_count(file_path):
+    """
+    The message count the backup declares on its root element
+
+    Returns:
+        int: The count attribute of <smses>, or None
+    """
+    with open(file_path, "rb") as f:
+        head = f.read(_HEAD_BYTES)
+    root = _ROOT_RE.search(head)
+    count = _COUNT_RE.search(root.group(0)) if root else None
+    return int(count.group(1)) if count else None
+
+
+# ElementTree
+
+def etree_records(file_path):
+    """
+    (body, readable_date, date) of each <sms>, with ElementTree
+
+    Parsed elements are freed as we go, so memory stays flat however large
+    the backup is.
+    """
+    root = None
+    count = 0
+    for event, elem in ET.iterparse(file_path, events=("start", "end")):
+        if event == "start":
+            if root is None:
+                root = elem
+            continue
+        if elem.tag != "sms" or elem is root:
+            continue
+        record = (elem.get("body"), elem.get("readable_date"), elem.get("date"))
+        elem.clear()
+        count += 1
+        if count % 1000 == 0:
+            # Drop the parsed (now empty) elements
+            root.clear()
+        yield record
+
+
+# lxml
+
+def lxml_records(file_path):
+    """(body, readable_date, date) of each <sms>, with lxml"""
+    if lxml_etree is None:
+        raise ValueError("The lxml parser backend needs lxml (pip install lxml)")
+    for _, elem in lxml_etree.iterparse(file_path, events=("end",), tag="sms", huge_tree=True):
+        yield elem.get("body"), elem.get("readable_date"), elem.get("date")
+        elem.clear()
+        # Drop the elements already seen
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+
+# Byte scanner
+
+# Chunks are cut at <sms tags, so each holds whole elements
+_CHUNK_BYTES = 4 * 1024 * 1024
+_BODY_RE = re.compile(rb' body="([^"]*)"')
+_READABLE_DATE_RE = re.compile(rb' readable_date="([^"]*)"')
+_DATE_RE = re.compile(rb' date="([^"]*)"')
+_SINGLE_QUOTED_RE = re.compile(rb"=\s*'")
+
+# An <sms tag runs to the next "<" (values can't contain one). Comments,
+# CDATA and processing instructions are skipped whole, so an <sms inside
+# them isn't taken for a message
+_TAG_RE = re.compile(rb"<!--.*?-->|<!\[CDATA\[.*?\]\]>|<\?.*?\?>|<sms([\s/>][^<]*)", re.S)
+_VALUE = rb"""(?:"[^"]*"|'[^']*')"""
+# The careful path: every attribute is matched, so text inside one value is
+# never read as another attribute, and the whole tag must be well-formed
+_TAG_CHECK_RE = re.compile(rb"((?:\s+[\w:.-]+\s*=\s*" + _VALUE + rb")*)\s*/?>")
+_WANTED_RE = re.compile(
+    rb"""\s+(?:(body|readable_date|date)\s*=\s*(?:"([^"]*)"|'([^']*)')"""
+    rb"|[\w:.-]+\s*=\s*" + _VALUE + rb")")
+_WANTED = {b"body": 0, b"readable_date": 1, b"date": 2}
+
+_ENTITY_RE = re.compile(r"&(?:(amp|lt|gt|quot|apos)|#([0-9]+)|#[xX]([0-9a-fA-F]+));")
+_BAD_ENTITY_RE = re.compile(r"&(?!(?:amp|lt|gt|quot|apos|#[0-9]+|#[xX][0-9a-fA-F]+);)")
+_NAMED = {"amp": "&", "lt": "<", "gt": ">", "quot": '"', "apos": "'"}
+_WHITESPACE = str.maketrans("\t\n", "  ")
+
+
+def _entity(match):
+    name, decimal, hexadecimal = match.groups()
+    if name:
+        return _NAMED[name]
+    return chr(int(decimal) if decimal else int(hexadecimal, 16))
+
+
+def unescape_attribute(raw):
+    """
+    Decode an attribute value as an XML parser would
+
+    Literal line breaks and tabs become spaces, then entities and
+    character references are expanded.
+
+    Args:
+        raw (bytes): The value between the quotes, UTF-8
+
+    Returns:
+        str: The attribute value
+
+    Raises:
+        ValueError: An entity XML doesn't define (there's no DTD)
+    """
+    return _unescape_text(raw.decode("utf-8"))
+
+
+def _unescape_text(text):
+    if "\r" in text:
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    if "\n" in text or "\t" in text:
+        text = text.translate(_WHITESPACE)
+    if "&" in text:
+        bad = _BAD_ENTITY_RE.search(text)
+        if bad:
+            raise ValueError("Undefined entity in attribute: {!r}".format(text[bad.start():bad.start() + 12]))
+        text = _ENTITY_RE.sub(_entity, text)
+    return text
+
+
+def _scan_tag(tag, file_path, offset):
+    """
+    The decoded (body, readable_date, date) values of one <sms> tag
+
+    Quick path, for tags written the way backup apps write them: when every
+    value is double-quoted, splitting the tag on '"' gives ' name=' and
+    value in turn, and dict(zip()) pairs them up in C without looking at
+    each attribute from Python. Tags that don't fit (single quotes, unusual
+    spacing, missing attributes, values needing unescaping) take the careful
+    path, which matches every attribute and rejects malformed tags.
+    """
+    parts = tag.split(b'"')
+    if len(parts) & 1:
+        names = parts[::2]
+        if names.pop().strip() in (b"/>", b">") and b"'" not in b"".join(names):
+            attributes = dict(zip(names, parts[1::2]))
+            body = attributes.get(b" body=")
+            readable_date = attributes.get(b" readable_date=")
+            date = attributes.get(b" date=")
+            if body is not None and readable_date is not None and date is not None:
+                raw = body + readable_date + date
+                if b"&" not in raw and b"\n" not in raw and b"\t" not in raw and b"\r" not in raw:
+                    return body.decode("utf-8"), readable_date.decode("utf-8"), date.decode("utf-8")
+
+    check = _TAG_CHECK_RE.match(tag)
+    if check is None:
+        raise ValueError("{}: malformed <sms> element at byte {}".format(file_path, offset))
+    record = [None, None, None]
+    for name, double, single in _WANTED_RE.findall(check.group(1)):
+        if name:
+            record[_WANTED[name]] = unescape_attribute(double or single)
+    return tuple(record)
+
+
+def _decode_values(values):
+    """Decode a column of raw values with one decode() call"""
+    # Values can't contain a double quote, so it can join them
+    text = b'"'.join(values).decode("utf-8")
+    decoded = text.split('"')
+    if "\n" in text or "\t" in text or "\r" in text:
+        decoded = [_unescape_text(value) for value in decoded]
+    elif "&" in text:
+        decoded = [_unescape_text(value) if "&" in value else value for value in decoded]
+    return decoded
+
+
+def _scan_chunk(chunk):
+    """
+    The records of a run of whole <sms> elements, read column by column
+
+    Three findall()s pull every body, readable_date and date out of the
+    chunk, so nothing is done per message from Python. That's only right
+    when each ' date="' really starts a date attribute, which these checks
+    make sure of: all values double-quoted, and every '"' either closing a
+    value or right after '=' (a value ending in '=' would break that).
+    Then each <sms> must have given exactly one of each. Duplicated
+    attributes aren't caught here as they are by the tree parsers.
+
+    Returns:
+        list: (body, readable_date, date) tuples, or None when the chunk
+        needs the per-tag path
+    """
+    count = chunk.count(b"<sms")
+    if count == 0 or chunk.count(b'="') * 2 != chunk.count(b'"'):
+        return None
+    if b"'" in chunk and _SINGLE_QUOTED_RE.search(chunk):
+        return None
+    bodies = _BODY_RE.findall(chunk)
+    readable_dates = _READABLE_DATE_RE.findall(chunk)
+    dates = _DATE_RE.findall(chunk)
+    if not len(bodies) == len(readable_dates) == len(dates) == count:
+        return None
+    return list(zip(_decode_values(bodies), _decode_values(readable_dates), _decode_values(dates)))
+
+
+def _scan_tags(data, file_path, start=0, end=None):
+    """Records of the <sms> tags in data[start:end], one tag at a time"""
+    end = len(data) if end is None else end
+    for token in _TAG_RE.finditer(data, start, end):
+        tag = token.group(1)
+        if tag is not None:
+            yield _scan_tag(tag, file_path, token.start())
+
+
+def _is_utf8(file_path):
+    with open(file_path, "rb") as f:
+        head = f.read(256)
+    if head.startswith((b"\xff\xfe", b"\xfe\xff")):
+        return False
+    declared = _ENCODING_RE.match(head.lstrip(b"\xef\xbb\xbf"))
+    return declared is None or declared.group(1).decode().lower() in _UTF8
+
+
+def scan_records(file_path):
+    """
+    (body, readable_date, date) of each <sms>, straight from the bytes
+
+    Most backups are read a chunk at a time (see _scan_chunk). Chunks that
+    don't pass its checks, and backups with comments, CDATA or processing
+    instructions inside <smses>, are read a tag at a time. Backups in
+    encodings other than UTF-8 are read with ElementTree.
+
+    Raises:
+        ValueError: An <sms> tag that isn't well-formed
+    """
+    if not _is_utf8(file_path):
+        yield from etree_records(file_path)
+        return
+    with open(file_path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise ValueError("{}: empty file".format(file_path))
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            root = _ROOT_RE.search(data)
+            if root is None:
+                yield from _scan_tags(data, file_path)
+                return
+            prolog = data[:root.start()]
+            start = root.end()
+            if (prolog.count(b"<!--") != prolog.count(b"-->")
+                    or data.find(b"<!", start) >= 0 or data.find(b"<?", start) >= 0):
+                yield from _scan_tags(data, file_path)
+                return
+            size = len(data)
+            while start < size:
+                end = data.find(b"<sms", start + _CHUNK_BYTES)
+                if end < 0:
+                    end = size
+                records = _scan_chunk(data[start:end])
+                if records is None:
+                    yield from _scan_tags(data, file_path, start, end)
+                else:
+                    yield from records
+                start = end
+
+
+BACKENDS = {
+    "etree": etree_records,
+    "lxml": lxml_records,
+    "scan": scan_records
+}
+
+
+def available_backends():
+    """Names of the backends that can run here"""
+    return [name for name in BACKENDS if name != "lxml" or lxml_etree is not None]
+
+
+def resolve_backend(name=None):
+    """
+    The backend function for a name ("auto" or None: the default)
+
+    Raises:
+        ValueError: Unknown backend, or lxml asked for but not installed
+    """
+    name = (name or DEFAULT_BACKEND).lower()
+    if name == "auto":
+        name = "scan"
+    if name not in BACKENDS:
+        raise ValueError("Unknown XML parser backend {!r} (choose from: auto, {})".format(
+            name, ", ".join(BACKENDS)))
+    if name == "lxml" and lxml_etree is None:
+        raise ValueError("The lxml parser backend needs lxml (pip install lxml)")
+    return BACKENDS[name]
+
+
+def iter_records(file_path, backend=None):
+    """
+    Yield (body, readable_date, date) for each <sms> element, in file order
+
+    Args:
+        file_path (str): Path to the <smses> XML backup
+        backend (str): 'auto', 'etree', 'lxml' or 'scan'
+    """
+    return resolve_backend(backend)(file_path)
+
+
+# Check the backends agree, and compare their speed
+if __name__ == "__main__":
+    import sys
+    import tempfile
+    import time
+
+    try:
+        from dsa.generate_sms import write_sms_backup
+    except ImportError:
+        from generate_sms import write_sms_backup
+
+    print("XML Parser Backends Test")
+    print("=" * 50)
+    print(f"Available: {', '.join(available_backends())}")
+
+    # Everything a scanner could get wrong
+    tricky = (
+        "<?xml version='1.0' encoding='utf-8'?>\n"
+        "<!-- exported by a test; <sms body=\"not a message\" /> -->\n"
+        "<smses count=\"10\" type=\"full\">\n"
+        "  <sms date=\"1\" body=\"Fish &amp; chips &lt;3 &quot;ok&quot; &#39;x&#x27; caf&#233;\" "
+        "readable_date=\"10 May 2024\" />\n"
+        "  <sms body='It&apos;s \"quoted\" with a > sign' date='2' readable_date='b' />\n"
+        "  <sms contact_name=\"x date=&quot;99&quot; body=y\" date=\"3\" body=\"after a decoy\" />\n"
+        "  <sms\n    date = \"4\"\n    body=\"line one&#10;line two\nwrapped\tand\r\ntabbed\"\n  />\n"
+        "  <sms date=\"5\" body=\"Mūhīre 💸 paid\"></sms>\n"
+        "  <sms date=\"6\" />\n"
+        "  <sms date=\"7\" body=\"\" readable_date=\"\"/>\n"
+        "  <![CDATA[<sms date=\"0\" body=\"in cdata\" />]]>\n"
+        "  <sms date=\"8\" body=\"x/>y\" toa=\"null\" sc_toa=\"null\" service_center=\"+250788110381\"/>\n"
+        "  <sms subject=\"a date=\" body=\"ends like an attribute\" date=\"10\" />\n"
+        "  <sms body=\"last\" date=\"9\"><part text=\"child elements are ignored\" /></sms>\n"
+        "</smses>\n")
+    directory = tempfile.mkdtemp()
+    tricky_path = os.path.join(directory, "tricky.xml")
+    with open(tricky_path, "w", encoding="utf-8") as f:
+        f.write(tricky)
+
+    # The same without comments or CDATA, read below in chunks of a few
+    # tags, so both the column-wise and the per-tag paths run
+    plain_path = os.path.join(directory, "plain.xml")
+    with open(plain_path, "w", encoding="utf-8") as f:
+        f.write("\n".join(line for line in tricky.splitlines() if "<!" not in line))
+
+    synthetic_path = os.path.join(directory, "synthetic.xml")
+    write_sms_backup(synthetic_path, 100000, seed=7)
+
+    files = [tricky_path, plain_path, synthetic_path]
+    sample = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "modified_sms_v2.xml")
+    if os.path.exists(sample):
+        files.append(sample)
+    files += sys.argv[1:]
+
+    for path in files:
+        reference = list(etree_records(path))
+        _CHUNK_BYTES = 1 if path == plain_path else 4 * 1024 * 1024
+        for name in available_backends():
+            records = list(iter_records(path, name))
+            assert records == reference, (name, path, next(
+                (a, b) for a, b in zip(records, reference) if a != b) if len(records) == len(reference) else len(records))
+        print(f"✓ {os.path.basename(path)}: {len(reference)} records, all backends match etree")
+    print(f"  Tricky records: {list(scan_records(tricky_path))[:4]}")
+    assert expected_count(tricky_path) == 10
+
+    # Broken input fails loudly, as it does with a tree parser
+    for broken in ('<smses><sms date=1 body="unquoted" /></smses>',
+                   '<smses><sms date="1" body="&nbsp;" /></smses>'):
+        with open(tricky_path, "w") as f:
+            f.write(broken)
+        for name in available_backends():
+            try:
+                list(iter_records(tricky_path, name))
+            except (ValueError, ET.ParseError):
+                continue
+            raise AssertionError(f"{name} accepted {broken}")
+    print("✓ Malformed tags and undefined entities are rejected by every backend")
+
+    # Throughput
+    size = os.path.getsize(synthetic_path)
+    print(f"\nThroughput on {synthetic_path} ({size / 1e6:.1f} MB, 100000 messages):")
+    for name in available_backends():
+        best = float("inf")
+        for _ in range(3):
+            begin = time.perf_counter()
+            for _ in iter_records(synthetic_path, name):
+                pass
+            best = min(best, time.perf_counter() - begin)
+        print(f"  {name:<6} {100000 / best:>10.0f} msg/s  {size / best / 1e6:6.1f} MB/s")
+
+    for path in os.listdir(directory):
+        os.remove(os.path.join(directory, path))
+    os.rmdir(directory)